@@ -26,7 +26,14 @@ if __name__ == "__main__":
     parser.add_argument('-a', '--storage-account')
     parser.add_argument('-c', '--storage-container')
     parser.add_argument('-k', '--storage-key')
+    parser.add_argument('-p', '--prefix', help='only onboard blobs of the storage container under this prefix')
     parser.add_argument('-n', '--num-images', type=int)
+    parser.add_argument(
+        '-s',
+        '--strategy',
+        choices=['least_confident', 'most_confident', 'any'],
+        help='order in which images are checked out for download'
+    )
 
     args = parser.parse_args()
     operation = args.operation
@@ -35,7 +42,7 @@ if __name__ == "__main__":
     config = Config.read_config(config_path)
 
     if operation == 'download':
-        download(config, args.num_images)
+        download(config, args.num_images, args.strategy)
     elif operation == 'upload':
         upload(config)
     else:
@@ -46,7 +53,8 @@ if __name__ == "__main__":
                 config,
                 args.storage_account,
                 args.storage_key,
-                args.storage_container
+                args.storage_container,
+                args.prefix
             )
         else:
             print("No folder, storage account, container, or key argument \
@@ -5,16 +5,32 @@ import json
 import copy
 import pathlib
 import os
+import base64
+import hashlib
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urlpath import URL
 from azure.storage.blob import BlockBlobService, ContentSettings
 from utils.blob_utils import BlobStorage
-from utils.vott_parser import process_vott_json, create_starting_vott_json, build_id_to_VottImageTag, create_vott_json_from_image_labels
+from utils.download_utils import download_files
+from utils.vott_parser import process_vott_json, create_starting_vott_json, build_id_to_VottImageTag, create_vott_json_from_image_labels, create_vott_json_from_checkout_columns, get_frame_hashes, select_frames
 from functions.pipeline.shared.db_access import ImageLabel, ImageTag
 
 DEFAULT_NUM_IMAGES = 40
 LOWER_LIMIT = 0
 UPPER_LIMIT = 100
 
+UPLOAD_WORKERS = 8
+# Files are uploaded in parallel, so each one is uploaded over a single connection
+UPLOAD_MAX_CONNECTIONS = 1
+ONBOARD_POST_BATCH_SIZE = 200
+# Kept in the onboarded folder, one JSON record per uploaded or onboarded image, so an interrupted onboarding
+# resumes where it stopped
+ONBOARD_MANIFEST_FILE_NAME = ".onboard_manifest.jsonl"
+# Kept next to data.json with a hash of each frame as it was last uploaded. download removes it with the rest of
+# the previous checkout.
+UPLOAD_STATE_FILE_NAME = "upload_state.json"
+
 azure_storage_client = None
 
 class ImageLimitException(Exception):
@@ -32,50 +48,145 @@ def supported_file_type(file_name):
 # TODO We should create the container if it does not exist
 def onboard_folder(config, folder_name):
     blob_storage = BlobStorage.get_azure_storage_client(config)
-    uri = 'https://' + config.get("storage_account") + '.blob.core.windows.net/' + config.get("storage_temp_container") + '/'
+    temp_container = config.get("storage_temp_container")
+    uri = 'https://' + config.get("storage_account") + '.blob.core.windows.net/' + temp_container + '/'
     functions_url = config.get('url') + '/api/onboarding'
     user_name = config.get("tagging_user")
-    images = []
-
-    for image in os.listdir(folder_name):
-        if not supported_file_type(image):
-            continue
 
+    # Images uploaded or onboarded by an earlier, possibly interrupted, run are not uploaded again
+    manifest_path = os.path.join(folder_name, ONBOARD_MANIFEST_FILE_NAME)
+    uploaded, onboarded = _load_onboard_manifest(manifest_path)
+
+    images = sorted(image for image in os.listdir(folder_name) if supported_file_type(image) and image not in onboarded)
+    to_upload = [image for image in images
+                 if uploaded.get(image) != _file_signature(os.path.join(folder_name, image))]
+    print("Uploading {0} images, {1} already uploaded.".format(len(to_upload), len(images) - len(to_upload)))
+
+    with open(manifest_path, "a") as manifest:
+        for image in _upload_images(blob_storage, temp_container, folder_name, to_upload):
+            uploaded[image] = _file_signature(os.path.join(folder_name, image))
+            _append_manifest(manifest, dict(uploaded[image], file=image))
+
+        to_onboard = [image for image in images if image in uploaded]
+        query = {
+            "code": config.get('key'),
+            "userName": user_name
+        }
+        # Posted in batches so each onboarding request finishes well within the function timeout
+        for i in range(0, len(to_onboard), ONBOARD_POST_BATCH_SIZE):
+            batch = to_onboard[i:i + ONBOARD_POST_BATCH_SIZE]
+            print("Onboarding images {0} to {1} of {2}".format(i + 1, i + len(batch), len(to_onboard)))
+
+            # Post this data to the server to add them to database and kick off active learning
+            data = {}
+            image_urls = {uri + image: image for image in batch}
+            data['imageUrls'] = list(image_urls.keys())
+
+            response = requests.post(functions_url, json=data, params=query)
+            response_json = _onboarding_response_json(response)
+            _print_onboarding_response(response_json, len(batch))
+            # Images the function is done with are recorded even if others in the batch failed. Their temporary
+            # blobs may already be deleted, so they can't be posted again. The rest are posted by the next run.
+            for image_url in _onboarded_urls(response, response_json, image_urls.keys()):
+                _append_manifest(manifest, {"file": image_urls[image_url], "onboarded": True})
+            response.raise_for_status()
+
+
+# Uploads images to the temporary container, UPLOAD_WORKERS at a time. Yields each image once it is uploaded.
+def _upload_images(blob_storage, container, folder_name, images):
+    def upload_image(image):
         local_path = os.path.join(folder_name, image)
-        print('Uploading image ' + image)
-
         # Upload the created file, use image name for the blob name
         blob_storage.create_blob_from_path(
-            config.get("storage_temp_container"),
+            container,
             image,
             local_path,
-            content_settings=ContentSettings(content_type='image/png')
+            # Large files are uploaded in blocks, which leaves the blob without an MD5 unless it is set here.
+            # Onboarding uses it to skip images that are already in the dataset.
+            content_settings=ContentSettings(content_type=_content_type(image), content_md5=_file_md5(local_path)),
+            max_connections=UPLOAD_MAX_CONNECTIONS
         )
+        return image
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_image, image) for image in images]
+        for count, future in enumerate(as_completed(futures), 1):
+            image = future.result()
+            print("[{0}/{1}] Uploaded image {2}".format(count, len(images), image))
+            yield image
+
+
+# Error responses that don't come from the function itself, e.g. a gateway timeout, need not be JSON
+def _onboarding_response_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+# Images of the batch that are onboarded, skipped as duplicates or still being copied by the function
+def _onboarded_urls(response, response_json, image_urls):
+    if 'onboarded' not in response_json:
+        # Function apps that predate per image results only report success for the whole batch
+        return list(image_urls) if response.ok else []
+    done = set(response_json['onboarded']) | set(response_json.get('duplicates', [])) | \
+        set(response_json.get('copy_pending', {}))
+    return [image_url for image_url in image_urls if image_url in done]
+
+
+def _print_onboarding_response(response_json, image_count):
+    if 'onboarded' in response_json:
+        print("Successfully onboarded {0} of {1} images.".format(len(response_json['onboarded']), image_count))
+    elif 'Success' in response_json:
+        print("Successfully onboarded {0} images.".format(image_count - len(response_json.get('duplicates', []))))
+    if response_json.get('duplicates'):
+        print("Skipped {0} images that were already onboarded.".format(len(response_json['duplicates'])))
+    if response_json.get('copy_pending'):
+        print("Copies to permanent storage still in progress for: " + str(response_json['copy_pending']))
+    if response_json.get('probe_failed'):
+        print("Failed to read following images: " + str(response_json['probe_failed']))
+    if 'copy_failed' in response_json:
+        print("Failed to copy following images to permanent storage: " + str(response_json['copy_failed']))
+    if 'delete_failed' in response_json:
+        print("Failed to delete following images from permanent storage: " + str(response_json['delete_failed']))
 
-        images.append(uri + image)
 
-    # Post this data to the server to add them to database and kick off active learning
-    data = {}
-    data['imageUrls'] = images
+def _content_type(file_name):
+    return mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
 
-    query = {
-        "code": config.get('key'),
-        "userName": user_name
-    }
 
-    response = requests.post(functions_url, json=data, params=query)
-    response_json = response.json()
-    response.raise_for_status()
+# Size and modification time, an image changed since it was uploaded is uploaded again
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
 
-    if 'Success' in response_json:
-        print("Successfully onboarded {0} images.".format(len(images)))
-    if 'copy_failed' in response_json:
-        print("Failed to copy following images to permanent storage: " + str(response_json['copy_failed']))
-    if 'delete_failed' in response_json:
-        print("Failed to delete following images from permanent storage: " + str(response_json['delete_failed']))
 
+# Returns ({file name: file signature} of uploaded images, set of onboarded file names)
+def _load_onboard_manifest(manifest_path):
+    uploaded = {}
+    onboarded = set()
+    if not os.path.exists(manifest_path):
+        return uploaded, onboarded
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line of a run that was killed while writing it
+                continue
+            if record.get("onboarded"):
+                onboarded.add(record["file"])
+            else:
+                uploaded[record["file"]] = {"size": record["size"], "mtime": record["mtime"]}
+    return uploaded, onboarded
 
-def onboard_container(config, account, key, container):
+
+def _append_manifest(manifest, record):
+    manifest.write(json.dumps(record) + "\n")
+    manifest.flush()
+
+
+def onboard_container(config, account, key, container, prefix=None):
     print("onboarding from storage container")
     function_url = config.get('url') + '/api/onboardcontainer'
     user_name = config.get("tagging_user")
@@ -89,13 +200,26 @@ def onboard_container(config, account, key, container):
     data = {
         "storageAccount": account,
         "storageAccountKey": key,
-        "storageContainer": container
+        "storageContainer": container,
+        "prefix": prefix
     }
 
     resp = requests.post(function_url, params=query, json=data)
     resp.raise_for_status()
+    job_id = resp.json()["jobId"]
+
+    print("Set up container for onboarding as job {0}. Onboarding may take some time.".format(job_id))
+    print("Check progress with: GET {0}?userName={1}&jobId={2}".format(function_url, user_name, job_id))
+    return job_id
+
 
-    print("Set up container for onboarding. Onboarding may take some time.")
+# Base64 encoded MD5 of a file, the form blob storage keeps as Content-MD5
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode('ascii')
 
 
 def _download_bounds(num_images):
@@ -118,15 +242,23 @@ def download(config, num_images, strategy=None):
     query = {
         "imageCount": images_to_download,
         "userName": user_name,
-        "checkOut": "true"
+        "checkOut": "true",
+        "format": "compact"
     }
+    if strategy:
+        query["strategy"] = strategy
 
     response = requests.get(functions_url, params=query)
     response.raise_for_status()
 
     json_resp = response.json()
-    images_json = json.loads(json_resp["images"])
-    count = len(images_json)
+    if "tags" in json_resp:
+        vott_json, image_urls = create_vott_json_from_checkout_columns(json_resp, json_resp["classification_list"])
+    else:
+        # Function apps that predate the compact format ignore it and send the default format
+        checkedout_image_labels = [ImageLabel.fromJson(item) for item in json.loads(json_resp["images"])]
+        vott_json, image_urls = create_vott_json_from_image_labels(checkedout_image_labels, json_resp["classification_list"])
+    count = len(image_urls)
 
     print("Received " + str(count) + " files.")
     
@@ -138,18 +270,17 @@ def download(config, num_images, strategy=None):
         config.get("tagging_location"))
     )
 
-    if file_tree.exists():
-        print("Removing existing tag data directory: " + str(file_tree))
+    data_dir = pathlib.Path(file_tree / "data")
 
-        shutil.rmtree(str(file_tree), ignore_errors=True)
+    if file_tree.exists():
+        print("Removing existing tag data from: " + str(file_tree))
+        # Images checked out again are kept, download_images skips them if they are complete
+        _remove_tag_data(file_tree, data_dir, {_local_image_path(data_dir, url) for url in image_urls})
 
-    data_dir = pathlib.Path(file_tree / "data")
     data_dir.mkdir(
         parents=True,
         exist_ok=True
     )
-    checkedout_image_labels = [ImageLabel.fromJson(item) for item in images_json]
-    vott_json, image_urls = create_vott_json_from_image_labels(checkedout_image_labels, json_resp["classification_list"])
 
     json_data = {'vott_json': vott_json,
                  'imageUrls': image_urls}
@@ -169,21 +300,42 @@ def download_images(config, image_dir, json_resp):
     write_vott_data(image_dir, json_resp)
 
     urls = json_resp['imageUrls']
-    downloaded_file_paths = []
-    for url_path in urls:
-        url = URL(url_path)
+    downloads = [(url, _local_image_path(image_dir, url)) for url in urls]
 
-        #   TODO: We will download an empty file if we get a permission error on the blob store URL
-        # We should raise an exception. For now the blob store must be publically accessible
-        response = requests.get(url)
-        file_path = pathlib.Path(image_dir / url.name)
+    def print_progress(finished, total, file_path, error):
+        if error:
+            print("[{0}/{1}] Failed to download {2}: {3}".format(finished, total, file_path.name, error))
+        else:
+            print("[{0}/{1}] {2}".format(finished, total, file_path.name))
 
-        with open(str(file_path), "wb") as file:
-            for chunk in response.iter_content(chunk_size=128):
-                file.write(chunk)
-            file.close()
-        downloaded_file_paths.append(file_path)
-    return downloaded_file_paths
+    downloaded_file_paths, failures = download_files(downloads, progress=print_progress)
+    if failures:
+        print("Failed to download {0} of {1} images.".format(len(failures), len(urls)))
+    # Keep the checkout order rather than completion order
+    downloaded = set(downloaded_file_paths)
+    return [file_path for _, file_path in downloads if file_path in downloaded]
+
+
+def _local_image_path(image_dir, url):
+    return pathlib.Path(image_dir / URL(url).name)
+
+
+# Removes everything under the tagging location except the images in keep_image_paths
+def _remove_tag_data(file_tree, data_dir, keep_image_paths):
+    for path in file_tree.iterdir():
+        if path == data_dir and path.is_dir():
+            for image_path in path.iterdir():
+                if image_path not in keep_image_paths:
+                    _remove_path(image_path)
+        else:
+            _remove_path(path)
+
+
+def _remove_path(path):
+    if path.is_dir():
+        shutil.rmtree(str(path), ignore_errors=True)
+    else:
+        path.unlink()
 
 
 def write_vott_data(image_dir, json_resp):
@@ -212,7 +364,18 @@ def upload(config):
 
     with open(str(vott_json)) as json_file:
         json_data = json.load(json_file)
-    process_json = process_vott_json(json_data)
+
+    # Only frames that changed since the last upload of this checkout are sent
+    upload_state_path = pathlib.Path(tagging_location / UPLOAD_STATE_FILE_NAME)
+    uploaded_hashes = _load_upload_state(upload_state_path)
+    frame_hashes = get_frame_hashes(json_data)
+    changed_frames = [frame for frame, frame_hash in frame_hashes.items() if uploaded_hashes.get(frame) != frame_hash]
+    if not changed_frames:
+        print("No changes since the last upload.")
+        return
+    print("Uploading {0} of {1} frames.".format(len(changed_frames), len(frame_hashes)))
+
+    process_json = process_vott_json(select_frames(json_data, changed_frames))
     query = {
         "userName": user_name,
         "upload": "true"
@@ -222,4 +385,21 @@ def upload(config):
     response.raise_for_status()
 
     resp_json = response.json()
-    print("Done!")
\ No newline at end of file
+    uploaded_hashes.update((frame, frame_hashes[frame]) for frame in changed_frames)
+    _save_upload_state(upload_state_path, uploaded_hashes)
+    print("Done!")
+
+
+def _load_upload_state(upload_state_path):
+    if not upload_state_path.exists():
+        return {}
+    with open(str(upload_state_path)) as state_file:
+        return json.load(state_file)
+
+
+def _save_upload_state(upload_state_path, frame_hashes):
+    # Replaced in one step so an interrupted save never loses the hashes of earlier uploads
+    temp_path = pathlib.Path(str(upload_state_path) + ".tmp")
+    with open(str(temp_path), "w") as state_file:
+        json.dump(frame_hashes, state_file)
+    os.replace(str(temp_path), str(upload_state_path))
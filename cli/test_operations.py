@@ -1,7 +1,11 @@
 import unittest
 import json
+import os
+import shutil
 import pathlib
-from unittest.mock import Mock
+import tempfile
+import requests
+from unittest.mock import Mock, patch
 
 from utils.config import Config, MissingConfigException
 from utils.config import (
@@ -19,6 +23,9 @@ from utils.config import (
 )
 from .operations import (
     _download_bounds,
+    download,
+    onboard_folder,
+    ONBOARD_MANIFEST_FILE_NAME,
     upload,
     ImageLimitException,
     DEFAULT_NUM_IMAGES,
@@ -46,6 +53,147 @@ class TestCLIOperations(unittest.TestCase):
         self.assertEqual(10, downloaded_image_count)
 
 
+@patch('cli.operations.requests.post')
+@patch('cli.operations.BlobStorage.get_azure_storage_client')
+class TestOnboardFolder(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for name in ["a.jpg", "b.png", "c.jpg", "notes.txt"]:
+            with open(os.path.join(self.folder, name), "wb") as f:
+                f.write(b"image " + name.encode())
+        config = {"storage_account": "account", "storage_temp_container": "temp", "url": "https://functions",
+                  "tagging_user": "me", "key": "key"}
+        self.config = Mock()
+        self.config.get.side_effect = config.get
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def posted_urls(self, mock_post):
+        return [url for c in mock_post.call_args_list for url in c[1]["json"]["imageUrls"]]
+
+    def test_content_types_and_batches(self, mock_client, mock_post):
+        mock_post.return_value.json.return_value = {"Success": "Transfer of all images complete."}
+        with patch('cli.operations.ONBOARD_POST_BATCH_SIZE', 2):
+            onboard_folder(self.config, self.folder)
+        uploads = {c[0][1]: c[1]["content_settings"].content_type
+                   for c in mock_client.return_value.create_blob_from_path.call_args_list}
+        self.assertEqual({"a.jpg": "image/jpeg", "b.png": "image/png", "c.jpg": "image/jpeg"}, uploads)
+        self.assertEqual(2, mock_post.call_count)
+        self.assertEqual(["https://account.blob.core.windows.net/temp/" + name for name in ["a.jpg", "b.png", "c.jpg"]],
+                         self.posted_urls(mock_post))
+
+    def test_resumes_after_failed_batch(self, mock_client, mock_post):
+        failed = Mock(ok=False)
+        failed.json.return_value = {"copy_failed": {}}
+        failed.raise_for_status.side_effect = requests.exceptions.HTTPError("500")
+        succeeded = Mock()
+        succeeded.json.return_value = {"Success": "Transfer of all images complete."}
+        mock_post.side_effect = [succeeded, failed]
+        with patch('cli.operations.ONBOARD_POST_BATCH_SIZE', 2):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                onboard_folder(self.config, self.folder)
+            self.assertTrue(os.path.exists(os.path.join(self.folder, ONBOARD_MANIFEST_FILE_NAME)))
+
+            mock_client.return_value.create_blob_from_path.reset_mock()
+            mock_post.reset_mock()
+            mock_post.side_effect = None
+            mock_post.return_value = succeeded
+            onboard_folder(self.config, self.folder)
+        mock_client.return_value.create_blob_from_path.assert_not_called()
+        self.assertEqual(["https://account.blob.core.windows.net/temp/c.jpg"], self.posted_urls(mock_post))
+
+    def test_records_images_onboarded_by_failed_batch(self, mock_client, mock_post):
+        uri = "https://account.blob.core.windows.net/temp/"
+        partly_failed = Mock(ok=False)
+        partly_failed.json.return_value = {"onboarded": [uri + "a.jpg"], "duplicates": [], "copy_pending": {},
+                                           "copy_failed": {uri + "b.png": uri + "2.png"}, "delete_failed": {},
+                                           "probe_failed": {uri + "c.jpg": "not found"}}
+        partly_failed.raise_for_status.side_effect = requests.exceptions.HTTPError("500")
+        mock_post.return_value = partly_failed
+        with self.assertRaises(requests.exceptions.HTTPError):
+            onboard_folder(self.config, self.folder)
+
+        mock_post.reset_mock()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            onboard_folder(self.config, self.folder)
+        self.assertEqual([uri + "b.png", uri + "c.jpg"], self.posted_urls(mock_post))
+
+    def test_error_body_that_is_not_json(self, mock_client, mock_post):
+        mock_post.return_value.ok = False
+        mock_post.return_value.json.side_effect = ValueError("No JSON object could be decoded")
+        mock_post.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError("504")
+        with self.assertRaises(requests.exceptions.HTTPError):
+            onboard_folder(self.config, self.folder)
+
+
+@patch('cli.operations.requests.post')
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        self.tagging_location = tempfile.mkdtemp()
+        self.config = Mock()
+        self.config.get.side_effect = {"url": "https://functions", "tagging_user": "me",
+                                       "tagging_location": self.tagging_location}.get
+        tag = {"x1": 1, "x2": 2, "y1": 3, "y2": 4, "tags": ["car"], "UID": "a", "id": 1, "type": "Rectangle", "name": 1}
+        self.vott_json = {"frames": {"1.jpg": [tag], "2.jpg": []}, "visitedFrames": ["1.jpg"]}
+
+    def tearDown(self):
+        shutil.rmtree(self.tagging_location)
+
+    def write_vott_json(self):
+        with open(os.path.join(self.tagging_location, "data.json"), "w") as f:
+            json.dump(self.vott_json, f)
+
+    def test_only_changed_frames_are_uploaded(self, mock_post):
+        self.write_vott_json()
+        upload(self.config)
+        self.assertEqual(2, mock_post.call_args[1]["json"]["totalNumImages"])
+
+        upload(self.config)
+        self.assertEqual(1, mock_post.call_count)
+
+        self.vott_json["visitedFrames"].append("2.jpg")
+        self.write_vott_json()
+        upload(self.config)
+        posted = mock_post.call_args[1]["json"]
+        self.assertEqual(1, posted["totalNumImages"])
+        self.assertEqual([2], posted["imagesVisitedNoTag"])
+
+
+@patch('cli.operations.download_images')
+@patch('cli.operations.requests.get')
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.tagging_location = tempfile.mkdtemp()
+        self.config = Mock()
+        self.config.get.side_effect = {"url": "https://functions", "tagging_user": "me",
+                                       "tagging_location": self.tagging_location}.get
+
+    def tearDown(self):
+        shutil.rmtree(self.tagging_location)
+
+    def test_compact_checkout(self, mock_get, mock_download_images):
+        mock_get.return_value.json.return_value = {
+            "images": {"id": [7, 8], "location": ["https://perm/7.jpg", "https://perm/8.jpg"],
+                       "height": [10, 20], "width": [30, 40]},
+            "tags": {"image": [1, 1], "x_min": [1.0, 2.0], "x_max": [3.0, 4.0], "y_min": [5.0, 6.0],
+                     "y_max": [7.0, 8.0], "class": [0, 1]},
+            "classes": ["car", "truck"],
+            "classification_list": ["car", "truck"]
+        }
+        mock_download_images.return_value = []
+        download(self.config, 2)
+
+        self.assertEqual("compact", mock_get.call_args[1]["params"]["format"])
+        json_data = mock_download_images.call_args[0][2]
+        self.assertEqual(["https://perm/7.jpg", "https://perm/8.jpg"], json_data["imageUrls"])
+        frames = json_data["vott_json"]["frames"]
+        self.assertEqual([], frames["7.jpg"])
+        self.assertEqual([["car"], ["truck"]], [tag["tags"] for tag in frames["8.jpg"]])
+        self.assertEqual(["8-0", "8-1"], [tag["UID"] for tag in frames["8.jpg"]])
+        self.assertEqual((20, 40), (frames["8.jpg"][0]["height"], frames["8.jpg"][0]["width"]))
+
+
 class TestConfig(unittest.TestCase):
 
     def _mock_sections(self, sections, data):
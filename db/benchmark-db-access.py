@@ -0,0 +1,81 @@
+import sys
+import os
+import time
+import argparse
+import logging
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.pipeline.shared.db_access import ImageTagDataAccess
+from functions.pipeline.shared.db_provider import PostGresProvider, DatabaseInfo
+from functions.pipeline.shared.db_access.db_access_v2 import generate_test_image_infos
+
+#################################################################
+# Benchmarks for the hot data access paths. Run this against a
+# scratch database created with install-db-resources.py, it
+# inserts the generated rows and does not clean them up.
+#################################################################
+
+DEFAULT_IMAGE_COUNTS = [1000, 10000, 100000]
+
+
+# Baseline for comparison: one INSERT ... RETURNING round trip per image
+def add_new_images_row_by_row(pg, list_of_image_infos, user_id):
+    url_to_image_id_map = {}
+    conn = pg.get_connection()
+    try:
+        cursor = conn.cursor()
+        query = ("INSERT INTO Image_Info (OriginalImageName,ImageLocation,Height,Width,CreatedByUser) "
+                 "VALUES (%s,%s,%s,%s,%s) RETURNING ImageId;")
+        for img in list_of_image_infos:
+            cursor.execute(query, (img.image_name, img.image_location, img.height, img.width, user_id))
+            url_to_image_id_map[img.image_location] = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+    return url_to_image_id_map
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_add_new_images(pg, data_access, user_id, image_counts, include_baseline):
+    print("add_new_images")
+    print("{0:>10}\t{1:>12}\t{2:>10}\t{3:>12}".format("Images", "Method", "Seconds", "Rows/sec"))
+    for count in image_counts:
+        image_infos = generate_test_image_infos(count)
+        url_to_image_id_map, elapsed = time_call(data_access.add_new_images, image_infos, user_id)
+        assert len(url_to_image_id_map) == len(set(img.image_location for img in image_infos))
+        print("{0:>10}\t{1:>12}\t{2:>10.2f}\t{3:>12.0f}".format(count, "batched", elapsed, count / elapsed))
+
+        if include_baseline:
+            image_infos = generate_test_image_infos(count)
+            _, elapsed = time_call(add_new_images_row_by_row, pg, image_infos, user_id)
+            print("{0:>10}\t{1:>12}\t{2:>10.2f}\t{3:>12.0f}".format(count, "row-by-row", elapsed, count / elapsed))
+
+
+def main(image_counts, user_name, include_baseline):
+    if(os.getenv("DB_HOST") is None or os.getenv("DB_USER") is None or os.getenv("DB_NAME") is None or os.getenv("DB_PASS") is None):
+        print("Please set environment variables for DB_HOST, DB_USER, DB_NAME, DB_PASS")
+        return
+
+    db_config = DatabaseInfo(os.getenv("DB_HOST"), os.getenv("DB_NAME"), os.getenv("DB_USER"), os.getenv("DB_PASS"))
+    pg = PostGresProvider(db_config)
+    data_access = ImageTagDataAccess(pg)
+    user_id = data_access.create_user(user_name)
+
+    benchmark_add_new_images(pg, data_access, user_id, image_counts, include_baseline)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--image-counts', type=int, nargs='+', default=DEFAULT_IMAGE_COUNTS,
+                        help='Number of images to register in each run')
+    parser.add_argument('-u', '--user-name', default='benchmark',
+                        help='User the generated images are created by')
+    parser.add_argument('--baseline', action='store_true',
+                        help='Also time the row at a time INSERT for comparison')
+    args = parser.parse_args()
+    main(args.image_counts, args.user_name, args.baseline)
@@ -8,6 +8,7 @@ from os import listdir
 from os.path import isfile, join
 
 default_postgres_db_name = "postgres"
+migrations_dir_name = "migrations"
 
 def read_file_as_string(local_file_name):
     data = None
@@ -102,12 +103,68 @@ def execute_files_in_dir_list(conn,list_of_sub_dirs):
             return
         execute_queries_from_map(conn,file_query_map)
 
-def main(db_name, overwrite_db):
+# Migrations are named NNN_description.sql, hold a single statement and are applied once each in version order
+def get_migration_version(file_path):
+    return int(os.path.basename(file_path).split('_', 1)[0])
+
+def create_migrations_table(conn):
+    cursor = conn.cursor()
+    query = ("CREATE TABLE IF NOT EXISTS Schema_Migrations ("
+             "Version integer PRIMARY KEY, "
+             "FileName text NOT NULL, "
+             "AppliedDtim timestamp NOT NULL default current_timestamp);")
+    cursor.execute(query)
+    conn.commit()
+
+def get_applied_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT Version FROM Schema_Migrations;")
+    return set(row[0] for row in cursor.fetchall())
+
+def apply_migrations(conn):
+    print("\n****\tApplying migrations in '{0}' directory\t****\n".format(migrations_dir_name))
+    create_migrations_table(conn)
+    applied = get_applied_migrations(conn)
+    file_query_map = get_file_query_map(migrations_dir_name)
+    if '' in file_query_map.values():
+        print("One of the migrations is empty. Please fix")
+        return
+    migrations = sorted((get_migration_version(f), f) for f in file_query_map.keys())
+    versions = [version for version, _ in migrations]
+    if len(versions) != len(set(versions)):
+        print("Migration versions must be unique. Please fix")
+        return
+    pending = [(version, f) for version, f in migrations if version not in applied]
+    if not pending:
+        print("Database is up to date")
+        return
+    cursor = conn.cursor()
+    print("Applied: \n")
+    for version, file_path in pending:
+        # The migration and its bookkeeping row commit together so a failed migration can be fixed and rerun
+        cursor.execute(file_query_map[file_path])
+        cursor.execute("INSERT INTO Schema_Migrations (Version, FileName) VALUES (%s, %s);",
+                       (version, os.path.basename(file_path)))
+        conn.commit()
+        print("\t{0}".format(file_path))
+
+def migrate(db_name):
+    if not database_exists(get_default_connection(), db_name):
+        print("Database {0} does not exist. Run without --migrate to create it.".format(db_name))
+        return
+    apply_migrations(get_connection_for_db(db_name))
+    print("Done!")
+
+def main(db_name, overwrite_db, migrate_only=False):
     try:
         if(os.getenv("DB_HOST") is None or os.getenv("DB_USER") is None or os.getenv("DB_PASS") is None):
             print("Please set environment variables for DB_HOST, DB_USER, DB_PASS")
             return
 
+        if migrate_only:
+            migrate(db_name)
+            return
+
         if (database_exists(get_default_connection(), db_name) and overwrite_db):
             remove_database(get_default_connection(),db_name)
         elif (database_exists(get_default_connection(), db_name) and not overwrite_db):
@@ -125,6 +182,9 @@ def main(db_name, overwrite_db):
         sub_dirs = ["tables","functions","triggers","data"]
         execute_files_in_dir_list(conn,sub_dirs)
 
+        #Bring the new database up to the latest schema version
+        apply_migrations(conn)
+
         print("Done!")
     except Exception as e:
         print(e)
@@ -139,6 +199,9 @@ if __name__ == "__main__":
     parser.add_argument('-o','--overwrite', action='store_true',
                     help='Will drop and restore a database if it already exists')
 
+    parser.add_argument('-m','--migrate', action='store_true',
+                    help='Apply pending migrations to an existing database instead of creating it')
+
     args = parser.parse_args()
     database_name = args.database_name
-    main(args.database_name,args.overwrite)
+    main(args.database_name,args.overwrite,args.migrate)
@@ -0,0 +1,8 @@
+-- Active learning score per image from its most recent predictions. Checkout walks the
+-- confidence index to serve the images the model is least (or most) sure about first.
+CREATE TABLE Image_Priority (
+    ImageId integer PRIMARY KEY REFERENCES Image_Info(ImageId),
+    TrainingId integer REFERENCES Training_Info(TrainingId),
+    ImageConfidence decimal(5,4) NOT NULL,
+    ModifiedDtim timestamp NOT NULL default current_timestamp
+);
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Ordered scan used by priority checkout
+CREATE INDEX Image_Priority_Confidence_Idx ON Image_Priority (ImageConfidence, ImageId);
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- One tagging state row per image. Also the index checkout claims and updates rows through
+ALTER TABLE Image_Tagging_State ADD CONSTRAINT Image_Tagging_State_PK PRIMARY KEY (ImageId);
\ No newline at end of file
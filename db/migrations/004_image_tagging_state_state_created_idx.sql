@@ -0,0 +1,2 @@
+-- Filtering by tag state, newest first
+CREATE INDEX Image_Tagging_State_State_Created_Idx ON Image_Tagging_State (TagStateId, CreatedDtim);
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Incremental label sync: labels created since a watermark
+CREATE INDEX Annotated_Labels_Created_Idx ON Annotated_Labels (CreatedDtim);
\ No newline at end of file
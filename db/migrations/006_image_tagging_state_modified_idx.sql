@@ -0,0 +1,2 @@
+-- Incremental image sync: tagging states changed since a watermark
+CREATE INDEX Image_Tagging_State_Modified_Idx ON Image_Tagging_State (ModifiedDtim);
\ No newline at end of file
@@ -0,0 +1,16 @@
+-- Progress of a storage container onboarding. Listing pages and queue batches update the counters as they finish.
+CREATE TABLE Onboarding_Job (
+    JobId SERIAL PRIMARY KEY,
+    StorageAccount text NOT NULL,
+    StorageContainer text NOT NULL,
+    Prefix text,
+    CreatedByUser integer REFERENCES User_Info(UserId),
+    PagesListed integer NOT NULL default 0,
+    BlobsListed integer NOT NULL default 0,
+    ImagesQueued integer NOT NULL default 0,
+    ImagesOnboarded integer NOT NULL default 0,
+    ImagesFailed integer NOT NULL default 0,
+    ListingComplete boolean NOT NULL default false,
+    ModifiedDtim timestamp NOT NULL default current_timestamp,
+    CreatedDtim timestamp NOT NULL default current_timestamp
+);
\ No newline at end of file
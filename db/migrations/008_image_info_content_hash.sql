@@ -0,0 +1,2 @@
+-- Base64 MD5 of the image content, used to skip images that are already onboarded
+ALTER TABLE Image_Info ADD COLUMN ContentHash text;
\ No newline at end of file
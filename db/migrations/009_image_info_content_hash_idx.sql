@@ -0,0 +1,2 @@
+-- At most one image per content. Images onboarded before hashing have no hash and are not deduplicated.
+CREATE UNIQUE INDEX Image_Info_ContentHash_Idx ON Image_Info (ContentHash) WHERE ContentHash IS NOT NULL;
\ No newline at end of file
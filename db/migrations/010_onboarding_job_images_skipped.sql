@@ -0,0 +1,2 @@
+-- Images of an onboarding job skipped because their content was already onboarded
+ALTER TABLE Onboarding_Job ADD COLUMN ImagesSkipped integer NOT NULL default 0;
\ No newline at end of file
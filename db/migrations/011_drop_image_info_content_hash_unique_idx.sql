@@ -0,0 +1,3 @@
+-- Content only counts as onboarded once its image is in permanent storage, which a unique index cannot express.
+-- Images whose copy failed or is pending keep their hash and the same content may be onboarded again.
+DROP INDEX Image_Info_ContentHash_Idx;
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Looks up onboarded images by content when skipping duplicates
+CREATE INDEX Image_Info_ContentHash_Idx ON Image_Info (ContentHash) WHERE ContentHash IS NOT NULL;
\ No newline at end of file
@@ -0,0 +1,7 @@
+-- Scores images from the predictions stored before Image_Priority existed, using the latest training like checkout
+-- used to. Images already scored by newer predictions keep their score.
+INSERT INTO Image_Priority (ImageId, TrainingId, ImageConfidence)
+SELECT ImageId, TrainingId, MIN(ImageConfidence) FROM Prediction_Labels
+WHERE TrainingId = (SELECT MAX(TrainingId) FROM Training_Info)
+GROUP BY ImageId, TrainingId
+ON CONFLICT (ImageId) DO NOTHING;
\ No newline at end of file
@@ -0,0 +1,3 @@
+-- Listing page markers of an onboarding job that have been queued and counted, so a retried page is counted once.
+-- The first page is recorded as an empty marker.
+ALTER TABLE Onboarding_Job ADD COLUMN ListedMarkers text[] NOT NULL default '{}';
\ No newline at end of file
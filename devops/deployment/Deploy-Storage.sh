@@ -46,4 +46,10 @@ az storage container create -n $STORAGE_PERM_CONTAINER --account-key $STORAGE_KE
 echo "Creating an onboarding queue"
 az storage queue create -n onboardqueue --account-key $STORAGE_KEY --account-name $STORAGE_NAME
 
+echo "Creating a queue for listing storage containers to onboard"
+az storage queue create -n onboardlistqueue --account-key $STORAGE_KEY --account-name $STORAGE_NAME
+
+echo "Creating a queue for copies still pending after onboarding"
+az storage queue create -n onboardcopyqueue --account-key $STORAGE_KEY --account-name $STORAGE_NAME
+
 echo "Done!"
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+#################################################################
+# Measures the cold start import time of each function in the
+# pipeline app with `python -X importtime`. Every run imports the
+# function module in a fresh interpreter, the way a new worker
+# does. azure.functions is imported first as the worker already
+# has it loaded, so it is not counted against the functions.
+#################################################################
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(REPO_ROOT, "functions", "pipeline")
+HOST_MODULE = "azure.functions"
+
+# import time:   self [us] | cumulative | imported package
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def get_function_names():
+    return sorted(name for name in os.listdir(PIPELINE_DIR)
+                  if os.path.isfile(os.path.join(PIPELINE_DIR, name, "function.json")))
+
+
+# Returns (cumulative import time of the function module in us, [(cumulative us, module)] for its direct imports).
+# The total includes the functions and functions.pipeline packages the module is imported through.
+def measure_import(function_name):
+    module = "functions.pipeline." + function_name
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import {0}; import {1}".format(HOST_MODULE, module)],
+                            cwd=REPO_ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            entries.append((int(match.group(2)), len(match.group(3)) // 2, match.group(4)))
+
+    # Children are reported before their parent, so the function's imports are the lines after the host module's
+    host_index = max(i for i, entry in enumerate(entries) if entry[2] == HOST_MODULE and entry[1] == 0)
+    function_entries = entries[host_index + 1:]
+    total = sum(cumulative for cumulative, depth, _ in function_entries if depth == 0)
+    children = [(cumulative, name) for cumulative, depth, name in function_entries if depth == 1]
+    return total, sorted(children, reverse=True)
+
+
+def main(function_names, runs, top):
+    for function_name in function_names:
+        measurements = [measure_import(function_name) for _ in range(runs)]
+        total, children = min(measurements, key=lambda measurement: measurement[0])
+        print("{0}: {1:.1f} ms".format(function_name, total / 1000))
+        for cumulative, name in children[:top]:
+            print("    {0:8.1f} ms  {1}".format(cumulative / 1000, name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--functions', nargs='+', default=None,
+                        help='Functions to measure, all functions in the pipeline app by default')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='Fresh interpreters per function, the fastest run is reported')
+    parser.add_argument('-t', '--top', type=int, default=5,
+                        help='Number of the slowest imports to list per function')
+    args = parser.parse_args()
+    main(args.functions or get_function_names(), args.runs, args.top)
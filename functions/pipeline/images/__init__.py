@@ -2,10 +2,14 @@ import logging
 
 import azure.functions as func
 import json
-import jsonpickle
+from ..shared.api_utils import encode, parse_timestamp
 from ..shared.db_provider import get_postgres_provider
-from ..shared.db_access import ImageTagDataAccess, ImageTagState
-from ..shared.storage_utils import get_signed_url_for_permstore_blob
+from ..shared.db_access import ImageTagDataAccess, ImageTagState, CheckoutStrategy, ImageLabel
+from ..shared.storage_utils import get_signed_urls_for_permstore_blobs
+
+# Checkout payload formats. The default nests a jsonpickle document of the image labels in the response,
+# compact returns them as columns, see ImageLabel.toColumns.
+CHECKOUT_FORMATS = ["default", "compact"]
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -16,6 +20,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     tag_status = req.params.get('tagStatus')
     image_ids = req.params.get('imageId')
     checkout = req.params.get('checkOut')
+    strategy = req.params.get('strategy')
+    modified_since = req.params.get('modifiedSince')
+    checkout_format = req.params.get('format')
 
     # setup response object
     headers = {
@@ -39,6 +46,24 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             headers=headers,
             body=json.dumps({"error": "image count needs to be specified when checking out images"})
         )
+    elif strategy and strategy not in [s.value for s in CheckoutStrategy]:
+        return func.HttpResponse(
+            status_code=400,
+            headers=headers,
+            body=json.dumps({"error": "strategy must be one of {0}".format([s.value for s in CheckoutStrategy])})
+        )
+    elif checkout_format and checkout_format not in CHECKOUT_FORMATS:
+        return func.HttpResponse(
+            status_code=400,
+            headers=headers,
+            body=json.dumps({"error": "format must be one of {0}".format(CHECKOUT_FORMATS)})
+        )
+    elif modified_since and not parse_timestamp(modified_since):
+        return func.HttpResponse(
+            status_code=400,
+            headers=headers,
+            body=json.dumps({"error": "modifiedSince must be an ISO 8601 timestamp"})
+        )
     else:
         try:
             # DB configuration
@@ -49,16 +74,21 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             # We ignore the rest of query params when checkOut is set to true.
             if checkout and checkout.lower() == "true":
                 image_count = int(image_count)
-                checked_out_images = data_access.checkout_images(image_count, user_id)
+                checkout_strategy = CheckoutStrategy(strategy) if strategy else CheckoutStrategy.LEAST_CONFIDENT
+                checked_out_images = data_access.checkout_images(image_count, user_id, checkout_strategy)
                 existing_classifications_list = data_access.get_existing_classifications()
                 # update image locations to signed urls 
-                for image in checked_out_images:
-                    signed_url_location = get_signed_url_for_permstore_blob(image.imagelocation)
+                signed_urls = get_signed_urls_for_permstore_blobs([image.imagelocation for image in checked_out_images])
+                for image, signed_url_location in zip(checked_out_images, signed_urls):
                     image.imagelocation = signed_url_location
-                return_body_json = {
-                    "images": jsonpickle.encode(checked_out_images, unpicklable=False),
-                    "classification_list": existing_classifications_list
-                }
+                if checkout_format == "compact":
+                    return_body_json = ImageLabel.toColumns(checked_out_images)
+                    return_body_json["classification_list"] = existing_classifications_list
+                else:
+                    return_body_json = {
+                        "images": encode(checked_out_images),
+                        "classification_list": existing_classifications_list
+                    }
                 return func.HttpResponse(
                     status_code=200,
                     headers=headers,
@@ -71,13 +101,15 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             elif tag_status:
                 if image_count:
                     image_count = int(image_count)
-                images_by_tag_status = data_access.get_images_by_tag_status(tag_status.split(','), image_count)
+                # With modifiedSince only images whose tag state changed since that watermark are returned
+                images_by_tag_status = data_access.get_images_by_tag_status(tag_status.split(','), image_count,
+                                                                            parse_timestamp(modified_since))
                 logging.debug("Received {0} images in tag status {1}".format(len(images_by_tag_status),tag_status))
                 image_infos = data_access.get_image_info_for_image_ids(list(images_by_tag_status.keys()))
 
             # For each image_info in image_infos, update image_info.location a signed url.
-            for image_info in image_infos:
-                signed_url_location = get_signed_url_for_permstore_blob(image_info['location'])
+            signed_urls = get_signed_urls_for_permstore_blobs([image_info['location'] for image_info in image_infos])
+            for image_info, signed_url_location in zip(image_infos, signed_urls):
                 image_info['location'] = signed_url_location
 
             content = json.dumps(image_infos)
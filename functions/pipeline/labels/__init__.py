@@ -1,14 +1,21 @@
 import logging
-import jsonpickle
+import io
 from collections import namedtuple
 import azure.functions as func
 import json
+from ..shared.api_utils import encode, parse_timestamp
 from ..shared.db_provider import get_postgres_provider
 from ..shared.db_access import ImageTagDataAccess, ImageTagState, PredictionLabel, ImageTag
 
 DEFAULT_RETURN_HEADER= { "content-type": "application/json" }
+NDJSON_RETURN_HEADER= { "content-type": "application/x-ndjson" }
+MAX_LABEL_PAGE_SIZE = 1000
 
-# GET returns all human annotated labels
+# GET returns all human annotated labels, one JSON document per image with format=ndjson. Either way the whole
+# body is built in memory, so large exports should page with pageSize instead.
+# GET calls with pageSize (and optionally after/before image ids) return one keyset page of labels
+# GET calls with pageSize and modifiedSince only page images whose labels changed after that watermark,
+# images left without labels come back with an empty labels list
 # POST calls with upload=true flag save all human annotated labels
 # POST calls with trainingId param save predicted labels 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -17,6 +24,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     user_name = req.params.get('userName')
     training_id = req.params.get("trainingId")
     upload = req.params.get("upload")
+    response_format = req.params.get("format")
+    page_size = req.params.get("pageSize")
+    after = req.params.get("after")
+    before = req.params.get("before")
+    modified_since = req.params.get("modifiedSince")
     
     if not user_name:
         return func.HttpResponse(
@@ -24,6 +36,24 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             headers=DEFAULT_RETURN_HEADER,
             body=json.dumps({"error": "invalid userName given or omitted"})
         )
+    elif req.method == "GET" and page_size and not __is_positive_int(page_size, MAX_LABEL_PAGE_SIZE):
+        return func.HttpResponse(
+            status_code=400,
+            headers=DEFAULT_RETURN_HEADER,
+            body=json.dumps({"error": "pageSize must be an integer between 1 and {0}".format(MAX_LABEL_PAGE_SIZE)})
+        )
+    elif req.method == "GET" and not all(__is_int(id) for id in (after, before) if id):
+        return func.HttpResponse(
+            status_code=400,
+            headers=DEFAULT_RETURN_HEADER,
+            body=json.dumps({"error": "after and before must be image ids"})
+        )
+    elif req.method == "GET" and modified_since and (not page_size or not parse_timestamp(modified_since)):
+        return func.HttpResponse(
+            status_code=400,
+            headers=DEFAULT_RETURN_HEADER,
+            body=json.dumps({"error": "modifiedSince must be a watermark returned by a previous page and requires pageSize"})
+        )
     elif req.method == "POST" and not upload and not training_id:
         return func.HttpResponse(
             status_code=401,
@@ -38,13 +68,36 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
             logging.debug("User '{0}' invoked labels api".format(user_name))
 
-            if req.method == "GET":
+            if req.method == "GET" and page_size:
+                page_size = int(page_size)
+                # Taken before reading so changes made while the page is read are picked up by the next sync
+                watermark = data_access.get_sync_watermark()
+                labels = data_access.get_labels_page(page_size, after, before, parse_timestamp(modified_since))
+                # A short page means the range is exhausted
+                next_after = labels[-1].image_id if len(labels) == page_size else None
+                content = json.dumps({
+                    "labels": json.loads(encode(labels)),
+                    "nextAfter": next_after,
+                    "watermark": watermark.isoformat()
+                })
+                return func.HttpResponse(
+                    status_code=200,
+                    headers=DEFAULT_RETURN_HEADER,
+                    body=content
+                )
+            elif req.method == "GET" and response_format == "ndjson":
+                return func.HttpResponse(
+                    status_code=200,
+                    headers=NDJSON_RETURN_HEADER,
+                    body=__encode_ndjson(data_access.iter_labels())
+                )
+            elif req.method == "GET":
                 # Note: Currently we return all human annotated labels since TAGGING.CSV requires all rows
                 # No use case to return predicted labels at the moment.
                 labels = data_access.get_labels()
 
                 #Encode the complex object nesting
-                content = jsonpickle.encode(labels,unpicklable=False)
+                content = encode(labels)
                 return func.HttpResponse(
                     status_code=200,
                     headers=DEFAULT_RETURN_HEADER,
@@ -60,7 +113,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                         headers=DEFAULT_RETURN_HEADER,
                         body=json.dumps({"Error": "Unable to decode POST body."})
                     )
-                __upload_tag_data(upload_data, data_access, user_id)
+                # All label and state changes for the upload are written in a single transaction
+                with data_access.unit_of_work():
+                    __upload_tag_data(upload_data, data_access, user_id)
 
                 return func.HttpResponse(
                     body=json.dumps(upload_data),
@@ -97,20 +152,27 @@ def __upload_tag_data(upload_data, data_access, user_id):
         if ids_to_tags[image_id]:
             all_imagetags.extend(__create_ImageTag_list(image_id, ids_to_tags[image_id]))
 
+    # Tags on images that were not visited are saved with the images, which stay incomplete
+    incomplete_ids = set(int(image_id) for image_id in upload_data["imagesNotVisited"])
+    completed_labels = []
+    incomplete_labels = []
     unique_class_names = upload_data["uniqueClassNames"]
     if all_imagetags and unique_class_names:
-        logging.info("Update all visited images with tags and set state to completed")        
         class_map = data_access.get_classification_map(unique_class_names,user_id)
-        annotated_labels = data_access.convert_to_annotated_label(all_imagetags,class_map)
-        data_access.update_tagged_images_v2(annotated_labels,user_id)
+        for label in data_access.convert_to_annotated_label(all_imagetags,class_map):
+            (incomplete_labels if int(label.image_id) in incomplete_ids else completed_labels).append(label)
     else:
         logging.info("No tagged image ids or classifications received")
 
+    if completed_labels:
+        logging.info("Update all visited images with tags and set state to completed")
+        data_access.update_tagged_images_v2(completed_labels,user_id)
+
     logging.info("Update visited but no tags identified images")
     data_access.update_completed_untagged_images(upload_data["imagesVisitedNoTag"], user_id)
 
     logging.info("Update unvisited/incomplete images")
-    data_access.update_incomplete_images(upload_data["imagesNotVisited"], user_id)
+    data_access.update_incomplete_images(upload_data["imagesNotVisited"], user_id, incomplete_labels)
 
 # Create list of ImageTag objects to write to db for given image_id
 def __create_ImageTag_list(image_id, tags_list):
@@ -118,4 +180,24 @@ def __create_ImageTag_list(image_id, tags_list):
     for tag in tags_list:
         image_tags.append(ImageTag(image_id, tag['x1'], tag['x2'], tag['y1'], tag['y2'], tag['classes']))
 
-    return image_tags
\ No newline at end of file
+    return image_tags
+
+# Encodes each label as its own line while reading them from the database. This is not streamed: the Python
+# Functions host only takes a complete body, so the encoded text of every label is held until the response is
+# sent. Only the label objects are never all held at once. Keyset pages are what keep memory bounded.
+def __encode_ndjson(labels):
+    lines = io.StringIO()
+    for label in labels:
+        lines.write(encode(label))
+        lines.write("\n")
+    return lines.getvalue()
+
+def __is_int(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+def __is_positive_int(value, maximum):
+    return __is_int(value) and 0 < int(value) <= maximum
\ No newline at end of file
@@ -2,23 +2,28 @@ import os
 import logging
 import json
 import azure.functions as func
-from urlpath import URL
 from datetime import datetime, timedelta
-from ..shared.constants import ImageFileType
-from ..shared.storage_utils import get_filepath_from_url
-
-from azure.storage.blob import BlockBlobService, BlobPermissions
-from azure.storage.queue import QueueService, QueueMessageFormat
+from ..shared.db_provider import get_postgres_provider
+from ..shared.db_access import ImageTagDataAccess
+from ..shared.onboarding import ONBOARD_LIST_QUEUE_NAME
 
 DEFAULT_RETURN_HEADER = {
     "content-type": "application/json"
 }
 
+# The source container is read through a container SAS rather than the account key, so the key never leaves
+# this request. It has to outlast listing and working through the onboarding queue for large containers.
+SOURCE_SAS_EXPIRY = timedelta(hours=24)
+
 
+# POST starts onboarding the supported images of a storage container, optionally only blobs under a prefix.
+# Listing happens in the background a page at a time, so the request returns 202 straight away with a job id.
+# GET with jobId returns the progress of that job.
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     user_name = req.params.get('userName')
+    job_id = req.params.get('jobId')
 
     if not user_name:
         return func.HttpResponse(
@@ -27,13 +32,16 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             body=json.dumps({"error": "invalid userName given or omitted"})
         )
 
+    if req.method == "GET":
+        return __get_job_progress(job_id)
+
     try:
         req_body = req.get_json()
-        logging.debug(req.get_json())
         storage_account = req_body["storageAccount"]
         storage_account_key = req_body["storageAccountKey"]
         storage_container = req_body["storageContainer"]
-    except ValueError:
+        prefix = req_body.get("prefix") or None
+    except (ValueError, KeyError):
         return func.HttpResponse(
             "ERROR: Unable to decode POST body",
             status_code=400
@@ -45,67 +53,86 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             status_code=401
         )
 
-    # Create blob service for storage account (retrieval source)
-    blob_service = BlockBlobService(
-        account_name=storage_account,
-        account_key=storage_account_key)
+    try:
+        # The storage SDK is slow to import and progress requests don't need it
+        from azure.storage.blob import BlockBlobService, ContainerPermissions
+
+        # Create blob service for storage account (retrieval source)
+        blob_service = BlockBlobService(
+            account_name=storage_account,
+            account_key=storage_account_key)
+
+        sas_token = blob_service.generate_container_shared_access_signature(
+            storage_container,
+            ContainerPermissions(read=True, list=True),
+            datetime.utcnow() + SOURCE_SAS_EXPIRY
+        )
 
-    # Queue service for perm storage and queue
-    queue_service = QueueService(
-        account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
-        account_key=os.getenv('STORAGE_ACCOUNT_KEY')
-    )
+        data_access = ImageTagDataAccess(get_postgres_provider())
+        user_id = data_access.create_user(user_name)
+        job_id = data_access.create_onboarding_job(user_id, storage_account, storage_container, prefix)
+
+        # First page of the listing. Each page queues the next one, see onboardlistprocessor.
+        list_work = {
+            "jobId": job_id,
+            "userName": user_name,
+            "storageAccount": storage_account,
+            "storageContainer": storage_container,
+            "sasToken": sas_token,
+            "prefix": prefix,
+            "marker": None
+        }
+        __get_queue_service().put_message(ONBOARD_LIST_QUEUE_NAME, json.dumps(list_work))
 
-    queue_service.encode_function = QueueMessageFormat.text_base64encode
+        return func.HttpResponse(
+            status_code=202,
+            headers=DEFAULT_RETURN_HEADER,
+            body=json.dumps({
+                "jobId": job_id,
+                "statusQuery": {"userName": user_name, "jobId": job_id}
+            })
+        )
+    except Exception as e:
+        logging.error("ERROR: Could not start onboarding. Exception: " + str(e))
+        return func.HttpResponse("ERROR: Could not start onboarding storage_container={0}. Exception={1}".format(
+            storage_container, e), status_code=500)
 
-    try:
-        blob_list = []
-
-        for blob_object in blob_service.list_blobs(storage_container):
-            blob_url = URL(
-                blob_service.make_blob_url(
-                    storage_container,
-                    blob_object.name
-                )
-            )
-            # Check for supported image types here.
-            if ImageFileType.is_supported_filetype(blob_url.suffix):
-                logging.debug("INFO: Building sas token for blob " + blob_object.name)
-                # create sas signature
-                sas_signature = blob_service.generate_blob_shared_access_signature(
-                    storage_container,
-                    blob_object.name,
-                    BlobPermissions.READ,
-                    datetime.utcnow() + timedelta(hours=1)
-                )
-
-                logging.debug("INFO: have sas signature {}".format(sas_signature))
-
-                signed_url = blob_url.with_query(sas_signature)
-
-                blob_list.append(signed_url.as_uri())
-
-                logging.debug("INFO: Built signed url: {}".format(signed_url))
-
-                msg_body = {
-                    "imageUrl": signed_url.as_uri(),
-                    "fileName": str(blob_url.name),
-                    "fileExtension": str(blob_url.suffix),
-                    "directoryComponents": get_filepath_from_url(blob_url, storage_container),
-                    "userName": user_name
-                }
-
-                body_str = json.dumps(msg_body)
-                queue_service.put_message("onboardqueue", body_str)
-            else:
-                logging.info("Blob object not supported. Object URL={}".format(blob_url.as_uri))
 
+def __get_job_progress(job_id):
+    if not job_id or not job_id.isdigit():
         return func.HttpResponse(
-            status_code=202,
+            status_code=400,
             headers=DEFAULT_RETURN_HEADER,
-            body=json.dumps(blob_list)
+            body=json.dumps({"error": "jobId must be given to get onboarding progress"})
         )
+    try:
+        job = ImageTagDataAccess(get_postgres_provider()).get_onboarding_job(int(job_id))
     except Exception as e:
-        logging.error("ERROR: Could not build blob object list. Exception: " + str(e))
-        return func.HttpResponse("ERROR: Could not get list of blobs in storage_container={0}. Exception={1}".format(
-            storage_container, e), status_code=500)
\ No newline at end of file
+        return func.HttpResponse("exception:" + str(e), status_code=500)
+    if not job:
+        return func.HttpResponse(
+            status_code=404,
+            headers=DEFAULT_RETURN_HEADER,
+            body=json.dumps({"error": "no onboarding job {0}".format(job_id)})
+        )
+    return func.HttpResponse(
+        status_code=200,
+        headers=DEFAULT_RETURN_HEADER,
+        body=json.dumps(job)
+    )
+
+
+# Queue client for perm storage is module level so warm invocations reuse it
+_queue_service = None
+
+
+def __get_queue_service():
+    global _queue_service
+    if _queue_service is None:
+        from azure.storage.queue import QueueService, QueueMessageFormat
+        _queue_service = QueueService(
+            account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+            account_key=os.getenv('STORAGE_ACCOUNT_KEY')
+        )
+        _queue_service.encode_function = QueueMessageFormat.text_base64encode
+    return _queue_service
\ No newline at end of file
@@ -0,0 +1,83 @@
+import os
+import json
+import logging
+import azure.functions as func
+
+from ..shared.db_provider import get_postgres_provider
+from ..shared.db_access import ImageTagDataAccess
+from ..shared.onboarding import (
+    delete_images_from_temp_storage,
+    queue_pending_copies,
+    COPY_FOLLOW_UP_MAX_ATTEMPTS
+)
+
+
+# Finishes onboarding images whose copy to permanent storage was still pending when the onboarding function
+# returned. Finished copies get their permanent URL and move to READY_TO_TAG, failed ones are started again and
+# copies still pending are queued to be checked again later.
+def main(msg: func.QueueMessage) -> None:
+    copy_work = json.loads(msg.get_body().decode('utf-8'))
+    user_id = copy_work["userId"]
+    attempt = copy_work["attempt"]
+    copy_source = os.getenv('SOURCE_CONTAINER_NAME')
+    copy_destination = os.getenv('DESTINATION_CONTAINER_NAME')
+    blob_service = __get_blob_service()
+
+    succeeded = []
+    pending = []
+    for copy in copy_work["copies"]:
+        blob_name = copy["destinationUrl"].split("/")[-1]
+        status = blob_service.get_blob_properties(copy_destination, blob_name).properties.copy.status
+        if status == "success":
+            succeeded.append(copy)
+            continue
+        if status != "pending":
+            logging.warning("Copy of {0} ended with status {1}, starting it again".format(copy["sourceUrl"], status))
+            blob_service.copy_blob(copy_destination, blob_name, copy["sourceUrl"])
+        pending.append(copy)
+
+    # Succeeded copies are saved before the rest are queued again, so a retry of this message never queues
+    # a second follow-up for the same copies
+    if succeeded:
+        ImageTagDataAccess(get_postgres_provider()).update_image_urls(
+            {copy["imageId"]: copy["destinationUrl"] for copy in succeeded}, user_id)
+        _, delete_error_dict = delete_images_from_temp_storage(
+            {copy["sourceUrl"]: copy["destinationUrl"] for copy in succeeded}, copy_source, blob_service)
+        if delete_error_dict:
+            logging.warning("Could not delete {0} images from temp storage".format(len(delete_error_dict)))
+    logging.info("{0} pending copies finished".format(len(succeeded)))
+
+    if not pending:
+        return
+    if attempt + 1 >= COPY_FOLLOW_UP_MAX_ATTEMPTS:
+        # The images stay NOT_READY with their temporary URL and blob, like images whose copy failed
+        logging.error("Giving up on {0} copies still pending after {1} checks: {2}".format(
+            len(pending), attempt + 1, [copy["sourceUrl"] for copy in pending]))
+        return
+    queue_pending_copies(__get_queue_service(), user_id, pending, attempt + 1)
+
+
+# Storage clients are module level so warm invocations reuse them. The storage SDK is slow to import, so it is
+# imported when a client is first created rather than on load.
+_blob_service = None
+_queue_service = None
+
+
+def __get_blob_service():
+    global _blob_service
+    if _blob_service is None:
+        from azure.storage.blob import BlockBlobService
+        _blob_service = BlockBlobService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+                                         account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
+    return _blob_service
+
+
+def __get_queue_service():
+    global _queue_service
+    if _queue_service is None:
+        from azure.storage.queue import QueueService, QueueMessageFormat
+        _queue_service = QueueService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+                                      account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
+        # The queue trigger expects base64 encoded messages
+        _queue_service.encode_function = QueueMessageFormat.text_base64encode
+    return _queue_service
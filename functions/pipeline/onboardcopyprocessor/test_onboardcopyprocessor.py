@@ -0,0 +1,60 @@
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from . import main
+from ..shared.onboarding import ONBOARD_COPY_QUEUE_NAME, COPY_FOLLOW_UP_MAX_ATTEMPTS
+
+
+def queue_message(body):
+    msg = Mock()
+    msg.get_body.return_value = json.dumps(body).encode('utf-8')
+    return msg
+
+
+def copy(image_id):
+    return {"imageId": image_id, "sourceUrl": "https://temp/{0}.jpg".format(image_id),
+            "destinationUrl": "https://perm/{0}.jpg".format(image_id)}
+
+
+def blob_properties(status):
+    blob = Mock()
+    blob.properties.copy.status = status
+    return blob
+
+
+@patch(__package__ + ".get_postgres_provider")
+@patch(__package__ + ".ImageTagDataAccess")
+@patch(__package__ + ".delete_images_from_temp_storage", return_value=({}, {}))
+@patch(__package__ + "._queue_service")
+@patch(__package__ + "._blob_service")
+class TestOnboardCopyProcessor(unittest.TestCase):
+    def test_finished_copies_are_made_ready(self, mock_blob_service, mock_queue_service, mock_delete,
+                                            mock_data_access, mock_provider):
+        mock_blob_service.get_blob_properties.side_effect = [blob_properties("success"), blob_properties("pending")]
+        main(queue_message({"userId": 3, "attempt": 0, "copies": [copy(1), copy(2)]}))
+
+        mock_data_access.return_value.update_image_urls.assert_called_once_with({1: "https://perm/1.jpg"}, 3)
+        self.assertEqual({"https://temp/1.jpg": "https://perm/1.jpg"}, mock_delete.call_args[0][0])
+        queue_name, body = mock_queue_service.put_message.call_args[0]
+        self.assertEqual(ONBOARD_COPY_QUEUE_NAME, queue_name)
+        self.assertEqual({"userId": 3, "attempt": 1, "copies": [copy(2)]}, json.loads(body))
+
+    def test_failed_copies_are_started_again(self, mock_blob_service, mock_queue_service, mock_delete,
+                                             mock_data_access, mock_provider):
+        mock_blob_service.get_blob_properties.return_value = blob_properties("failed")
+        main(queue_message({"userId": 3, "attempt": 0, "copies": [copy(1)]}))
+
+        mock_blob_service.copy_blob.assert_called_once_with(None, "1.jpg", "https://temp/1.jpg")
+        mock_data_access.return_value.update_image_urls.assert_not_called()
+        self.assertEqual(1, mock_queue_service.put_message.call_count)
+
+    def test_gives_up_after_max_attempts(self, mock_blob_service, mock_queue_service, mock_delete,
+                                         mock_data_access, mock_provider):
+        mock_blob_service.get_blob_properties.return_value = blob_properties("pending")
+        main(queue_message({"userId": 3, "attempt": COPY_FOLLOW_UP_MAX_ATTEMPTS - 1, "copies": [copy(1)]}))
+        mock_queue_service.put_message.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,10 @@ import os
 import logging
 import json
 import azure.functions as func
-from urllib.request import urlopen
-from PIL import Image
 from ..shared.db_provider import get_postgres_provider
 from ..shared.db_access import ImageTagDataAccess, ImageInfo
-from ..shared.onboarding import copy_images_to_permanent_storage, delete_images_from_temp_storage
-from azure.storage.blob import BlockBlobService
+from ..shared.onboarding import copy_images_to_permanent_storage, delete_images_from_temp_storage, queue_pending_copies
+from ..shared.image_utils import probe_image
 
 DEFAULT_RETURN_HEADER= { "content-type": "application/json" }
 
@@ -53,14 +51,14 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Check to ensure image URLs sent by client are all unique.
     url_list = set(raw_url_list)
 
-    try:
-        image_object_list = build_objects_from_url_list(url_list)
-    except Exception as e:
-        logging.error("Error: Could not build image object list. Exception: " + str(e))
+    # Images that can't be read are reported on their own, the rest of the batch is still onboarded
+    image_object_list, probe_error_dict = build_objects_from_url_list(url_list)
+    if not image_object_list:
+        logging.error("Error: Could not build image object list.")
         return func.HttpResponse(
             status_code=400,
             headers=DEFAULT_RETURN_HEADER,
-            body=json.dumps({"Error": "Could not build image object list. Exception: " + str(e)})
+            body=json.dumps({"Error": "Could not build image object list.", "probe_failed": probe_error_dict})
         )
 
     try:
@@ -73,20 +71,33 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             body=json.dumps({"Error": "Database connection failed. Exception: " + str(e)})
         )
 
-    # Create/look up username in database and retrieve user_id number
-    user_id= data_access.create_user(user_name)
-    logging.info("User ID for {0} is {1}".format(user_name, user_id))
-
-    # Add the images to the database and retrieve their image ID's
-    logging.info("Add new images to the database, and retrieve a dictionary ImageId's mapped to ImageUrl's")
-    image_id_url_map = data_access.add_new_images(image_object_list,user_id)
-
-    # Create blob service for storage account
+    # Create blob service for storage account. The storage SDK is slow to import, so requests that are turned
+    # away before this point never import it.
+    from azure.storage.blob import BlockBlobService
     blob_service = BlockBlobService(account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
 
-    # Copy images from temporary to permanent storage.  Receive back a list of the copy operations that succeeded and failed.
-    # Note: Format for copy_succeeded_dict and copy_error_dict is { sourceURL : destinationURL }
-    copy_succeeded_dict, copy_error_dict = copy_images_to_permanent_storage(image_id_url_map, COPY_SOURCE, COPY_DESTINATION, blob_service)
+    # User lookup and image registration share one connection and are committed together, before any copy
+    # starts, so no transaction is held open while the copies are polled
+    with data_access.unit_of_work():
+        # Create/look up username in database and retrieve user_id number
+        user_id= data_access.create_user(user_name)
+        logging.info("User ID for {0} is {1}".format(user_name, user_id))
+
+        # Add the images to the database and retrieve their image ID's
+        logging.info("Add new images to the database, and retrieve a dictionary ImageId's mapped to ImageUrl's")
+        image_id_url_map = data_access.add_new_images(image_object_list,user_id)
+    # Images whose content is already onboarded are not registered again
+    duplicate_urls = [image.image_location for image in image_object_list if image.image_location not in image_id_url_map]
+    if duplicate_urls:
+        logging.info("Skipping {0} images already onboarded".format(len(duplicate_urls)))
+
+    # Copy images from temporary to permanent storage.  Receive back the copy operations that succeeded, failed and are still pending.
+    # Note: Format for copy_succeeded_dict, copy_error_dict and copy_pending_dict is { sourceURL : destinationURL }
+    copy_result = copy_images_to_permanent_storage(image_id_url_map, COPY_SOURCE, COPY_DESTINATION, blob_service)
+    copy_succeeded_dict = copy_result.succeeded
+    copy_error_dict = copy_result.failed
+    # Slow copies keep their temporary URL and blob until onboardcopyprocessor sees them finish
+    copy_pending_dict = copy_result.pending
 
     # Update URLs in DB for images that were successfully copied
     logging.info("Now updating URLs in the DB for images that were successfully copied...")
@@ -97,46 +108,100 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         filename = str(destination_url).split('/')[-1]
         image_id_to_update = int(filename.split('.')[0])
         update_urls_dictionary[image_id_to_update] = str(destination_url)
+    # A second, short transaction
     data_access.update_image_urls(update_urls_dictionary, user_id)
     logging.info("Done.")
 
+    # Pending copies are checked again in the background, and moved to their permanent URL and READY_TO_TAG once
+    # they finish. If they can't be queued nothing would finish them, so they are reported as failed instead.
+    if copy_pending_dict:
+        pending_copies = [{"imageId": image_id_url_map[url], "sourceUrl": url, "destinationUrl": str(destination_url)}
+                          for url, destination_url in copy_pending_dict.items()]
+        try:
+            queue_pending_copies(__get_queue_service(), user_id, pending_copies)
+        except Exception as e:
+            logging.error("Error: Could not queue pending copies. Exception: " + str(e))
+            copy_error_dict.update(copy_pending_dict)
+            copy_pending_dict = {}
+
     # Delete images from temporary storage.  Receive back a list of the delete operations that succeeded and failed.
     # Note: Format for delete_succeeded_dict and delete_error_dict is { sourceURL : destinationURL }
     logging.info("Now deleting images from temp storage...")
-    delete_succeeded_dict, delete_error_dict = delete_images_from_temp_storage(copy_succeeded_dict, COPY_SOURCE, blob_service)
+    # Duplicates were never copied. add_new_images only skips content whose image is already in permanent
+    # storage, so their temporary copies aren't needed.
+    delete_images_dict = dict(copy_succeeded_dict)
+    delete_images_dict.update((url, None) for url in duplicate_urls)
+    delete_succeeded_dict, delete_error_dict = delete_images_from_temp_storage(delete_images_dict, COPY_SOURCE, blob_service)
     logging.info("Done.")
 
-    # If both error_dicts are empty, return a 200 OK status code.
-    # If copy_error_dict or delete_error_dict contains any items, build a JSON object for HTTP response
+    # Every response lists the images that are done: copied, skipped as duplicates, or still copying in the
+    # background. A client onboarding in batches records these, so it only sends the others again.
+    image_results = {
+        "onboarded": list(copy_succeeded_dict.keys()),
+        "duplicates": duplicate_urls,
+        "copy_pending": dict(copy_pending_dict)
+    }
+
+    # If all error_dicts are empty and no copy is pending, return a 200 OK status code.
+    # If only copies are pending, return 202 Accepted listing them. They are finished by onboardcopyprocessor and needn't be onboarded again.
+    # If copy_error_dict, delete_error_dict or probe_error_dict contains any items, build a JSON object for HTTP response
     # and return a bad status code indicating that one or more images failed.
-    if not copy_error_dict and not delete_error_dict:
-        content = json.dumps({"Success": "Transfer of all images complete."})
+    if not copy_error_dict and not delete_error_dict and not probe_error_dict and not copy_pending_dict:
+        content = json.dumps(dict(image_results, Success="Transfer of all images complete."))
         return func.HttpResponse(
             status_code=200,
             headers=DEFAULT_RETURN_HEADER,
             body=content
         )
+    elif not copy_error_dict and not delete_error_dict and not probe_error_dict:
+        content = json.dumps(image_results)
+        return func.HttpResponse(
+            status_code=202,
+            headers=DEFAULT_RETURN_HEADER,
+            body=content
+        )
     else:
-        content = json.dumps({
-            "copy_failed":dict(copy_error_dict),
-            "delete_failed":dict(delete_error_dict)
-            })
+        content = json.dumps(dict(
+            image_results,
+            copy_failed=dict(copy_error_dict),
+            delete_failed=dict(delete_error_dict),
+            probe_failed=probe_error_dict
+            ))
         return func.HttpResponse(
             status_code=500,
             headers=DEFAULT_RETURN_HEADER,
             body=content
         )
 
-# Given a list of image URL's, build an ImageInfo object for each, and return a list of these image objects.
+# Queue client is module level so warm invocations reuse it. Only needed when copies are still pending.
+_queue_service = None
+
+def __get_queue_service():
+    global _queue_service
+    if _queue_service is None:
+        from azure.storage.queue import QueueService, QueueMessageFormat
+        _queue_service = QueueService(account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY)
+        # The queue trigger expects base64 encoded messages
+        _queue_service.encode_function = QueueMessageFormat.text_base64encode
+    return _queue_service
+
+# Given a list of image URL's, build an ImageInfo object for each. Returns a list of these image objects and
+# a dictionary { imageURL : error } of the images that could not be read.
 def build_objects_from_url_list(url_list):
     image_object_list = []
+    probe_error_dict = {}
     for url in url_list:
         # Split original image name from URL
         original_filename = url.split("/")[-1]
-        # Create ImageInfo object (def in db_access.py)
-        with Image.open(urlopen(url)) as img:
-            width, height = img.size
-        image = ImageInfo(original_filename, url, height, width)
+        # Create ImageInfo object (def in db_access.py). Only the image header is downloaded to read its size,
+        # the content hash comes with it from blob storage.
+        try:
+            width, height, content_hash = probe_image(url)
+        except Exception as e:
+            logging.error("Error: Could not read image {0}. Exception: {1}".format(url, e))
+            probe_error_dict[url] = str(e)
+            continue
+        image = ImageInfo(original_filename, url, height, width, content_hash)
         # Append image object to the list
         image_object_list.append(image)
-    return image_object_list
+    return image_object_list, probe_error_dict
@@ -0,0 +1,106 @@
+import os
+import json
+import logging
+import azure.functions as func
+from concurrent.futures import ThreadPoolExecutor
+
+from ..shared.constants import ImageFileType
+from ..shared.db_provider import get_postgres_provider
+from ..shared.db_access import ImageTagDataAccess
+from ..shared.storage_utils import get_filepath_from_url
+from ..shared.onboarding import (
+    build_onboarding_messages,
+    ONBOARD_QUEUE_NAME,
+    ONBOARD_LIST_QUEUE_NAME,
+    ONBOARD_LIST_PAGE_SIZE
+)
+
+# Onboarding messages of a page are put on the queue concurrently
+QUEUE_PUT_WORKERS = 8
+
+
+# Lists one page of blobs of the source container for an onboarding job and queues its images. The next page
+# is queued last, once this page's images are queued and counted, so listing a large container is spread across
+# invocations and a retried page only repeats its own work rather than starting a second listing. The job
+# records the pages it has counted, so a page retried after that only queues the next page again.
+def main(msg: func.QueueMessage) -> None:
+    list_work = json.loads(msg.get_body().decode('utf-8'))
+    job_id = list_work["jobId"]
+    storage_container = list_work["storageContainer"]
+    sas_token = list_work["sasToken"]
+    # The first page has no marker
+    page_marker = list_work.get("marker") or ""
+    logging.info("Listing page of onboarding job {0}, container={1}, prefix={2}, marker={3}".format(
+        job_id, storage_container, list_work.get("prefix"), list_work.get("marker")))
+
+    # The storage SDK is slow to import, so it is imported on first use rather than on load
+    from azure.storage.blob import BlockBlobService
+    blob_service = BlockBlobService(account_name=list_work["storageAccount"], sas_token=sas_token)
+    page = blob_service.list_blobs(storage_container, prefix=list_work.get("prefix"),
+                                   num_results=ONBOARD_LIST_PAGE_SIZE, marker=list_work.get("marker"))
+    blob_objects = list(page)
+
+    queue_service = __get_queue_service()
+    data_access = ImageTagDataAccess(get_postgres_provider())
+    if data_access.is_onboarding_page_listed(job_id, page_marker):
+        logging.info("Page {0} of onboarding job {1} was already queued".format(page_marker, job_id))
+    else:
+        images = __get_images(blob_service, storage_container, sas_token, blob_objects)
+        messages = list(build_onboarding_messages(list_work["userName"], images, job_id=job_id))
+        with ThreadPoolExecutor(max_workers=QUEUE_PUT_WORKERS) as executor:
+            # list() surfaces the first failed put, so the page is retried
+            list(executor.map(lambda body_str: queue_service.put_message(ONBOARD_QUEUE_NAME, body_str), messages))
+
+        # Not counted again if a copy of this message counted the page while it was being queued
+        data_access.update_onboarding_job(
+            job_id,
+            pages_listed=1,
+            blobs_listed=len(blob_objects),
+            images_queued=len(images),
+            listing_complete=not page.next_marker,
+            page_marker=page_marker
+        )
+        logging.info("Queued {0} of {1} blobs in {2} messages for onboarding job {3}".format(
+            len(images), len(blob_objects), len(messages), job_id))
+
+    if page.next_marker:
+        queue_service.put_message(ONBOARD_LIST_QUEUE_NAME, json.dumps(dict(list_work, marker=page.next_marker)))
+
+
+# Returns the onboarding message entries for the supported images among blob_objects
+def __get_images(blob_service, storage_container, sas_token, blob_objects):
+    # urlpath is slow to import, like the storage SDK
+    from urlpath import URL
+    images = []
+    for blob_object in blob_objects:
+        blob_name = blob_object.name
+        blob_url = URL(blob_service.make_blob_url(storage_container, blob_name))
+        # Check for supported image types here.
+        if ImageFileType.is_supported_filetype(blob_url.suffix):
+            images.append({
+                "imageUrl": blob_service.make_blob_url(storage_container, blob_name, sas_token=sas_token),
+                "fileName": str(blob_url.name),
+                "fileExtension": str(blob_url.suffix),
+                "directoryComponents": get_filepath_from_url(blob_url, storage_container),
+                # Listing returns the MD5 of blobs that have one, so onboarding can skip known content
+                "contentMd5": blob_object.properties.content_settings.content_md5
+            })
+        else:
+            logging.info("Blob object not supported. Object URL={}".format(blob_url.as_uri()))
+    return images
+
+
+# Queue client for perm storage is module level so warm invocations reuse it
+_queue_service = None
+
+
+def __get_queue_service():
+    global _queue_service
+    if _queue_service is None:
+        from azure.storage.queue import QueueService, QueueMessageFormat
+        _queue_service = QueueService(
+            account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+            account_key=os.getenv('STORAGE_ACCOUNT_KEY')
+        )
+        _queue_service.encode_function = QueueMessageFormat.text_base64encode
+    return _queue_service
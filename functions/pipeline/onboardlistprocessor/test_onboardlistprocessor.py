@@ -0,0 +1,95 @@
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from . import main
+from ..shared.onboarding import ONBOARD_QUEUE_NAME, ONBOARD_LIST_QUEUE_NAME, ONBOARD_LIST_PAGE_SIZE
+
+
+def queue_message(body):
+    msg = Mock()
+    msg.get_body.return_value = json.dumps(body).encode('utf-8')
+    return msg
+
+
+def blob(name):
+    blob_object = Mock()
+    blob_object.name = name
+    blob_object.properties.content_settings.content_md5 = "md5-" + name
+    return blob_object
+
+
+class Page(list):
+    def __init__(self, blobs, next_marker):
+        super().__init__(blobs)
+        self.next_marker = next_marker
+
+
+def make_blob_url(container, blob_name, sas_token=None):
+    url = "https://account.blob.core.windows.net/{0}/{1}".format(container, blob_name)
+    return url + "?" + sas_token if sas_token else url
+
+
+LIST_WORK = {"jobId": 4, "userName": "me", "storageAccount": "account", "storageContainer": "images",
+             "sasToken": "sig", "prefix": None, "marker": None}
+
+
+@patch(__package__ + ".get_postgres_provider")
+@patch(__package__ + ".ImageTagDataAccess")
+@patch(__package__ + "._queue_service")
+@patch("azure.storage.blob.BlockBlobService")
+class TestOnboardListProcessor(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+
+    def set_up_page(self, mock_blob_service, mock_queue_service, mock_data_access, next_marker):
+        mock_blob_service.return_value.make_blob_url.side_effect = make_blob_url
+        mock_blob_service.return_value.list_blobs.return_value = Page(
+            [blob("a.jpg"), blob("notes.txt"), blob("b.png")], next_marker)
+        mock_queue_service.put_message.side_effect = lambda queue_name, body: self.events.append((queue_name, body))
+        mock_data_access.return_value.is_onboarding_page_listed.return_value = False
+        mock_data_access.return_value.update_onboarding_job.side_effect = \
+            lambda *args, **kwargs: self.events.append(("update", kwargs))
+
+    def test_next_page_is_queued_last(self, mock_blob_service, mock_queue_service, mock_data_access, mock_provider):
+        self.set_up_page(mock_blob_service, mock_queue_service, mock_data_access, "marker-2")
+        main(queue_message(LIST_WORK))
+
+        self.assertEqual([ONBOARD_QUEUE_NAME, "update", ONBOARD_LIST_QUEUE_NAME], [event[0] for event in self.events])
+        images = json.loads(self.events[0][1])["images"]
+        self.assertEqual(["a.jpg", "b.png"], [image["fileName"] for image in images])
+        self.assertEqual("md5-a.jpg", images[0]["contentMd5"])
+        self.assertEqual(dict(pages_listed=1, blobs_listed=3, images_queued=2, listing_complete=False, page_marker=""),
+                         self.events[1][1])
+        self.assertEqual(dict(LIST_WORK, marker="marker-2"), json.loads(self.events[2][1]))
+
+    def test_failed_page_does_not_queue_next_page(self, mock_blob_service, mock_queue_service, mock_data_access,
+                                                  mock_provider):
+        self.set_up_page(mock_blob_service, mock_queue_service, mock_data_access, "marker-2")
+        mock_data_access.return_value.update_onboarding_job.side_effect = Exception("database unavailable")
+        with self.assertRaises(Exception):
+            main(queue_message(LIST_WORK))
+        self.assertEqual([ONBOARD_QUEUE_NAME], [event[0] for event in self.events])
+
+    def test_retried_page_only_queues_next_page(self, mock_blob_service, mock_queue_service, mock_data_access,
+                                                mock_provider):
+        self.set_up_page(mock_blob_service, mock_queue_service, mock_data_access, "marker-3")
+        mock_data_access.return_value.is_onboarding_page_listed.return_value = True
+        main(queue_message(dict(LIST_WORK, marker="marker-2")))
+
+        mock_data_access.return_value.is_onboarding_page_listed.assert_called_once_with(4, "marker-2")
+        self.assertEqual([ONBOARD_LIST_QUEUE_NAME], [event[0] for event in self.events])
+        self.assertEqual(dict(LIST_WORK, marker="marker-3"), json.loads(self.events[0][1]))
+
+    def test_last_page_completes_listing(self, mock_blob_service, mock_queue_service, mock_data_access, mock_provider):
+        self.set_up_page(mock_blob_service, mock_queue_service, mock_data_access, None)
+        main(queue_message(dict(LIST_WORK, marker="marker-2")))
+
+        mock_blob_service.return_value.list_blobs.assert_called_once_with(
+            "images", prefix=None, num_results=ONBOARD_LIST_PAGE_SIZE, marker="marker-2")
+        self.assertEqual([ONBOARD_QUEUE_NAME, "update"], [event[0] for event in self.events])
+        self.assertTrue(self.events[1][1]["listing_complete"])
+
+
+if __name__ == '__main__':
+    unittest.main()
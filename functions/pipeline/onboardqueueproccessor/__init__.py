@@ -2,13 +2,15 @@ import os
 import json
 import logging
 import azure.functions as func
+from concurrent.futures import ThreadPoolExecutor
 
-from urllib.request import urlopen
-
-from PIL import Image
 from ..shared.db_provider import get_postgres_provider
 from ..shared.db_access import ImageTagDataAccess, ImageInfo
-from azure.storage.blob import BlockBlobService
+from ..shared.image_utils import probe_image
+from ..shared.onboarding import copy_blob_from_url, parse_onboarding_message, ONBOARD_POISON_QUEUE_NAME
+
+# Images of a batch are probed and copied concurrently
+ONBOARD_WORKERS = int(os.getenv('ONBOARD_WORKERS', 8))
 
 
 def main(msg: func.QueueMessage) -> None:
@@ -32,66 +34,127 @@ def main(msg: func.QueueMessage) -> None:
 
     try:
         msg_json = json.loads(msg.get_body().decode('utf-8'))
-
-        img_url = msg_json['imageUrl']
-        user_name = msg_json["userName"]
-        original_filename = msg_json['fileName']
-        filetype = msg_json['fileExtension']
-        original_file_directory = msg_json['directoryComponents']
-
-        # Only 1 object in this list for now due to single message processing.
-        image_object_list = []
-
-        with Image.open(urlopen(img_url)) as img:
-            width, height = img.size
-
-        image = ImageInfo(original_filename, img_url, height, width)
-        # Append image object to the list
-        image_object_list.append(image)
-
-        data_access = ImageTagDataAccess(get_postgres_provider())
-        user_id = data_access.create_user(user_name)
-
-        logging.debug("Add new images to the database, and retrieve a dictionary ImageId's mapped to ImageUrl's")
-        image_id_url_map = data_access.add_new_images(image_object_list, user_id)
-
+        user_name, images, job_id = parse_onboarding_message(msg_json)
         copy_destination = os.getenv('DESTINATION_CONTAINER_NAME')
-
-        # Create blob service for storage account
-        blob_service = BlockBlobService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
-                                        account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
-
-        # Copy images to permanent storage and get a dictionary of images for which to update URLs in DB.
-        # and a list of failures.  If the list of failures contains any items, return a status code other than 200.
-
-        image_id = list(image_id_url_map.values())[0]
-        new_blob_name = (str(image_id) + filetype)
-
-        response = urlopen(img_url)
-
-        image_bytes = response.read()
-
-        # Per Azure notes https://docs.microsoft.com/en-us/azure/storage/blobs/storage-properties-metadata:
-        # The name of your metadata must conform to the naming conventions for C# identifiers. Dashes do not work.
-        # Azure blob is also setting the keys to full lowercase.
-        blob_metadata = {
-            "userFilePath": original_file_directory,
-            "originalFilename": original_filename,
-            "uploadUser": user_name
-        }
-
-        blob_create_response = blob_service.create_blob_from_bytes(copy_destination, new_blob_name, image_bytes, metadata=blob_metadata)
-        update_urls_dictionary = {image_id: blob_service.make_blob_url(copy_destination, new_blob_name)}
-
-        # Otherwise, dictionary contains permanent image URLs for each image ID that was successfully copied.
-        if not blob_create_response:
-            logging.error("ERROR: Image copy/delete operation failed. Check state of images in storage.")
-        else:
-            logging.debug("Now updating permanent URLs in the DB...")
-            data_access.update_image_urls(update_urls_dictionary, user_id)
-
-            # content = json.dumps({"imageUrls": list(update_urls_dictionary.values())})
-            logging.debug("success onboarding.")
+        blob_service = __get_blob_service()
+
+        # (image, error) for each image of the batch that could not be onboarded
+        failures = []
+        with ThreadPoolExecutor(max_workers=ONBOARD_WORKERS) as executor:
+            # Only image headers are downloaded here, storage copies the images themselves
+            image_infos = __run_all(executor, __build_image_info, images, failures)
+            data_access = ImageTagDataAccess(get_postgres_provider())
+            if not image_infos:
+                logging.error("No image in the message could be read")
+                if job_id is not None:
+                    data_access.update_onboarding_job(job_id, images_failed=len(failures))
+            else:
+                # The whole batch is registered with one user lookup in a single transaction, committed before
+                # the copies start so it isn't held open while they run
+                with data_access.unit_of_work():
+                    user_id = data_access.create_user(user_name)
+
+                    logging.debug("Add new images to the database, and retrieve a dictionary ImageId's mapped to ImageUrl's")
+                    image_id_url_map = data_access.add_new_images([info for _, info in image_infos], user_id)
+
+                # Images whose content is already onboarded are not registered or copied again
+                copy_tasks = [(image, image_id_url_map[image['imageUrl']], user_name, blob_service, copy_destination)
+                              for image, _ in image_infos if image['imageUrl'] in image_id_url_map]
+                skipped = len(image_infos) - len(copy_tasks)
+                if skipped:
+                    logging.info("Skipping {0} images already onboarded".format(skipped))
+                update_urls_dictionary = dict(__run_all(executor, __copy_to_perm_store, copy_tasks, failures,
+                                                        item_of=lambda task: task[0]))
+
+                # The copied images' URLs and the job's progress are saved in a second, short transaction
+                with data_access.unit_of_work():
+                    if update_urls_dictionary:
+                        logging.debug("Now updating permanent URLs in the DB...")
+                        data_access.update_image_urls(update_urls_dictionary, user_id)
+                    if job_id is not None:
+                        data_access.update_onboarding_job(job_id, images_onboarded=len(update_urls_dictionary),
+                                                          images_skipped=skipped, images_failed=len(failures))
+                logging.debug("Onboarded {0} of {1} images.".format(len(update_urls_dictionary), len(images)))
+
+        if failures:
+            __report_failures(user_name, job_id, failures)
     except Exception as e:
         logging.error("Exception: " + str(e))
-        raise e  # TODO: Handle errors and exceptions on the poison queue
+        raise e
+
+
+# Runs func over items on the executor. Returns the results that succeeded and appends (item, error) to failures
+# for those that raised.
+def __run_all(executor, func, items, failures, item_of=lambda item: item):
+    futures = [(item, executor.submit(func, item)) for item in items]
+    results = []
+    for item, future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logging.error("Failed to onboard {0}: {1}".format(item_of(item).get('fileName'), e))
+            failures.append((item_of(item), str(e)))
+    return results
+
+
+def __build_image_info(image):
+    width, height, content_hash = probe_image(image['imageUrl'])
+    # Container listings already carry the blob's MD5
+    content_hash = image.get('contentMd5') or content_hash
+    return image, ImageInfo(image['fileName'], image['imageUrl'], height, width, content_hash)
+
+
+# Returns (image id, permanent url)
+def __copy_to_perm_store(task):
+    image, image_id, user_name, blob_service, copy_destination = task
+    new_blob_name = (str(image_id) + image['fileExtension'])
+
+    # Per Azure notes https://docs.microsoft.com/en-us/azure/storage/blobs/storage-properties-metadata:
+    # The name of your metadata must conform to the naming conventions for C# identifiers. Dashes do not work.
+    # Azure blob is also setting the keys to full lowercase.
+    blob_metadata = {
+        "userFilePath": image['directoryComponents'],
+        "originalFilename": image['fileName'],
+        "uploadUser": user_name
+    }
+
+    # Server side copy, streamed through the function only if storage can't read the source
+    copy_blob_from_url(blob_service, copy_destination, new_blob_name, image['imageUrl'], metadata=blob_metadata)
+    return image_id, blob_service.make_blob_url(copy_destination, new_blob_name)
+
+
+# Each failed image goes to the poison queue as its own single image message, with the error, so it can be
+# inspected and requeued on its own. Images whose copy failed stay registered in the NOT_READY state, which doesn't
+# count as onboarded, so a requeued image is registered and copied again.
+def __report_failures(user_name, job_id, failures):
+    queue_service = __get_queue_service()
+    for image, error in failures:
+        queue_service.put_message(ONBOARD_POISON_QUEUE_NAME,
+                                  json.dumps({"userName": user_name, "jobId": job_id, "images": [image], "error": error}))
+    logging.warning("Sent {0} failed images to {1}".format(len(failures), ONBOARD_POISON_QUEUE_NAME))
+
+
+# Storage clients are module level so warm invocations reuse them. The storage SDK is slow to import, so it is
+# imported when a client is first created rather than on load.
+_blob_service = None
+_queue_service = None
+
+
+def __get_blob_service():
+    global _blob_service
+    if _blob_service is None:
+        from azure.storage.blob import BlockBlobService
+        _blob_service = BlockBlobService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+                                         account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
+    return _blob_service
+
+
+def __get_queue_service():
+    global _queue_service
+    if _queue_service is None:
+        from azure.storage.queue import QueueService, QueueMessageFormat
+        _queue_service = QueueService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
+                                      account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
+        # The queue trigger expects base64 encoded messages
+        _queue_service.encode_function = QueueMessageFormat.text_base64encode
+    return _queue_service
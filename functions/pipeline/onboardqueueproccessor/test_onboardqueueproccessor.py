@@ -0,0 +1,68 @@
+import json
+import unittest
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
+
+from . import main
+
+
+def queue_message(body):
+    msg = Mock()
+    msg.get_body.return_value = json.dumps(body).encode('utf-8')
+    msg.id, msg.pop_receipt, msg.dequeue_count = "1", "receipt", 1
+    msg.expiration_time = msg.insertion_time = msg.time_next_visible = None
+    return msg
+
+
+def image(name):
+    return {"imageUrl": "https://temp/" + name, "fileName": name, "fileExtension": ".jpg",
+            "directoryComponents": "folder"}
+
+
+@patch(__package__ + ".get_postgres_provider")
+@patch(__package__ + ".probe_image", return_value=(640, 480, None))
+@patch(__package__ + ".copy_blob_from_url")
+@patch(__package__ + "._blob_service", Mock())
+class TestOnboardQueueProcessor(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.data_access = Mock()
+
+        @contextmanager
+        def unit_of_work():
+            self.events.append("begin")
+            yield self.data_access
+            self.events.append("commit")
+
+        self.data_access.unit_of_work.side_effect = unit_of_work
+        self.data_access.create_user.return_value = 1
+        self.data_access.add_new_images.side_effect = lambda infos, user_id: \
+            {info.image_location: i + 10 for i, info in enumerate(infos)}
+        self.data_access.update_image_urls.side_effect = lambda *args: self.events.append("update_image_urls")
+
+    def run_message(self, body):
+        with patch(__package__ + ".ImageTagDataAccess", return_value=self.data_access):
+            main(queue_message(body))
+
+    def test_images_are_committed_before_copying(self, mock_copy, mock_probe, mock_provider):
+        mock_copy.side_effect = lambda *args, **kwargs: self.events.append("copy")
+        self.run_message({"userName": "me", "jobId": 5, "images": [image("a.jpg"), image("b.jpg")]})
+
+        self.assertEqual(["begin", "commit", "copy", "copy", "begin", "update_image_urls", "commit"], self.events)
+        update_urls = self.data_access.update_image_urls.call_args[0][0]
+        self.assertEqual({10, 11}, set(update_urls.keys()))
+        self.data_access.update_onboarding_job.assert_called_once_with(5, images_onboarded=2, images_skipped=0,
+                                                                       images_failed=0)
+
+    @patch(__package__ + "._queue_service")
+    def test_failed_copies_are_reported(self, mock_queue_service, mock_copy, mock_probe, mock_provider):
+        mock_copy.side_effect = [None, Exception("copy failed")]
+        self.run_message({"userName": "me", "images": [image("a.jpg"), image("b.jpg")]})
+
+        self.assertEqual(1, len(self.data_access.update_image_urls.call_args[0][0]))
+        poison_message = json.loads(mock_queue_service.put_message.call_args[0][1])
+        self.assertEqual([image("b.jpg")], poison_message["images"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import datetime
+
+
+# jsonpickle is imported on first use so only requests that encode with it pay for it on a cold start
+def encode(obj):
+    import jsonpickle
+    return jsonpickle.encode(obj, unpicklable=False)
+
+
+# Watermarks are handed out by the labels api as ISO 8601 timestamps. Returns None for values that aren't one.
+def parse_timestamp(value):
+    if not value:
+        return None
+    for timestamp_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    return None
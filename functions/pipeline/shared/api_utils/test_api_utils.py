@@ -0,0 +1,29 @@
+import datetime
+import json
+import unittest
+
+from . import encode, parse_timestamp
+
+
+class TestParseTimestamp(unittest.TestCase):
+    def test_parses_with_and_without_microseconds(self):
+        self.assertEqual(datetime.datetime(2018, 11, 1, 12, 0, 0, 500),
+                         parse_timestamp("2018-11-01T12:00:00.000500"))
+        self.assertEqual(datetime.datetime(2018, 11, 1, 12, 0, 0), parse_timestamp("2018-11-01T12:00:00"))
+
+    def test_invalid_timestamp(self):
+        self.assertIsNone(parse_timestamp("yesterday"))
+        self.assertIsNone(parse_timestamp(None))
+
+
+class TestEncode(unittest.TestCase):
+    def test_encodes_objects_as_plain_json(self):
+        class Label(object):
+            def __init__(self):
+                self.image_id = 1
+                self.labels = []
+        self.assertEqual({"image_id": 1, "labels": []}, json.loads(encode(Label())))
+
+
+if __name__ == '__main__':
+    unittest.main()
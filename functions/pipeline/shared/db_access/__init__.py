@@ -1,2 +1,2 @@
-from .models import ImageTag, ImageInfo, ImageTagState, ImageLabel, PredictionLabel, TrainingSession, Tag
+from .models import ImageTag, ImageInfo, ImageTagState, ImageLabel, PredictionLabel, TrainingSession, Tag, CheckoutStrategy
 from .db_access_v2 import ImageTagDataAccess
\ No newline at end of file
@@ -2,31 +2,195 @@ import string
 import logging
 import random
 import getpass
+import io
+import datetime
 import itertools
 import json
+import threading
+from contextlib import contextmanager
 from ..db_provider import DatabaseInfo, PostGresProvider
-from .models import ImageTag, ImageLabel, ImageTagState, AnnotatedLabel, Tag, ImageInfo, PredictionLabel, TrainingSession
+from .models import ImageTag, ImageLabel, ImageTagState, AnnotatedLabel, Tag, ImageInfo, PredictionLabel, TrainingSession, CheckoutStrategy
+
+# Claims taggable images that have a priority score, walking the Image_Priority confidence index in order
+CHECKOUT_CLAIM_BY_PRIORITY_QUERY = ("SELECT s.imageid, p.trainingid FROM image_priority p "
+                                    "JOIN image_tagging_state s ON s.imageid = p.imageid "
+                                    "WHERE s.tagstateid IN (%s,%s) "
+                                    "ORDER BY p.imageconfidence {0}, p.imageid {0} "
+                                    "LIMIT %s FOR UPDATE OF s SKIP LOCKED")
+
+# Claims any taggable images, scored or not
+CHECKOUT_CLAIM_ANY_QUERY = ("SELECT s.imageid, p.trainingid FROM image_tagging_state s "
+                            "LEFT JOIN image_priority p ON p.imageid = s.imageid "
+                            "WHERE s.tagstateid IN (%s,%s) "
+                            "LIMIT %s FOR UPDATE OF s SKIP LOCKED")
+
+CHECKOUT_PRIORITY_ORDER = {
+    CheckoutStrategy.LEAST_CONFIDENT: "ASC",
+    CheckoutStrategy.MOST_CONFIDENT: "DESC"
+}
+
+# Claimed rows are moved to TAG_IN_PROGRESS in the same statement. SKIP LOCKED lets concurrent checkouts pass over
+# rows another tagger is claiming instead of blocking on them or handing out the same image twice. Predictions are
+# looked up by (TrainingId, ImageId) for the training that produced each image's priority score, or for the latest
+# training if the image has no score yet.
+CHECKOUT_QUERY = ("WITH claimed AS ({0}), "
+                  "its AS ( "
+                  "UPDATE image_tagging_state s "
+                  "SET tagstateid = %s, modifiedbyuser = %s, modifieddtim = now() "
+                  "FROM claimed c WHERE s.imageid = c.imageid "
+                  "RETURNING s.imageid, "
+                  "COALESCE(c.trainingid, (SELECT MAX(trainingid) FROM training_info)) AS trainingid "
+                  "), "
+                  "pl AS ( "
+                  "SELECT p.*, ci.classificationname "
+                  "FROM its "
+                  "join prediction_labels p on p.trainingid = its.trainingid and p.imageid = its.imageid "
+                  "join classification_info ci on ci.classificationid = p.classificationid "
+                  ") "
+                  "select "
+                  "its.imageid, "
+                  "i.imagelocation, "
+                  "pl.classificationid, "
+                  "pl.classificationname, "
+                  "pl.x_min, "
+                  "pl.x_max, "
+                  "pl.y_min, "
+                  "pl.y_max, "
+                  "i.height, "
+                  "i.width, "
+                  "pl.boxconfidence, "
+                  "pl.imageconfidence "
+                  "FROM its "
+                  "join image_info i on i.imageid = its.imageid "
+                  "left outer join pl on its.imageid = pl.imageid")
+
+GET_LABELS_QUERY = ("SELECT d.imageid, d.imagelocation, d.height, d.width, "
+                    "c.classificationname, x_min, x_max, y_min, y_max "
+                    "FROM Annotated_Labels a "
+                    "inner join classification_info c on a.classificationid = c.classificationid "
+                    "inner join image_info d on d.imageid = a.imageid ")
+
+# Keyset page of labels: the first page_size labeled images after an image id, walked in Annotated_Labels
+# primary key order so each page costs the same no matter how deep into the table it is
+GET_LABELS_PAGE_QUERY = ("WITH page AS ("
+                         "SELECT DISTINCT a.imageid FROM Annotated_Labels a WHERE a.imageid > %s {0}"
+                         "ORDER BY a.imageid LIMIT %s) "
+                         "SELECT d.imageid, d.imagelocation, d.height, d.width, "
+                         "c.classificationname, x_min, x_max, y_min, y_max "
+                         "FROM page p "
+                         "inner join Annotated_Labels a on a.imageid = p.imageid "
+                         "inner join classification_info c on a.classificationid = c.classificationid "
+                         "inner join image_info d on d.imageid = a.imageid "
+                         "ORDER BY a.imageid")
+GET_LABELS_PAGE_BEFORE_CLAUSE = "AND a.imageid < %s "
+
+# Keyset page of the images whose labels may have changed since a watermark: labels were added to them, or their
+# tagging state changed, which every upload of their labels does, including one that removes them all. Each image
+# comes back with its full current label set, images left without labels as a single row with no classification.
+GET_CHANGED_LABELS_PAGE_QUERY = ("WITH page AS ("
+                                 "SELECT imageid FROM ("
+                                 "SELECT a.imageid FROM Annotated_Labels a WHERE a.imageid > %s {0}AND a.CreatedDtim > %s "
+                                 "UNION "
+                                 "SELECT s.imageid FROM Image_Tagging_State s WHERE s.imageid > %s {1}AND s.ModifiedDtim > %s"
+                                 ") changed ORDER BY imageid LIMIT %s) "
+                                 "SELECT d.imageid, d.imagelocation, d.height, d.width, "
+                                 "c.classificationname, x_min, x_max, y_min, y_max "
+                                 "FROM page p "
+                                 "inner join image_info d on d.imageid = p.imageid "
+                                 "left join Annotated_Labels a on a.imageid = p.imageid "
+                                 "left join classification_info c on a.classificationid = c.classificationid "
+                                 "ORDER BY p.imageid")
+GET_CHANGED_LABELS_PAGE_BEFORE_CLAUSE = "AND s.imageid < %s "
+
+# Rows fetched per round trip when streaming labels through a server side cursor
+LABEL_FETCH_SIZE = 5000
+LABEL_CURSOR_NAME = "labels_cursor"
+
+# Served by the Image_Tagging_State (TagStateId, CreatedDtim) index
+GET_IMAGES_BY_TAG_STATUS_QUERY = ("SELECT b.ImageId, b.ImageLocation, a.TagStateId FROM Image_Tagging_State a "
+                                  "JOIN Image_Info b ON a.ImageId = b.ImageId WHERE a.TagStateId = ANY(%s::int[]) "
+                                  "{0}ORDER BY a.createddtim DESC")
+GET_IMAGES_MODIFIED_SINCE_CLAUSE = "AND a.ModifiedDtim > %s "
+
+# Incremental syncs re-read this far behind the caller's watermark. Rows are stamped with their transaction's
+# start time, so a long running transaction can commit rows older than a watermark handed out before it committed.
+SYNC_WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+ONBOARDING_JOB_COLUMNS = ("JobId", "StorageAccount", "StorageContainer", "Prefix", "PagesListed", "BlobsListed",
+                          "ImagesQueued", "ImagesOnboarded", "ImagesSkipped", "ImagesFailed", "ListingComplete",
+                          "ModifiedDtim", "CreatedDtim")
+ONBOARDING_JOB_FIELDS = ("jobId", "storageAccount", "storageContainer", "prefix", "pagesListed", "blobsListed",
+                         "imagesQueued", "imagesOnboarded", "imagesSkipped", "imagesFailed", "listingComplete",
+                         "modified", "created")
+
+# Number of images registered per INSERT statement in add_new_images
+IMAGE_INSERT_BATCH_SIZE = 5000
+
+# How long a NOT_READY image counts as still being copied to permanent storage. Onboarding the same content again
+# skips it until then, after that the copy is taken to have failed. Covers the onboarding copy follow-up checks.
+ONBOARDING_COPY_WINDOW = datetime.timedelta(hours=1)
+
+# Maximum number of rows sent per COPY statement so bulk uploads are streamed in bounded pieces
+COPY_CHUNK_SIZE = 10000
+
+ANNOTATED_LABEL_COPY_COLUMNS = ("ImageId","ClassificationId","X_Min","X_Max","Y_Min","Y_Max","CreatedByUser")
+PREDICTION_LABEL_COPY_COLUMNS = ("TrainingId","ImageId","ClassificationId","X_Min","X_Max","Y_Min","Y_Max",
+                                 "BoxConfidence","ImageConfidence")
+PREDICTION_LABEL_KEY_COLUMNS = "TrainingId,ImageId,ClassificationId,X_Min,X_Max,Y_Min,Y_Max"
 
 class ImageTagDataAccess(object):
     def __init__(self,  db_provider):
         self._db_provider = db_provider
+        self._unit_of_work = threading.local()
+
+    # Runs every data access call made inside the with block on a single connection and commits once
+    # when the block exits. An exception rolls back everything done in the block. Nested blocks join
+    # the outer unit of work.
+    #   with data_access.unit_of_work():
+    #       user_id = data_access.create_user(user_name)
+    #       data_access.add_new_images(image_infos, user_id)
+    @contextmanager
+    def unit_of_work(self):
+        if getattr(self._unit_of_work, "connection", None) is not None:
+            yield self
+            return
 
-    def test_connection(self):
         conn = self._db_provider.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('select * from tagstate')
-        row = cursor.fetchone()
-        logging.info('')
-        while row:
-            logging.info(str(row[0]) + " " + str(row[1]))
+        self._unit_of_work.connection = conn
+        try:
+            yield self
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._unit_of_work.connection = None
+            conn.close()
+
+    def _get_connection(self):
+        conn = getattr(self._unit_of_work, "connection", None)
+        if conn is not None:
+            return _UnitOfWorkConnection(conn)
+        return self._db_provider.get_connection()
+
+    def test_connection(self):
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select * from tagstate')
             row = cursor.fetchone()
+            logging.info('')
+            while row:
+                logging.info(str(row[0]) + " " + str(row[1]))
+                row = cursor.fetchone()
+        finally: conn.close()
 
     def create_user(self,user_name):
         user_id = -1
         if not user_name:
             raise ArgumentException("Parameter cannot be an empty string")
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
                 query = ("WITH existingUser AS ( "
@@ -57,17 +221,23 @@ class ImageTagDataAccess(object):
 
         selected_images_to_tag = {}
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
-                query = ("SELECT b.ImageId, b.ImageLocation, a.TagStateId FROM Image_Tagging_State a "
-                        "JOIN Image_Info b ON a.ImageId = b.ImageId WHERE a.TagStateId IN ({1}, {2}) order by "
-                        "a.createddtim DESC limit {0}")
-                cursor.execute(query.format(number_of_images, ImageTagState.READY_TO_TAG, ImageTagState.INCOMPLETE_TAG))
+                # Claim and update in one statement so concurrent callers never get the same images
+                query = ("WITH claimed AS ( "
+                        "SELECT a.ImageId FROM Image_Tagging_State a WHERE a.TagStateId IN (%s, %s) "
+                        "order by a.createddtim DESC limit %s FOR UPDATE SKIP LOCKED), "
+                        "updated AS ( "
+                        "UPDATE Image_Tagging_State a SET TagStateId = %s, ModifiedByUser = %s, ModifiedDtim = now() "
+                        "FROM claimed c WHERE a.ImageId = c.ImageId RETURNING a.ImageId, a.TagStateId) "
+                        "SELECT b.ImageId, b.ImageLocation, u.TagStateId FROM updated u JOIN Image_Info b ON u.ImageId = b.ImageId")
+                cursor.execute(query,(int(ImageTagState.READY_TO_TAG), int(ImageTagState.INCOMPLETE_TAG), number_of_images,
+                                      int(ImageTagState.TAG_IN_PROGRESS), user_id))
                 for row in cursor:
                     logging.debug('Image Id: {0} \t\tImage Name: {1} \t\tTag State: {2}'.format(row[0], row[1], row[2]))
                     selected_images_to_tag[row[0]] = str(row[1])
-                self._update_images(selected_images_to_tag,ImageTagState.TAG_IN_PROGRESS, user_id, conn)
+                conn.commit()
             finally:
                 cursor.close()
         except Exception as e:
@@ -85,40 +255,70 @@ class ImageTagDataAccess(object):
         url_to_image_id_map = {}
         if(len(list_of_image_infos) > 0):
             try:
-                conn = self._db_provider.get_connection()
+                conn = self._get_connection()
                 try:
                     cursor = conn.cursor()
-                    for img in list(list_of_image_infos):
-                        query = ("INSERT INTO Image_Info (OriginalImageName,ImageLocation,Height,Width,CreatedByUser) "
-                                "VALUES (%s,%s,%s,%s,%s) RETURNING ImageId;")
-                        cursor.execute(query,(img.image_name,img.image_location,img.height,img.width,user_id))
-                        new_img_id = cursor.fetchone()[0]
-                        url_to_image_id_map[img.image_location] = new_img_id
+                    # One statement per batch: the columns are sent as arrays and unnested server side,
+                    # and the location is returned with each id to keep the url to id mapping exact.
+                    # Images whose content is already onboarded are skipped and left out of the mapping. Content
+                    # counts as onboarded once its image has left NOT_READY, i.e. its copy to permanent storage
+                    # succeeded and its location was updated, or while that copy may still be running. Images whose
+                    # copy failed can be onboarded again. Only the first of several images with the same content
+                    # in a batch is inserted.
+                    query = ("INSERT INTO Image_Info (OriginalImageName,ImageLocation,Height,Width,CreatedByUser,ContentHash) "
+                            "SELECT DISTINCT ON (t.c, CASE WHEN t.c IS NULL THEN t.o END) n, l, h, w, %s, c "
+                            "FROM unnest(%s::text[], %s::text[], %s::int[], %s::int[], %s::text[]) WITH ORDINALITY AS t(n, l, h, w, c, o) "
+                            "WHERE t.c IS NULL OR NOT EXISTS ("
+                            "SELECT 1 FROM Image_Info i JOIN Image_Tagging_State s ON s.ImageId = i.ImageId "
+                            "WHERE i.ContentHash = t.c AND i.ImageLocation <> t.l "
+                            "AND (s.TagStateId <> %s OR s.ModifiedDtim > now() - %s)) "
+                            "ORDER BY t.c, CASE WHEN t.c IS NULL THEN t.o END, t.o "
+                            "RETURNING ImageId, ImageLocation")
+                    image_infos = list(list_of_image_infos)
+                    content_hashes = sorted(set(img.content_hash for img in image_infos if img.content_hash))
+                    if content_hashes:
+                        # Concurrent onboarding of the same content waits here for the first to commit, so the
+                        # duplicate check sees its images. Taken in hash order, once per call, to avoid deadlocks.
+                        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(h)) FROM unnest(%s::text[]) AS u(h)",
+                                       (content_hashes,))
+                    for i in range(0, len(image_infos), IMAGE_INSERT_BATCH_SIZE):
+                        batch = image_infos[i:i + IMAGE_INSERT_BATCH_SIZE]
+                        cursor.execute(query,(user_id,
+                                              [img.image_name for img in batch],
+                                              [img.image_location for img in batch],
+                                              [int(img.height) for img in batch],
+                                              [int(img.width) for img in batch],
+                                              [img.content_hash for img in batch],
+                                              int(ImageTagState.NOT_READY),
+                                              ONBOARDING_COPY_WINDOW))
+                        for row in cursor.fetchall():
+                            url_to_image_id_map[row[1]] = row[0]
                     conn.commit()
                 finally: cursor.close()
-                logging.debug("Inserted {0} images to the DB".format(len(url_to_image_id_map)))
+                logging.debug("Inserted {0} of {1} images to the DB".format(len(url_to_image_id_map), len(image_infos)))
             except Exception as e:
                 logging.error("An errors occured getting image ids: {0}".format(e))
                 raise
             finally: conn.close()
         return url_to_image_id_map
 
-    def get_images_by_tag_status(self, tag_status, limit=None):
+    # With modified_since, only images whose tagging state changed after that watermark are returned
+    def get_images_by_tag_status(self, tag_status, limit=None, modified_since=None):
         images_by_tag_status = {}
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
-                tags = ''
-                for id in tag_status:
-                    tags += str(id) + ','
-                tags = tags[:-1]
-                query = ("SELECT b.ImageId, b.ImageLocation, a.TagStateId FROM Image_Tagging_State a "
-                        "JOIN Image_Info b ON a.ImageId = b.ImageId WHERE a.TagStateId IN ({0}) order by "
-                        "a.createddtim DESC")
+                args = [[int(id) for id in tag_status]]
+                clauses = ""
+                if modified_since:
+                    clauses += GET_IMAGES_MODIFIED_SINCE_CLAUSE
+                    args.append(modified_since - SYNC_WATERMARK_OVERLAP)
+                query = GET_IMAGES_BY_TAG_STATUS_QUERY.format(clauses)
                 if limit:
-                    query += " limit {1}"
-                cursor.execute(query.format(tags, limit))
+                    query += " LIMIT %s"
+                    args.append(int(limit))
+                cursor.execute(query, tuple(args))
                 for row in cursor:
                     logging.debug('Image Id: {0} \t\tImage Name: {1} \t\tTag State: {2}'.format(row[0], row[1], row[2]))
                     images_by_tag_status[row[0]] = str(row[1])
@@ -136,7 +336,7 @@ class ImageTagDataAccess(object):
             return list()
 
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
                 ids = ''
@@ -166,61 +366,28 @@ class ImageTagDataAccess(object):
             conn.close()
         return list(images_info)
 
-    def checkout_images(self, image_count, user_id):
+    def checkout_images(self, image_count, user_id, strategy=CheckoutStrategy.LEAST_CONFIDENT):
         if type(image_count) is not int:
             raise TypeError('image_count must be an integer')
+        if type(user_id) is not int:
+            raise TypeError('user id must be an integer')
+        strategy = CheckoutStrategy(strategy)
         image_id_to_image_labels = {}
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
-                query = ("with pl AS ( "
-                        "SELECT p.*, ci.classificationname "
-                        "FROM prediction_labels p "
-                        "join classification_info ci on ci.classificationid = p.classificationid "
-                        "WHERE trainingid = (select MAX(trainingid) From training_info) "
-                        "), "
-                        "its AS ( "
-                        "SELECT s.imageid, ts.tagstatename, i.imagelocation,i.height,i.width "
-                        "FROM image_tagging_state s "
-                        "join image_info i on i.imageid = s.imageid "
-                        "join tag_state ts on ts.tagstateid = s.tagstateid "
-                        "WHERE s.tagstateid in ({0},{1}) LIMIT {2} "
-                        ") "
-                        "select "
-                        "its.imageid, "
-                        "its.imagelocation, "
-                        "pl.classificationid, "
-                        "pl.classificationname, "
-                        "pl.x_min, "
-                        "pl.x_max, "
-                        "pl.y_min, "
-                        "pl.y_max, "
-                        "its.height, "
-                        "its.width, "
-                        "pl.boxconfidence, "
-                        "pl.imageconfidence, "
-                        "its.tagstatename "
-                        "FROM its "
-                        "left outer join pl on its.imageid = pl.imageid")
-                cursor.execute(query.format(ImageTagState.READY_TO_TAG, ImageTagState.INCOMPLETE_TAG, image_count))
-
-                logging.debug("Got image tags back for image_count={0}".format(image_count))
-
-                for row in cursor:
-                    image_tag = {}
-                    # Handle the incomplete case
-                    if row[4] and row[5] and row[6] and row[7]:
-                        image_tag = ImageTag(row[0], float(row[4]), float(row[5]), float(row[6]), float(row[7]), row[3])
-                    if row[0] not in image_id_to_image_labels:
-                        image_label = ImageLabel(row[0], row[1], row[8], row[9], [image_tag])
-                        image_id_to_image_labels[row[0]] = image_label
-                    else:
-                        image_id_to_image_labels[row[0]].labels.append(image_tag)
+                # Images with a priority score are served first in the order the strategy asks for. Any shortfall
+                # (images never scored by a model, or the ANY strategy) is filled with unordered taggable images.
+                if strategy != CheckoutStrategy.ANY:
+                    claim_query = CHECKOUT_CLAIM_BY_PRIORITY_QUERY.format(CHECKOUT_PRIORITY_ORDER[strategy])
+                    self._checkout(cursor, claim_query, image_count, user_id, image_id_to_image_labels)
+                remaining = image_count - len(image_id_to_image_labels)
+                if remaining > 0:
+                    self._checkout(cursor, CHECKOUT_CLAIM_ANY_QUERY, remaining, user_id, image_id_to_image_labels)
 
                 logging.debug("Checked out images: " + str(image_id_to_image_labels))
-                images_ids_to_update = list(image_id_to_image_labels.keys())
-                self._update_images(images_ids_to_update, ImageTagState.TAG_IN_PROGRESS, user_id, conn)
+                conn.commit()
             finally:
                 cursor.close()
         except Exception as e:
@@ -230,9 +397,139 @@ class ImageTagDataAccess(object):
             conn.close()
         return list(image_id_to_image_labels.values())
 
+    def _checkout(self, cursor, claim_query, image_count, user_id, image_id_to_image_labels):
+        cursor.execute(CHECKOUT_QUERY.format(claim_query),(int(ImageTagState.READY_TO_TAG), int(ImageTagState.INCOMPLETE_TAG),
+                       image_count, int(ImageTagState.TAG_IN_PROGRESS), user_id))
+
+        logging.debug("Got image tags back for image_count={0}".format(image_count))
+
+        for row in cursor:
+            image_tag = {}
+            # Handle the incomplete case
+            if row[4] and row[5] and row[6] and row[7]:
+                image_tag = ImageTag(row[0], float(row[4]), float(row[5]), float(row[6]), float(row[7]), row[3])
+            if row[0] not in image_id_to_image_labels:
+                image_label = ImageLabel(row[0], row[1], row[8], row[9], [image_tag])
+                image_id_to_image_labels[row[0]] = image_label
+            else:
+                image_id_to_image_labels[row[0]].labels.append(image_tag)
+
+    def create_onboarding_job(self, user_id, storage_account, storage_container, prefix=None):
+        if type(user_id) is not int:
+            raise TypeError('user id must be an integer')
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                query = ("INSERT INTO Onboarding_Job (StorageAccount, StorageContainer, Prefix, CreatedByUser) "
+                         "VALUES (%s, %s, %s, %s) RETURNING JobId")
+                cursor.execute(query, (storage_account, storage_container, prefix, user_id))
+                job_id = cursor.fetchone()[0]
+                conn.commit()
+            finally:
+                cursor.close()
+            logging.debug("Created onboarding job {0} for container {1}".format(job_id, storage_container))
+        except Exception as e:
+            logging.error("An error occurred creating an onboarding job: {0}".format(e))
+            raise
+        finally:
+            conn.close()
+        return job_id
+
+    # Adds to the job's counters. Listing pages and queue batches finish in any order, so counters are only
+    # ever incremented, and listing_complete only ever set.
+    # With page_marker, the update is for that listing page and is only applied once: it returns False, leaving
+    # the counters alone, if the page was already counted.
+    def update_onboarding_job(self, job_id, pages_listed=0, blobs_listed=0, images_queued=0, images_onboarded=0,
+                              images_skipped=0, images_failed=0, listing_complete=False, page_marker=None):
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                query = ("UPDATE Onboarding_Job SET PagesListed = PagesListed + %s, BlobsListed = BlobsListed + %s, "
+                         "ImagesQueued = ImagesQueued + %s, ImagesOnboarded = ImagesOnboarded + %s, "
+                         "ImagesSkipped = ImagesSkipped + %s, ImagesFailed = ImagesFailed + %s, "
+                         "ListingComplete = ListingComplete OR %s, ModifiedDtim = now(){0} WHERE JobId = %s{1} "
+                         "RETURNING JobId")
+                args = [pages_listed, blobs_listed, images_queued, images_onboarded, images_skipped, images_failed,
+                        listing_complete]
+                if page_marker is None:
+                    query = query.format("", "")
+                    args.append(job_id)
+                else:
+                    query = query.format(", ListedMarkers = array_append(ListedMarkers, %s)",
+                                         " AND NOT (%s = ANY(ListedMarkers))")
+                    args += [page_marker, job_id, page_marker]
+                cursor.execute(query, tuple(args))
+                updated = cursor.fetchone() is not None
+                conn.commit()
+            finally:
+                cursor.close()
+        except Exception as e:
+            logging.error("An error occurred updating onboarding job {0}: {1}".format(job_id, e))
+            raise
+        finally:
+            conn.close()
+        return updated
+
+    # Whether the listing page starting at page_marker was already queued and counted, see update_onboarding_job
+    def is_onboarding_page_listed(self, job_id, page_marker):
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT %s = ANY(ListedMarkers) FROM Onboarding_Job WHERE JobId = %s",
+                               (page_marker, job_id))
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+        except Exception as e:
+            logging.error("An error occurred getting onboarding job {0}: {1}".format(job_id, e))
+            raise
+        finally:
+            conn.close()
+        return bool(row and row[0])
+
+    # Returns the job's progress as a dictionary, or None if there is no such job
+    def get_onboarding_job(self, job_id):
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                query = ("SELECT {0} FROM Onboarding_Job WHERE JobId = %s").format(", ".join(ONBOARDING_JOB_COLUMNS))
+                cursor.execute(query, (int(job_id),))
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+        except Exception as e:
+            logging.error("An error occurred getting onboarding job {0}: {1}".format(job_id, e))
+            raise
+        finally:
+            conn.close()
+        if not row:
+            return None
+        job = dict(zip(ONBOARDING_JOB_FIELDS, row))
+        job["modified"] = job["modified"].isoformat()
+        job["created"] = job["created"].isoformat()
+        return job
+
+    # Database time to use as the modified_since watermark of the next incremental sync. Take it before
+    # reading the changes it covers.
+    def get_sync_watermark(self):
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT LOCALTIMESTAMP")
+                return cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
     def get_existing_classifications(self):
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
                 query = "SELECT classificationname from classification_info order by classificationname asc"
@@ -252,14 +549,42 @@ class ImageTagDataAccess(object):
             conn.close()
         return list(classification_set)
 
-    def update_incomplete_images(self, list_of_image_ids, user_id):
+    # annotated_labels are the labels saved so far on these images. They replace the images' existing labels, like
+    # update_tagged_images_v2 does, so an image uploaded again with fewer labels loses the ones that were removed.
+    def update_incomplete_images(self, list_of_image_ids, user_id, annotated_labels=None):
         #TODO: Make sure the image ids are in a TAG_IN_PROGRESS state
-        self._update_images(list_of_image_ids,ImageTagState.INCOMPLETE_TAG,user_id, self._db_provider.get_connection())
+        if not list_of_image_ids:
+            logging.debug("No images to update")
+            return
+
+        if type(user_id) is not int:
+            raise TypeError('user id must be an integer')
+
+        annotated_labels = annotated_labels or []
+        try:
+            conn = self._get_connection()
+            try:
+                self._delete_annotated_labels(list_of_image_ids, conn)
+                cursor = conn.cursor()
+                if annotated_labels:
+                    rows = ((label.image_id,label.classification_id,label.x_min,label.x_max,label.y_min,label.y_max,user_id)
+                            for label in annotated_labels)
+                    _copy_rows(cursor, "Annotated_Labels", ANNOTATED_LABEL_COPY_COLUMNS, rows)
+                    logging.debug("Copied {0} annotated labels".format(len(annotated_labels)))
+                self._update_images(list_of_image_ids,ImageTagState.INCOMPLETE_TAG,user_id,conn)
+                conn.commit()
+            finally: cursor.close()
+        except Exception as e:
+            logging.error("An errors occured updating incomplete images: {0}".format(e))
+            raise
+        finally: conn.close()
         logging.debug("Updated {0} image(s) to the state {1}".format(len(list_of_image_ids),ImageTagState.INCOMPLETE_TAG.name))
 
     def update_completed_untagged_images(self,list_of_image_ids, user_id):
         #TODO: Make sure the image ids are in a TAG_IN_PROGRESS state
-        self._update_images(list_of_image_ids,ImageTagState.COMPLETED_TAG,user_id, self._db_provider.get_connection())
+        # Visited without any tags, so labels saved by an earlier upload of these images no longer apply
+        self._delete_annotated_labels(list_of_image_ids, None)
+        self._update_images(list_of_image_ids,ImageTagState.COMPLETED_TAG,user_id, None)
         logging.debug("Updated {0} image(s) to the state {1}".format(len(list_of_image_ids),ImageTagState.COMPLETED_TAG.name))
 
     def _update_images(self, list_of_image_ids, new_image_tag_state, user_id, conn):
@@ -269,18 +594,18 @@ class ImageTagDataAccess(object):
         if type(user_id) is not int:
             raise TypeError('user id must be an integer')
 
-        if not conn:
-            conn = self._db_provider.get_connection()
+        # Connections we open here must be handed back to the pool, connections passed in belong to the caller
+        owns_connection = not conn
+        if owns_connection:
+            conn = self._get_connection()
 
         try:
             if(len(list_of_image_ids) > 0):
                 cursor = conn.cursor()
                 try:
-                    image_ids_as_strings = [str(i) for i in list_of_image_ids]
-                    images_to_update = '{0}'.format(', '.join(image_ids_as_strings))
-                    # TODO: find another way to do string subsitution that doesn't break this query
-                    query = "UPDATE Image_Tagging_State SET TagStateId = {0}, ModifiedByUser = {2}, ModifiedDtim = now() WHERE ImageId IN ({1})"
-                    cursor.execute(query.format(new_image_tag_state,images_to_update,user_id))
+                    images_to_update = [int(i) for i in list_of_image_ids]
+                    query = "UPDATE Image_Tagging_State SET TagStateId = %s, ModifiedByUser = %s, ModifiedDtim = now() WHERE ImageId = ANY(%s::int[])"
+                    cursor.execute(query,(int(new_image_tag_state),user_id,images_to_update))
                     conn.commit()
                 finally: cursor.close()
             else:
@@ -288,6 +613,30 @@ class ImageTagDataAccess(object):
         except Exception as e:
             logging.error("An errors occured updating images: {0}".format(e))
             raise
+        finally:
+            if owns_connection: conn.close()
+
+    # Removes the human annotated labels of the images, so uploading an image's labels replaces rather than adds to them
+    def _delete_annotated_labels(self, list_of_image_ids, conn):
+        if not list_of_image_ids:
+            return
+        owns_connection = not conn
+        if owns_connection:
+            conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("DELETE FROM Annotated_Labels WHERE ImageId = ANY(%s::int[])",
+                               (sorted(set(int(i) for i in list_of_image_ids)),))
+                # A caller's connection is committed by the caller, together with the labels that replace these
+                if owns_connection:
+                    conn.commit()
+            finally: cursor.close()
+        except Exception as e:
+            logging.error("An errors occured deleting annotated labels: {0}".format(e))
+            raise
+        finally:
+            if owns_connection: conn.close()
 
     def update_image_urls(self,image_id_to_url_map, user_id):
         if type(user_id) is not int:
@@ -295,17 +644,19 @@ class ImageTagDataAccess(object):
 
         if(len(image_id_to_url_map.items())):
             try:
-                conn = self._db_provider.get_connection()
+                conn = self._get_connection()
                 try:
                     cursor = conn.cursor()
-                    for image_id, new_url in image_id_to_url_map.items():
-                        cursor = conn.cursor()
-                        query = "UPDATE Image_Info SET ImageLocation = '{0}', ModifiedDtim = now() WHERE ImageId = {1}"
-                        cursor.execute(query.format(new_url,image_id))
-                        conn.commit()
-                        logging.debug("Updated ImageId: {0} to new ImageLocation: {1}".format(image_id,new_url))
-                        self._update_images([image_id],ImageTagState.READY_TO_TAG, user_id,conn)
-                        logging.debug("ImageId: {0} to has a new state: {1}".format(image_id,ImageTagState.READY_TO_TAG.name))
+                    image_ids = [int(image_id) for image_id in image_id_to_url_map.keys()]
+                    new_urls = [str(new_url) for new_url in image_id_to_url_map.values()]
+                    # All locations are updated in one statement, and _update_images moves all of the images
+                    # to READY_TO_TAG in a second one before committing both together.
+                    query = ("UPDATE Image_Info i SET ImageLocation = u.url, ModifiedDtim = now() "
+                            "FROM unnest(%s::int[], %s::text[]) AS u(imageid, url) WHERE i.ImageId = u.imageid")
+                    cursor.execute(query,(image_ids,new_urls))
+                    logging.debug("Updated ImageLocation for {0} images".format(len(image_ids)))
+                    self._update_images(image_ids,ImageTagState.READY_TO_TAG, user_id,conn)
+                    logging.debug("{0} images have a new state: {1}".format(len(image_ids),ImageTagState.READY_TO_TAG.name))
                 finally: cursor.close()
             except Exception as e:
                 logging.error("An errors occured updating image urls: {0}".format(e))
@@ -317,7 +668,7 @@ class ImageTagDataAccess(object):
         if not class_names:
             raise ValueError("Classification names must be present")
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
                 query = ("WITH sc AS ( "
@@ -357,17 +708,15 @@ class ImageTagDataAccess(object):
         labels_length = len(annotated_labels)
         all_image_ids = list(l.image_id for l in annotated_labels)
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
+                # Each image's labels are replaced, so uploading the same labels again is harmless
+                self._delete_annotated_labels(all_image_ids, conn)
                 cursor = conn.cursor()
-                query = "INSERT INTO Annotated_Labels(ImageId,ClassificationId,X_Min,X_Max,Y_Min,Y_Max,CreatedByUser) VALUES "
-                #Build query so we can insert all rows at once
-                for i in range(labels_length):
-                    label = annotated_labels[i]
-                    query+="({0},{1},{2},{3},{4},{5},{6}) ".format(label.image_id,label.classification_id,
-                                                            label.x_min,label.x_max,label.y_min,label.y_max,user_id)
-                    if i != labels_length-1: query+=","
-                cursor.execute(query)
+                rows = ((label.image_id,label.classification_id,label.x_min,label.x_max,label.y_min,label.y_max,user_id)
+                        for label in annotated_labels)
+                _copy_rows(cursor, "Annotated_Labels", ANNOTATED_LABEL_COPY_COLUMNS, rows)
+                logging.debug("Copied {0} annotated labels".format(labels_length))
                 self._update_images(all_image_ids,ImageTagState.COMPLETED_TAG,user_id,conn)
                 conn.commit()
             #logging.debug("Updated status for {0} images".format(len(all_image_ids)))
@@ -394,18 +743,34 @@ class ImageTagDataAccess(object):
 
         labels_length = len(prediction_labels)
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
-                query = "INSERT INTO Prediction_Labels(TrainingId,ImageId,ClassificationId,X_Min,X_Max,Y_Min,Y_Max,BoxConfidence,ImageConfidence) VALUES "
-                #Build query so we can insert all rows at once
-                for i in range(labels_length):
-                    label = prediction_labels[i]
-                    query+="({0},{1},{2},{3},{4},{5},{6},{7},{8}) ".format(training_id,label.image_id,label.classification_id,
-                                                                    label.x_min,label.x_max,label.y_min,label.y_max,
-                                                                    label.box_confidence,label.image_confidence)
-                    if i != labels_length-1: query+=","
+                # Stream the predictions into a session scoped staging table, then merge them so a
+                # re-upload of the same training's predictions updates confidences instead of failing
+                # on the primary key.
+                cursor.execute("CREATE TEMP TABLE IF NOT EXISTS Prediction_Labels_Staging "
+                               "(LIKE Prediction_Labels) ON COMMIT DELETE ROWS")
+                rows = ((training_id,label.image_id,label.classification_id,label.x_min,label.x_max,
+                         label.y_min,label.y_max,label.box_confidence,label.image_confidence)
+                        for label in prediction_labels)
+                _copy_rows(cursor, "Prediction_Labels_Staging", PREDICTION_LABEL_COPY_COLUMNS, rows)
+                query = ("INSERT INTO Prediction_Labels ({0}) "
+                         "SELECT DISTINCT ON ({1}) {0} FROM Prediction_Labels_Staging "
+                         "ORDER BY {1}, BoxConfidence DESC "
+                         "ON CONFLICT ({1}) DO UPDATE SET "
+                         "BoxConfidence = EXCLUDED.BoxConfidence, ImageConfidence = EXCLUDED.ImageConfidence")
+                cursor.execute(query.format(",".join(PREDICTION_LABEL_COPY_COLUMNS), PREDICTION_LABEL_KEY_COLUMNS))
+                # Keep each image's checkout priority in step with its newest predictions
+                query = ("INSERT INTO Image_Priority (ImageId, TrainingId, ImageConfidence, ModifiedDtim) "
+                         "SELECT ImageId, TrainingId, MIN(ImageConfidence), now() FROM Prediction_Labels_Staging "
+                         "GROUP BY ImageId, TrainingId "
+                         "ON CONFLICT (ImageId) DO UPDATE SET TrainingId = EXCLUDED.TrainingId, "
+                         "ImageConfidence = EXCLUDED.ImageConfidence, ModifiedDtim = EXCLUDED.ModifiedDtim "
+                         "WHERE Image_Priority.TrainingId <= EXCLUDED.TrainingId")
                 cursor.execute(query)
+                # The staging rows are also dropped on commit, this keeps later calls in the same unit of work clean
+                cursor.execute("TRUNCATE Prediction_Labels_Staging")
                 #TODO: Update some sort of training status table?
                 #self._update_training_status(training_id,conn)
                 conn.commit()
@@ -419,7 +784,7 @@ class ImageTagDataAccess(object):
     def add_training_session(self, training: TrainingSession, user_id: int):
         training_id = -1
         try:
-            conn = self._db_provider.get_connection()
+            conn = self._get_connection()
             try:
                 cursor = conn.cursor()
                 query = ("WITH t AS ( "
@@ -454,37 +819,136 @@ class ImageTagDataAccess(object):
     # In practice we won't be getting multiple class names per bounding box however
     # VOTT supports this. If multple class names per boounding box is common we can get more 
     # efficient with the nesting to avoid dupe bounding boxes per image
-    def get_labels(self):        
-        id_to_imagelabels = {}
-        conn = None
+    def get_labels(self):
+        labels = list(self.iter_labels())
+        logging.debug("Found labels for {0} images".format(len(labels)))
+        return labels
+
+    # Returns the labels of up to page_size images with ids after `after` (and before `before`, when given) in
+    # image id order. Pass the last image id of a page as `after` to get the next one.
+    # With modified_since, only images whose labels may have changed since that watermark are returned, those
+    # with no labels left with an empty label list.
+    def get_labels_page(self, page_size, after=None, before=None, modified_since=None):
+        if type(page_size) is not int or page_size <= 0:
+            raise ArgumentException("page_size must be a positive integer")
+        after = int(after) if after is not None else 0
+        image_labels = []
+        conn = self._get_connection()
         try:
-            conn = self._db_provider.get_connection()
+            cursor = conn.cursor()
             try:
-                cursor = conn.cursor()
-                query = ("SELECT d.imageid, d.imagelocation, d.height, d.width, "
-                         "c.classificationname, x_min, x_max, y_min, y_max "
-                            "FROM Annotated_Labels a "
-                                "inner join classification_info c on a.classificationid = c.classificationid "
-                                "inner join image_info d on d.imageid = a.imageid ")
-                cursor.execute(query)
-                for row in cursor:
-                    image_id = row[0]
-                    tag = Tag(row[4],float(row[5]),float(row[6]),float(row[7]),float(row[8]))
-                    if image_id in id_to_imagelabels:                  
-                        id_to_imagelabels[image_id].labels.append(tag)
-                    else:
-                        img_label = ImageLabel(image_id,row[1],row[2],row[3],[tag])
-                        id_to_imagelabels[image_id] = img_label
-                
-                logging.debug("Found labels for {0} images".format(len(id_to_imagelabels)))       
+                before_args = [int(before)] if before is not None else []
+                if modified_since:
+                    since = modified_since - SYNC_WATERMARK_OVERLAP
+                    before_clause = GET_LABELS_PAGE_BEFORE_CLAUSE if before_args else ""
+                    state_before_clause = GET_CHANGED_LABELS_PAGE_BEFORE_CLAUSE if before_args else ""
+                    query = GET_CHANGED_LABELS_PAGE_QUERY.format(before_clause, state_before_clause)
+                    args = [after] + before_args + [since, after] + before_args + [since, page_size]
+                else:
+                    query = GET_LABELS_PAGE_QUERY.format(GET_LABELS_PAGE_BEFORE_CLAUSE if before_args else "")
+                    args = [after] + before_args + [page_size]
+                cursor.execute(query, tuple(args))
+                image_labels = list(_group_label_rows(cursor.fetchall()))
+                logging.debug("Found labels for {0} images after image id {1}".format(len(image_labels), after))
+            finally:
+                cursor.close()
+        except Exception as e:
+            logging.error("An error occurred getting a page of labels: {0}".format(e))
+            raise
+        finally:
+            conn.close()
+        return image_labels
+
+    # Yields one ImageLabel per labeled image, in image id order. Rows are read through a server side cursor
+    # fetch_size at a time, so memory use is bounded by one fetch rather than the size of the label table.
+    def iter_labels(self, fetch_size=None):
+        fetch_size = int(fetch_size or LABEL_FETCH_SIZE)
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("DECLARE {0} NO SCROLL CURSOR FOR {1} ORDER BY a.imageid".format(
+                    LABEL_CURSOR_NAME, GET_LABELS_QUERY))
+                yield from _group_label_rows(_fetch_forward(cursor, LABEL_CURSOR_NAME, fetch_size))
+                cursor.execute("CLOSE {0}".format(LABEL_CURSOR_NAME))
             finally:
                 cursor.close()
         except Exception as e:
             logging.error("An error occurred getting labels: {0}".format(e))
             raise
         finally:
+            # Returning the connection to the pool rolls back the read transaction, which also drops the
+            # cursor if iteration stopped early
             conn.close()
-        return list(id_to_imagelabels.values())
+
+# Yields the rows of a declared cursor, fetch_size rows per round trip
+def _fetch_forward(cursor, cursor_name, fetch_size):
+    while True:
+        cursor.execute("FETCH FORWARD {0} FROM {1}".format(fetch_size, cursor_name))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield from rows
+
+# Groups label rows ordered by image id into one ImageLabel per image
+def _group_label_rows(rows):
+    image_label = None
+    for row in rows:
+        # Images without labels have a single row with no classification
+        tags = [Tag(row[4],float(row[5]),float(row[6]),float(row[7]),float(row[8]))] if row[4] is not None else []
+        if image_label and image_label.image_id == row[0]:
+            image_label.labels.extend(tags)
+        else:
+            if image_label:
+                yield image_label
+            image_label = ImageLabel(row[0],row[1],row[2],row[3],tags)
+    if image_label:
+        yield image_label
+
+# Streams rows into table_name using COPY FROM STDIN, one statement per chunk_size rows
+def _copy_rows(cursor, table_name, columns, rows, chunk_size=None):
+    chunk_size = chunk_size or COPY_CHUNK_SIZE
+    query = "COPY {0} ({1}) FROM STDIN".format(table_name, ",".join(columns))
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        cursor.execute(query, stream=io.BytesIO(_format_copy_rows(chunk)))
+
+# Encodes rows in the PostgreSQL COPY text format
+def _format_copy_rows(rows):
+    lines = []
+    for row in rows:
+        lines.append("\t".join(_format_copy_value(value) for value in row))
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+def _format_copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                     .replace("\n", "\\n").replace("\r", "\\r"))
+    return str(value)
+
+# Connection handed to data access methods while a unit of work is active. Commit and close are
+# deferred to the unit of work so every call shares one transaction.
+class _UnitOfWorkConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
 
 class ArgumentException(Exception):
     pass
@@ -1,4 +1,4 @@
-from enum import IntEnum, unique
+from enum import Enum, IntEnum, unique
 
 @unique
 class ImageTagState(IntEnum):
@@ -9,13 +9,21 @@ class ImageTagState(IntEnum):
     INCOMPLETE_TAG = 4
     ABANDONED = 5
 
-# An entity class for a VOTT image
+# Order in which checkout serves images, based on the confidence of the latest model predictions
+@unique
+class CheckoutStrategy(Enum):
+    LEAST_CONFIDENT = "least_confident"
+    MOST_CONFIDENT = "most_confident"
+    ANY = "any"
+
+# An entity class for a VOTT image. content_hash is the base64 MD5 of the image, if known.
 class ImageInfo(object):
-    def __init__(self, image_name, image_location, height, width):
+    def __init__(self, image_name, image_location, height, width, content_hash=None):
         self.image_name = image_name
         self.image_location = image_location
         self.height = height
         self.width = width
+        self.content_hash = content_hash
 
 
 # Entity class for Tags stored in DB
@@ -65,6 +73,30 @@ class ImageLabel(object):
         image_label = ImageLabel(dictionary["image_id"], dictionary["imagelocation"], dictionary["image_height"], dictionary["image_width"], tags, dictionary.get("user_folder"))
         return image_label
 
+    # Compact checkout payload: the images and their boxes as parallel arrays rather than an object per image
+    # and box. tags["image"] is an index into the images arrays and tags["class"] an index into classes.
+    # Labels that aren't an ImageTag (images checked out without tags) are left out.
+    @staticmethod
+    def toColumns(image_labels):
+        images = {"id": [], "location": [], "height": [], "width": []}
+        tags = {"image": [], "x_min": [], "x_max": [], "y_min": [], "y_max": [], "class": []}
+        class_indexes = {}
+        for image_index, image_label in enumerate(image_labels):
+            images["id"].append(image_label.image_id)
+            images["location"].append(image_label.imagelocation)
+            images["height"].append(image_label.image_height)
+            images["width"].append(image_label.image_width)
+            for tag in image_label.labels:
+                if not isinstance(tag, ImageTag):
+                    continue
+                tags["image"].append(image_index)
+                tags["x_min"].append(tag.x_min)
+                tags["x_max"].append(tag.x_max)
+                tags["y_min"].append(tag.y_min)
+                tags["y_max"].append(tag.y_max)
+                tags["class"].append(class_indexes.setdefault(tag.classification_names, len(class_indexes)))
+        return {"images": images, "tags": tags, "classes": list(class_indexes)}
+
 
 class Tag(object):
     def __init__(self,classificationname, x_min: float, x_max: float, y_min: float, y_max: float):
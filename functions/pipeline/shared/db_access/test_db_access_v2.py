@@ -1,12 +1,20 @@
 import unittest
+import datetime
 from unittest.mock import patch 
 from unittest.mock import Mock
+from unittest.mock import MagicMock
 
 from .db_access_v2 import(
     ImageTagDataAccess,
     ArgumentException,
     ImageTagState,
-    generate_test_image_infos
+    CheckoutStrategy,
+    PredictionLabel,
+    AnnotatedLabel,
+    generate_test_image_infos,
+    _format_copy_rows,
+    SYNC_WATERMARK_OVERLAP,
+    ONBOARDING_COPY_WINDOW
 #    _update_images,
 #    create_user,
 #    get_image_ids_for_new_images,
@@ -34,6 +42,15 @@ class MockConnection:
     def cursor(self):
         return self._mock_cursor()
 
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
 class MockDBProvider:
     def __init__(self, fail = False):
         self.fail = fail
@@ -43,6 +60,390 @@ class MockDBProvider:
             raise Exception 
         return MockConnection() 
 
+class CountingDBProvider:
+    def __init__(self, cursor=None):
+        self.connections = []
+        self.cursor = cursor
+
+    def get_connection(self):
+        conn = Mock()
+        if self.cursor:
+            conn.cursor.return_value = self.cursor
+        conn.cursor.return_value.fetchone.return_value = (1, "A")
+        self.connections.append(conn)
+        return conn
+
+class TestUnitOfWork(unittest.TestCase):
+    def test_unit_of_work_shares_one_connection_and_commit(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        with data_access.unit_of_work():
+            data_access.create_user('MyUserName')
+            data_access.update_incomplete_images([1, 2], 1)
+            data_access.update_completed_untagged_images([3], 1)
+        self.assertEqual(1, len(provider.connections))
+        conn = provider.connections[0]
+        self.assertEqual(1, conn.commit.call_count)
+        conn.rollback.assert_not_called()
+        conn.close.assert_called_once_with()
+
+    def test_unit_of_work_rolls_back_on_error(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        with self.assertRaises(TypeError):
+            with data_access.unit_of_work():
+                data_access.create_user('MyUserName')
+                data_access.update_incomplete_images([1], "I should be an integer")
+        conn = provider.connections[0]
+        conn.commit.assert_not_called()
+        conn.rollback.assert_called_once_with()
+        conn.close.assert_called_once_with()
+
+    def test_nested_unit_of_work_joins_outer(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        with data_access.unit_of_work():
+            with data_access.unit_of_work():
+                data_access.create_user('MyUserName')
+            data_access.create_user('MyUserName')
+        self.assertEqual(1, len(provider.connections))
+        self.assertEqual(1, provider.connections[0].commit.call_count)
+
+    def test_calls_outside_unit_of_work_commit_individually(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        data_access.create_user('MyUserName')
+        data_access.create_user('MyUserName')
+        self.assertEqual(2, len(provider.connections))
+
+class TestBulkCopy(unittest.TestCase):
+    def test_format_copy_rows(self):
+        copy_data = _format_copy_rows([(1, 2.5, None), (2, "tab\there", "back\\slash\n")])
+        self.assertEqual(b"1\t2.5\t\\N\n2\ttab\\there\tback\\\\slash\\n\n", copy_data)
+
+    def test_add_prediction_labels_streams_chunks(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        labels = [PredictionLabel(1, i, 2, 10, 20, 30, 40, 100, 100, 0.9, 0.8) for i in range(5)]
+        with patch('functions.pipeline.shared.db_access.db_access_v2.COPY_CHUNK_SIZE', 2):
+            data_access.add_prediction_labels(labels, 1)
+        cursor = provider.connections[0].cursor.return_value
+        copy_calls = [c for c in cursor.execute.call_args_list if c[0][0].startswith("COPY")]
+        self.assertEqual(3, len(copy_calls))
+        streamed = b"".join(c[1]["stream"].getvalue() for c in copy_calls)
+        self.assertEqual(5, streamed.count(b"\n"))
+        self.assertTrue(any("ON CONFLICT" in c[0][0] for c in cursor.execute.call_args_list))
+
+    def test_update_tagged_images_copies_labels(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        labels = [AnnotatedLabel(7, 2, 10, 20, 30, 40)]
+        data_access.update_tagged_images_v2(labels, 3)
+        cursor = provider.connections[0].cursor.return_value
+        delete_call, copy_call = cursor.execute.call_args_list[:2]
+        self.assertTrue(delete_call[0][0].startswith("DELETE FROM Annotated_Labels"))
+        self.assertEqual(([7],), delete_call[0][1])
+        self.assertTrue(copy_call[0][0].startswith("COPY Annotated_Labels"))
+        self.assertEqual(b"7\t2\t10\t20\t30\t40\t3\n", copy_call[1]["stream"].getvalue())
+
+    def test_update_incomplete_images_replaces_labels(self):
+        provider = CountingDBProvider()
+        data_access = ImageTagDataAccess(provider)
+        data_access.update_incomplete_images([7], 3, [AnnotatedLabel(7, 2, 10, 20, 30, 40),
+                                                      AnnotatedLabel(7, 2, 50, 60, 70, 80)])
+        # Submitted again with one of the two labels removed
+        data_access.update_incomplete_images([7], 3, [AnnotatedLabel(7, 2, 10, 20, 30, 40)])
+        cursor = provider.connections[1].cursor.return_value
+        delete_call, copy_call, update_call = cursor.execute.call_args_list[:3]
+        self.assertTrue(delete_call[0][0].startswith("DELETE FROM Annotated_Labels"))
+        self.assertEqual(([7],), delete_call[0][1])
+        self.assertEqual(b"7\t2\t10\t20\t30\t40\t3\n", copy_call[1]["stream"].getvalue())
+        self.assertEqual((int(ImageTagState.INCOMPLETE_TAG), 3, [7]), update_call[0][1])
+        provider.connections[1].commit.assert_called_with()
+
+    def test_update_incomplete_images_without_labels_clears_them(self):
+        provider = CountingDBProvider()
+        ImageTagDataAccess(provider).update_incomplete_images([7, 8], 3)
+        cursor = provider.connections[0].cursor.return_value
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertTrue(queries[0].startswith("DELETE FROM Annotated_Labels"))
+        self.assertFalse(any(query.startswith("COPY") for query in queries))
+
+class TestAddNewImages(unittest.TestCase):
+    def test_add_new_images_inserts_in_batches(self):
+        cursor = Mock()
+        cursor.fetchall.side_effect = [[(1, "url0"), (2, "url1")], [(3, "url2")]]
+        provider = CountingDBProvider(cursor)
+        image_infos = generate_test_image_infos(3)
+        for i, img in enumerate(image_infos):
+            img.image_location = "url{0}".format(i)
+        with patch('functions.pipeline.shared.db_access.db_access_v2.IMAGE_INSERT_BATCH_SIZE', 2):
+            url_to_image_id = ImageTagDataAccess(provider).add_new_images(image_infos, 5)
+        self.assertEqual({"url0": 1, "url1": 2, "url2": 3}, url_to_image_id)
+        self.assertEqual(2, cursor.execute.call_count)
+        first_batch_args = cursor.execute.call_args_list[0][0][1]
+        self.assertEqual(5, first_batch_args[0])
+        self.assertEqual(["url0", "url1"], first_batch_args[2])
+        self.assertEqual(1, provider.connections[0].commit.call_count)
+
+    def test_add_new_images_skips_known_content(self):
+        cursor = Mock()
+        cursor.fetchall.side_effect = [[(1, "url0")]]
+        provider = CountingDBProvider(cursor)
+        image_infos = generate_test_image_infos(2)
+        for i, img in enumerate(image_infos):
+            img.image_location = "url{0}".format(i)
+            img.content_hash = "hash{0}".format(i)
+        url_to_image_id = ImageTagDataAccess(provider).add_new_images(image_infos, 5)
+        self.assertEqual({"url0": 1}, url_to_image_id)
+        query, args = cursor.execute.call_args[0]
+        self.assertNotIn("ON CONFLICT", query)
+        self.assertIn("AND (s.TagStateId <> %s OR s.ModifiedDtim > now() - %s)", query)
+        self.assertEqual(["hash0", "hash1"], args[5])
+        self.assertEqual(int(ImageTagState.NOT_READY), args[6])
+        self.assertEqual(ONBOARDING_COPY_WINDOW, args[7])
+
+    def test_add_new_images_inserts_one_image_per_content_hash(self):
+        cursor = Mock()
+        cursor.fetchall.side_effect = [[(1, "url0"), (3, "url2")]]
+        provider = CountingDBProvider(cursor)
+        image_infos = generate_test_image_infos(3)
+        for i, img in enumerate(image_infos):
+            img.image_location = "url{0}".format(i)
+        image_infos[0].content_hash = image_infos[1].content_hash = "hash0"
+        url_to_image_id = ImageTagDataAccess(provider).add_new_images(image_infos, 5)
+        self.assertEqual({"url0": 1, "url2": 3}, url_to_image_id)
+        lock_query, lock_args = cursor.execute.call_args_list[0][0]
+        self.assertIn("pg_advisory_xact_lock(hashtext(h))", lock_query)
+        self.assertEqual((["hash0"],), lock_args)
+        insert_query, insert_args = cursor.execute.call_args_list[1][0]
+        self.assertIn("DISTINCT ON (t.c, CASE WHEN t.c IS NULL THEN t.o END)", insert_query)
+        self.assertEqual(["hash0", "hash0", None], insert_args[5])
+        self.assertEqual(1, provider.connections[0].commit.call_count)
+
+class TestUpdateImageUrls(unittest.TestCase):
+    def test_update_image_urls_is_set_based(self):
+        provider = CountingDBProvider()
+        ImageTagDataAccess(provider).update_image_urls({1: "https://a/1.jpg", 2: "https://a/2.jpg"}, 3)
+        self.assertEqual(1, len(provider.connections))
+        conn = provider.connections[0]
+        execute_calls = conn.cursor.return_value.execute.call_args_list
+        self.assertEqual(2, len(execute_calls))
+        self.assertEqual(([1, 2], ["https://a/1.jpg", "https://a/2.jpg"]), execute_calls[0][0][1])
+        self.assertEqual((int(ImageTagState.READY_TO_TAG), 3, [1, 2]), execute_calls[1][0][1])
+        self.assertEqual(1, conn.commit.call_count)
+
+class TestGetImagesByTagStatus(unittest.TestCase):
+    def test_tag_states_and_limit_are_parameters(self):
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter([(1, "https://a/1.jpg", 1)])
+        provider = CountingDBProvider(cursor)
+        images = ImageTagDataAccess(provider).get_images_by_tag_status(["1", "4"], "10")
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("ANY(%s::int[])", query)
+        self.assertEqual(([1, 4], 10), params)
+        self.assertEqual({1: "https://a/1.jpg"}, images)
+
+    def test_modified_since_filters_on_state_changes(self):
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter([])
+        provider = CountingDBProvider(cursor)
+        watermark = datetime.datetime(2018, 11, 1, 12, 0, 0)
+        ImageTagDataAccess(provider).get_images_by_tag_status(["1"], modified_since=watermark)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("a.ModifiedDtim > %s ORDER BY", query)
+        self.assertEqual(([1], watermark - SYNC_WATERMARK_OVERLAP), params)
+
+    def test_rejects_non_integer_tag_states(self):
+        provider = CountingDBProvider(MagicMock())
+        with self.assertRaises(ValueError):
+            ImageTagDataAccess(provider).get_images_by_tag_status(["1; DROP TABLE Image_Info"])
+
+class TestOnboardingJob(unittest.TestCase):
+    def test_update_only_increments_counters(self):
+        cursor = MagicMock()
+        provider = CountingDBProvider(cursor)
+        ImageTagDataAccess(provider).update_onboarding_job(3, pages_listed=1, blobs_listed=10, images_queued=8,
+                                                           listing_complete=True)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("PagesListed = PagesListed + %s", query)
+        self.assertIn("ListingComplete = ListingComplete OR %s", query)
+        self.assertEqual((1, 10, 8, 0, 0, 0, True, 3), params)
+        provider.connections[0].commit.assert_called_once()
+
+    def test_page_update_is_applied_once(self):
+        cursor = MagicMock()
+        cursor.fetchone.side_effect = [(3,), None]
+        data_access = ImageTagDataAccess(CountingDBProvider(cursor))
+        self.assertTrue(data_access.update_onboarding_job(3, pages_listed=1, images_queued=8, page_marker="m2"))
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("ListedMarkers = array_append(ListedMarkers, %s)", query)
+        self.assertIn("AND NOT (%s = ANY(ListedMarkers))", query)
+        self.assertEqual((1, 0, 8, 0, 0, 0, False, "m2", 3, "m2"), params)
+        self.assertFalse(data_access.update_onboarding_job(3, pages_listed=1, images_queued=8, page_marker="m2"))
+
+    def test_is_onboarding_page_listed(self):
+        cursor = MagicMock()
+        cursor.fetchone.side_effect = [(True,), (False,), None]
+        data_access = ImageTagDataAccess(CountingDBProvider(cursor))
+        self.assertTrue(data_access.is_onboarding_page_listed(3, ""))
+        self.assertEqual(("", 3), cursor.execute.call_args[0][1])
+        self.assertFalse(data_access.is_onboarding_page_listed(3, "m2"))
+        self.assertFalse(data_access.is_onboarding_page_listed(4, "m2"))
+
+    def test_get_missing_job(self):
+        cursor = MagicMock()
+        cursor.fetchone.side_effect = [None]
+        self.assertIsNone(ImageTagDataAccess(CountingDBProvider(cursor)).get_onboarding_job("3"))
+
+    def test_get_job_progress(self):
+        cursor = MagicMock()
+        created = datetime.datetime(2018, 11, 1, 12, 0, 0)
+        cursor.fetchone.side_effect = [(3, "account", "container", None, 2, 2000, 1500, 1200, 6, 4, False,
+                                         created, created)]
+        job = ImageTagDataAccess(CountingDBProvider(cursor)).get_onboarding_job(3)
+        self.assertEqual(1200, job["imagesOnboarded"])
+        self.assertFalse(job["listingComplete"])
+        self.assertEqual("2018-11-01T12:00:00", job["created"])
+
+class TestIterLabels(unittest.TestCase):
+    def test_groups_rows_across_fetches(self):
+        cursor = MagicMock()
+        cursor.fetchall.side_effect = [
+            [(1, "https://a/1.jpg", 100, 200, "knot", 1, 2, 3, 4),
+             (1, "https://a/1.jpg", 100, 200, "defect", 5, 6, 7, 8)],
+            [(1, "https://a/1.jpg", 100, 200, "knot", 9, 10, 11, 12),
+             (2, "https://a/2.jpg", 300, 400, "knot", 1, 2, 3, 4)],
+            []
+        ]
+        provider = CountingDBProvider(cursor)
+        labels = list(ImageTagDataAccess(provider).iter_labels(fetch_size=2))
+        self.assertEqual([1, 2], [label.image_id for label in labels])
+        self.assertEqual(3, len(labels[0].labels))
+        self.assertEqual(1, len(labels[1].labels))
+        queries = [call[0][0] for call in cursor.execute.call_args_list]
+        self.assertTrue(queries[0].startswith("DECLARE labels_cursor"))
+        self.assertIn("ORDER BY a.imageid", queries[0])
+        self.assertEqual(["FETCH FORWARD 2 FROM labels_cursor"] * 3, queries[1:4])
+        self.assertEqual("CLOSE labels_cursor", queries[-1])
+        provider.connections[0].close.assert_called_once_with()
+
+    def test_stopping_early_returns_connection(self):
+        cursor = MagicMock()
+        cursor.fetchall.side_effect = [[(1, "https://a/1.jpg", 100, 200, "knot", 1, 2, 3, 4),
+                                        (2, "https://a/2.jpg", 100, 200, "knot", 1, 2, 3, 4)], []]
+        provider = CountingDBProvider(cursor)
+        labels = ImageTagDataAccess(provider).iter_labels()
+        self.assertEqual(1, next(labels).image_id)
+        labels.close()
+        provider.connections[0].close.assert_called_once_with()
+
+class TestGetLabelsPage(unittest.TestCase):
+    def test_page_is_bounded_by_image_ids(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(5, "https://a/5.jpg", 100, 200, "knot", 1, 2, 3, 4),
+                                        (5, "https://a/5.jpg", 100, 200, "knot", 5, 6, 7, 8)]
+        provider = CountingDBProvider(cursor)
+        labels = ImageTagDataAccess(provider).get_labels_page(2, after="4", before=10)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("a.imageid > %s AND a.imageid < %s", query)
+        self.assertEqual((4, 10, 2), params)
+        self.assertEqual([5], [label.image_id for label in labels])
+        self.assertEqual(2, len(labels[0].labels))
+
+    def test_first_page_starts_at_the_beginning(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = []
+        provider = CountingDBProvider(cursor)
+        self.assertEqual([], ImageTagDataAccess(provider).get_labels_page(10))
+        query, params = cursor.execute.call_args[0]
+        self.assertNotIn("a.imageid < %s", query)
+        self.assertEqual((0, 10), params)
+
+    def test_modified_since_reads_back_the_overlap(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = []
+        provider = CountingDBProvider(cursor)
+        watermark = datetime.datetime(2018, 11, 1, 12, 0, 0)
+        ImageTagDataAccess(provider).get_labels_page(10, modified_since=watermark)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("a.CreatedDtim > %s", query)
+        self.assertIn("s.ModifiedDtim > %s", query)
+        since = watermark - SYNC_WATERMARK_OVERLAP
+        self.assertEqual((0, since, 0, since, 10), params)
+
+    def test_modified_since_returns_images_without_labels(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(3, "https://a/3.jpg", 100, 200, None, None, None, None, None),
+                                        (5, "https://a/5.jpg", 100, 200, "knot", 1, 2, 3, 4)]
+        provider = CountingDBProvider(cursor)
+        watermark = datetime.datetime(2018, 11, 1, 12, 0, 0)
+        labels = ImageTagDataAccess(provider).get_labels_page(10, after=2, before=8, modified_since=watermark)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("a.imageid < %s", query)
+        self.assertIn("s.imageid < %s", query)
+        since = watermark - SYNC_WATERMARK_OVERLAP
+        self.assertEqual((2, 8, since, 2, 8, since, 10), params)
+        self.assertEqual([3, 5], [label.image_id for label in labels])
+        self.assertEqual([0, 1], [len(label.labels) for label in labels])
+
+    def test_page_size_must_be_positive(self):
+        with self.assertRaises(ArgumentException):
+            ImageTagDataAccess(CountingDBProvider()).get_labels_page(0)
+
+class TestCheckoutImages(unittest.TestCase):
+    def test_checkout_claims_and_updates_in_one_statement(self):
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter([
+            (1, "https://a/1.jpg", 2, "knot", 10, 20, 30, 40, 100, 200, 0.9, 0.5),
+            (1, "https://a/1.jpg", 2, "knot", 50, 60, 70, 80, 100, 200, 0.8, 0.5),
+            (2, "https://a/2.jpg", None, None, None, None, None, None, 300, 400, None, None)
+        ])
+        provider = CountingDBProvider(cursor)
+        image_labels = ImageTagDataAccess(provider).checkout_images(5, 3, CheckoutStrategy.ANY)
+        self.assertEqual(1, cursor.execute.call_count)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn("FOR UPDATE OF s SKIP LOCKED", query)
+        self.assertIn("COALESCE(c.trainingid, (SELECT MAX(trainingid) FROM training_info))", query)
+        self.assertEqual((int(ImageTagState.READY_TO_TAG), int(ImageTagState.INCOMPLETE_TAG), 5,
+                          int(ImageTagState.TAG_IN_PROGRESS), 3), params)
+        self.assertEqual(1, provider.connections[0].commit.call_count)
+        self.assertEqual([1, 2], [label.image_id for label in image_labels])
+        self.assertEqual(2, len(image_labels[0].labels))
+        self.assertEqual(300, image_labels[1].image_height)
+
+    def test_checkout_serves_scored_images_first(self):
+        cursor = MagicMock()
+        cursor.__iter__.side_effect = [
+            iter([(1, "https://a/1.jpg", 2, "knot", 10, 20, 30, 40, 100, 200, 0.9, 0.1)]),
+            iter([(2, "https://a/2.jpg", None, None, None, None, None, None, 300, 400, None, None)])
+        ]
+        provider = CountingDBProvider(cursor)
+        image_labels = ImageTagDataAccess(provider).checkout_images(2, 3, "least_confident")
+        priority_query, priority_params = cursor.execute.call_args_list[0][0]
+        fill_query, fill_params = cursor.execute.call_args_list[1][0]
+        self.assertIn("ORDER BY p.imageconfidence ASC", priority_query)
+        self.assertEqual(2, priority_params[2])
+        self.assertNotIn("ORDER BY", fill_query)
+        self.assertEqual(1, fill_params[2])
+        self.assertEqual([1, 2], [label.image_id for label in image_labels])
+        self.assertEqual(1, provider.connections[0].commit.call_count)
+
+    def test_checkout_skips_fill_when_enough_scored_images(self):
+        cursor = MagicMock()
+        cursor.__iter__.return_value = iter([(1, "https://a/1.jpg", 2, "knot", 10, 20, 30, 40, 100, 200, 0.9, 0.9)])
+        ImageTagDataAccess(CountingDBProvider(cursor)).checkout_images(1, 3, CheckoutStrategy.MOST_CONFIDENT)
+        self.assertEqual(1, cursor.execute.call_count)
+        self.assertIn("ORDER BY p.imageconfidence DESC", cursor.execute.call_args[0][0])
+
+    def test_checkout_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            ImageTagDataAccess(CountingDBProvider()).checkout_images(5, 3, "newest")
+
+    def test_checkout_user_id_type_error(self):
+        with self.assertRaises(TypeError):
+            ImageTagDataAccess(CountingDBProvider()).checkout_images(5, "I should be an integer")
+
 class TestImageTagDataAccess(unittest.TestCase):
     def test_connection(self):
         print("Running...")
@@ -0,0 +1,93 @@
+import os
+import json
+import unittest
+
+from ..db_provider import DatabaseInfo, PostGresProvider
+from .db_access_v2 import (
+    CHECKOUT_QUERY,
+    CHECKOUT_CLAIM_BY_PRIORITY_QUERY,
+    CHECKOUT_CLAIM_ANY_QUERY,
+    GET_LABELS_QUERY,
+    GET_LABELS_PAGE_QUERY,
+    GET_LABELS_PAGE_BEFORE_CLAUSE,
+    GET_IMAGES_BY_TAG_STATUS_QUERY
+)
+from .models import ImageTagState
+
+DB_ENV_VARS = ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASS")
+
+
+# Plan regression tests for the hot query paths. These need a database installed (and migrated) with
+# db/install-db-resources.py and are skipped unless the DB_* environment variables are set. Sequential
+# scans are disabled so the planner picks an index whenever a usable one exists, regardless of table size.
+@unittest.skipUnless(all(os.getenv(v) for v in DB_ENV_VARS), "Requires DB_HOST, DB_NAME, DB_USER and DB_PASS")
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        db_config = DatabaseInfo(os.getenv("DB_HOST"), os.getenv("DB_NAME"), os.getenv("DB_USER"), os.getenv("DB_PASS"))
+        self.conn = PostGresProvider(db_config).get_connection()
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def tearDown(self):
+        # EXPLAIN without ANALYZE does not run the statements, rolling back just resets the setting
+        self.conn.rollback()
+        self.conn.close()
+
+    def explain(self, query, args=None):
+        self.cursor.execute("EXPLAIN (FORMAT JSON) " + query, args)
+        plan = self.cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return list(_walk_plan(plan[0]["Plan"]))
+
+    def checkout_args(self):
+        return (int(ImageTagState.READY_TO_TAG), int(ImageTagState.INCOMPLETE_TAG), 10,
+                int(ImageTagState.TAG_IN_PROGRESS), 1)
+
+    def assert_uses_index(self, nodes, index_name):
+        self.assertIn(index_name, set(n.get("Index Name") for n in nodes))
+
+    def assert_no_seq_scan(self, nodes, relation_name):
+        seq_scans = set(n.get("Relation Name") for n in nodes if n["Node Type"] == "Seq Scan")
+        self.assertNotIn(relation_name, seq_scans)
+
+    def test_checkout_by_priority(self):
+        claim_query = CHECKOUT_CLAIM_BY_PRIORITY_QUERY.format("ASC")
+        nodes = self.explain(CHECKOUT_QUERY.format(claim_query), self.checkout_args())
+        self.assert_uses_index(nodes, "image_priority_confidence_idx")
+        self.assert_uses_index(nodes, "image_tagging_state_pk")
+        self.assert_no_seq_scan(nodes, "image_tagging_state")
+        self.assert_no_seq_scan(nodes, "prediction_labels")
+
+    def test_checkout_any(self):
+        nodes = self.explain(CHECKOUT_QUERY.format(CHECKOUT_CLAIM_ANY_QUERY), self.checkout_args())
+        self.assert_uses_index(nodes, "image_tagging_state_state_created_idx")
+        self.assert_uses_index(nodes, "image_tagging_state_pk")
+        self.assert_no_seq_scan(nodes, "image_tagging_state")
+
+    def test_get_labels(self):
+        nodes = self.explain(GET_LABELS_QUERY)
+        self.assert_no_seq_scan(nodes, "annotated_labels")
+        self.assert_no_seq_scan(nodes, "image_info")
+
+    def test_get_labels_page(self):
+        nodes = self.explain(GET_LABELS_PAGE_QUERY.format(GET_LABELS_PAGE_BEFORE_CLAUSE), (100, 200, 50))
+        self.assert_uses_index(nodes, "annotated_labels_pkey")
+        self.assert_no_seq_scan(nodes, "annotated_labels")
+        self.assert_no_seq_scan(nodes, "image_info")
+
+    def test_get_images_by_tag_status(self):
+        nodes = self.explain(GET_IMAGES_BY_TAG_STATUS_QUERY.format("") + " LIMIT %s",
+                             ([int(ImageTagState.READY_TO_TAG), int(ImageTagState.INCOMPLETE_TAG)], 10))
+        self.assert_uses_index(nodes, "image_tagging_state_state_created_idx")
+        self.assert_no_seq_scan(nodes, "image_tagging_state")
+
+
+def _walk_plan(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk_plan(child)
+
+
+if __name__ == '__main__':
+    unittest.main()
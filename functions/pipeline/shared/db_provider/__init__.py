@@ -1 +1 @@
-from .db_provider import DatabaseInfo, DBProvider, PostGresProvider, get_postgres_provider
+from .db_provider import DatabaseInfo, DBProvider, PostGresProvider, get_postgres_provider, ConnectionPool, PooledConnection, PoolTimeoutError, get_connection_pool
\ No newline at end of file
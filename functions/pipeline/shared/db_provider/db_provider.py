@@ -1,5 +1,8 @@
-import pg8000
 import os
+import time
+import logging
+import threading
+from collections import deque
 
 # import pyodbc
 
@@ -9,8 +12,37 @@ default_db_name = ""
 default_db_user = ""
 default_db_pass = ""
 
+# Pool sizing. A function host runs a handful of concurrent invocations per worker, so the pool is small
+# and connections are kept warm across invocations rather than opened per data access call.
+DEFAULT_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 5))
+DEFAULT_POOL_MAX_IDLE_SECONDS = float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', 300))
+DEFAULT_POOL_WAIT_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_WAIT_TIMEOUT_SECONDS', 30))
+# Connections idle for longer than this are pinged before being handed out again
+DEFAULT_POOL_HEALTH_CHECK_SECONDS = float(os.getenv('DB_POOL_HEALTH_CHECK_SECONDS', 30))
+
+# Pools and providers are module level so they survive across warm Azure Function invocations
+_pools = {}
+_pools_lock = threading.Lock()
+_providers = {}
+
+
 def get_postgres_provider():
-    return PostGresProvider(__get_database_info_from_env())
+    database_info = __get_database_info_from_env()
+    key = (database_info.db_host_name, database_info.db_name, database_info.db_user_name, database_info.db_password)
+    provider = _providers.get(key)
+    if provider is None:
+        provider = _providers.setdefault(key, PostGresProvider(database_info))
+    return provider
+
+
+def get_connection_pool(database_info):
+    key = (database_info.db_host_name, database_info.db_name, database_info.db_user_name, database_info.db_password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(lambda: _new_postgres_connection(database_info))
+            _pools[key] = pool
+        return pool
 
 
 def __get_database_info_from_env():
@@ -18,6 +50,14 @@ def __get_database_info_from_env():
                         os.getenv('DB_USER', default_db_user), os.getenv('DB_PASS', default_db_pass))
 
 
+def _new_postgres_connection(database_info):
+    # pg8000 is slow to import, so it is imported when the first connection is opened rather than on a cold start
+    import pg8000
+    return pg8000.connect(database_info.db_user_name, host=database_info.db_host_name, unix_sock=None, port=5432,
+                          database=database_info.db_name, password=database_info.db_password,
+                          ssl=True, timeout=None, application_name=None)
+
+
 class DatabaseInfo(object):
     def __init__(self, db_host_name, db_name, db_user_name, db_password):
         self.db_host_name = db_host_name
@@ -26,6 +66,199 @@ class DatabaseInfo(object):
         self.db_password = db_password
 
 
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PoolMetrics(object):
+    def __init__(self):
+        self.acquired = 0
+        self.created = 0
+        self.waits = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.evicted = 0
+        self.discarded = 0
+        self.health_check_failures = 0
+
+    def record_acquire(self, wait_seconds, waited):
+        self.acquired += 1
+        if waited:
+            self.waits += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+# Bounded, thread safe pool of database connections. Connections handed out are wrapped in a
+# PooledConnection whose close() returns the connection to the pool instead of closing it, so callers
+# keep the usual get_connection()/close() pattern.
+class ConnectionPool(object):
+    def __init__(self, connection_factory, max_size=DEFAULT_POOL_MAX_SIZE,
+                 max_idle_seconds=DEFAULT_POOL_MAX_IDLE_SECONDS,
+                 wait_timeout_seconds=DEFAULT_POOL_WAIT_TIMEOUT_SECONDS,
+                 health_check_seconds=DEFAULT_POOL_HEALTH_CHECK_SECONDS):
+        if max_size <= 0:
+            raise ValueError("Pool max_size must be greater than zero")
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.health_check_seconds = health_check_seconds
+        self.metrics = PoolMetrics()
+        self._connection_factory = connection_factory
+        # Idle connections as (connection, released_at). Oldest on the left, most recently used on the right.
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.wait_timeout_seconds
+        waited = False
+        connection = None
+        released_at = None
+        with self._condition:
+            stale = self._evict_idle()
+            while True:
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.metrics.timeouts += 1
+                    raise PoolTimeoutError("Timed out after {0}s waiting for a database connection".format(
+                        self.wait_timeout_seconds))
+                waited = True
+                self._condition.wait(remaining)
+            self.metrics.record_acquire(time.monotonic() - start, waited)
+        # Closing involves network I/O, so it happens outside the lock
+        _close_quietly(stale)
+
+        if connection is not None and time.monotonic() - released_at > self.health_check_seconds:
+            if not self._is_healthy(connection):
+                logging.warning("Discarding unhealthy pooled database connection")
+                with self._condition:
+                    self.metrics.health_check_failures += 1
+                _close_quietly([connection])
+                connection = None
+
+        if connection is None:
+            try:
+                connection = self._connection_factory()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self.metrics.created += 1
+        return PooledConnection(self, connection)
+
+    def release(self, connection, discard=False):
+        if not discard:
+            try:
+                # Never hand out a connection with an open (or aborted) transaction
+                connection.rollback()
+            except Exception as e:
+                logging.warning("Discarding database connection that failed to reset: {0}".format(e))
+                discard = True
+        with self._condition:
+            if discard:
+                self._size -= 1
+                self.metrics.discarded += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        if discard:
+            _close_quietly([connection])
+
+    def close(self):
+        with self._condition:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        _close_quietly(idle)
+
+    def stats(self):
+        with self._condition:
+            stats = self.metrics.as_dict()
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["max_size"] = self.max_size
+        return stats
+
+    # Must be called holding the lock. Returns the connections removed from the pool for the caller to close.
+    def _evict_idle(self):
+        stale = []
+        cutoff = time.monotonic() - self.max_idle_seconds
+        while self._idle and self._idle[0][1] < cutoff:
+            connection, _ = self._idle.popleft()
+            stale.append(connection)
+        if stale:
+            self._size -= len(stale)
+            self.metrics.evicted += len(stale)
+        return stale
+
+    @staticmethod
+    def _is_healthy(connection):
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            finally:
+                cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+
+class PooledConnection(object):
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def cursor(self):
+        return self.__get_connection().cursor()
+
+    def commit(self):
+        self.__get_connection().commit()
+
+    def rollback(self):
+        self.__get_connection().rollback()
+
+    def close(self):
+        # Returns the connection to the pool. Safe to call more than once.
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def __get_connection(self):
+        if self._connection is None:
+            import pg8000
+            raise pg8000.InterfaceError("connection is closed")
+        return self._connection
+
+    def __getattr__(self, name):
+        return getattr(self.__get_connection(), name)
+
+
+def _close_quietly(connections):
+    for connection in connections:
+        try:
+            connection.close()
+        except Exception as e:
+            logging.debug("Error closing database connection: {0}".format(e))
+
+
 class DBProvider(object):
     def __new_connection(self, host_name, db_name, db_user, db_pass): pass
 
@@ -38,17 +271,13 @@ class DBProvider(object):
 
 class PostGresProvider(DBProvider):
 
-    def __init__(self, database_info):
+    def __init__(self, database_info, pool=None):
         self.database_info = database_info
-
-    def __new_connection(self, host_name, db_name, db_user, db_pass):
-        return pg8000.connect(db_user, host=host_name, unix_sock=None, port=5432, database=db_name, password=db_pass,
-                              ssl=True, timeout=None, application_name=None)
+        self.pool = pool if pool else get_connection_pool(database_info)
 
     def get_connection(self):
-        # self.connection =
-        return self.__new_connection(self.database_info.db_host_name, self.database_info.db_name,
-                                     self.database_info.db_user_name, self.database_info.db_password)
+        # Connections come from the shared pool. Closing them returns them to the pool.
+        return self.pool.acquire()
 
 
 '''
@@ -62,4 +291,4 @@ class MSSqlProvider(DBProvider):
 
     def get_connection(self):
         return self.__new_connection(self.database_info.db_host_name,self.database_info.db_name,self.database_info.db_user_name,self.database_info.db_password)
-'''
\ No newline at end of file
+'''
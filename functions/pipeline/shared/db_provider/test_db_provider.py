@@ -0,0 +1,128 @@
+import time
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from .db_provider import (
+    ConnectionPool,
+    PoolTimeoutError,
+    PostGresProvider,
+    DatabaseInfo,
+    get_postgres_provider
+)
+
+
+class MockConnectionFactory:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.connections = []
+
+    def __call__(self):
+        conn = Mock()
+        if not self.healthy:
+            conn.cursor.return_value.execute.side_effect = Exception("connection reset")
+        self.connections.append(conn)
+        return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_close_returns_connection_to_pool(self):
+        factory = MockConnectionFactory()
+        pool = ConnectionPool(factory, max_size=2)
+        conn = pool.acquire()
+        conn.close()
+        conn = pool.acquire()
+        conn.close()
+        self.assertEqual(1, len(factory.connections))
+        self.assertEqual(1, pool.stats()["idle"])
+        factory.connections[0].close.assert_not_called()
+
+    def test_close_twice_releases_once(self):
+        pool = ConnectionPool(MockConnectionFactory(), max_size=2)
+        conn = pool.acquire()
+        conn.close()
+        conn.close()
+        self.assertEqual(1, pool.stats()["idle"])
+
+    def test_release_rolls_back_open_transaction(self):
+        factory = MockConnectionFactory()
+        pool = ConnectionPool(factory, max_size=1)
+        pool.acquire().close()
+        factory.connections[0].rollback.assert_called_once_with()
+
+    def test_failed_reset_discards_connection(self):
+        factory = MockConnectionFactory()
+        pool = ConnectionPool(factory, max_size=1)
+        conn = pool.acquire()
+        factory.connections[0].rollback.side_effect = Exception("broken pipe")
+        conn.close()
+        stats = pool.stats()
+        self.assertEqual(0, stats["size"])
+        self.assertEqual(1, stats["discarded"])
+        factory.connections[0].close.assert_called_once_with()
+
+    def test_acquire_times_out_when_exhausted(self):
+        pool = ConnectionPool(MockConnectionFactory(), max_size=1, wait_timeout_seconds=0.05)
+        pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+        self.assertEqual(1, pool.stats()["timeouts"])
+
+    def test_waiter_receives_released_connection(self):
+        factory = MockConnectionFactory()
+        pool = ConnectionPool(factory, max_size=1, wait_timeout_seconds=5)
+        conn = pool.acquire()
+        timer = threading.Timer(0.05, conn.close)
+        timer.start()
+        pool.acquire().close()
+        timer.join()
+        stats = pool.stats()
+        self.assertEqual(1, len(factory.connections))
+        self.assertEqual(1, stats["waits"])
+        self.assertGreater(stats["max_wait_seconds"], 0)
+
+    def test_idle_connections_are_evicted(self):
+        factory = MockConnectionFactory()
+        pool = ConnectionPool(factory, max_size=2, max_idle_seconds=0.01)
+        pool.acquire().close()
+        time.sleep(0.05)
+        pool.acquire().close()
+        self.assertEqual(2, len(factory.connections))
+        self.assertEqual(1, pool.stats()["evicted"])
+        factory.connections[0].close.assert_called_once_with()
+
+    def test_unhealthy_connection_is_replaced(self):
+        factory = MockConnectionFactory(healthy=False)
+        pool = ConnectionPool(factory, max_size=1, health_check_seconds=0)
+        pool.acquire().close()
+        time.sleep(0.01)
+        pool.acquire().close()
+        stats = pool.stats()
+        self.assertEqual(2, len(factory.connections))
+        self.assertEqual(1, stats["health_check_failures"])
+        self.assertEqual(1, stats["size"])
+
+    def test_factory_error_frees_slot(self):
+        factory = Mock(side_effect=Exception("could not connect"))
+        pool = ConnectionPool(factory, max_size=1)
+        with self.assertRaises(Exception):
+            pool.acquire()
+        self.assertEqual(0, pool.stats()["size"])
+
+    def test_providers_share_pool_for_same_database(self):
+        first = PostGresProvider(DatabaseInfo("host", "db", "user", "pass"))
+        second = PostGresProvider(DatabaseInfo("host", "db", "user", "pass"))
+        other = PostGresProvider(DatabaseInfo("host", "otherdb", "user", "pass"))
+        self.assertIs(first.pool, second.pool)
+        self.assertIsNot(first.pool, other.pool)
+
+    def test_provider_is_created_once_per_database(self):
+        with patch.dict('os.environ', {"DB_HOST": "host", "DB_NAME": "db", "DB_USER": "user", "DB_PASS": "pass"}):
+            first = get_postgres_provider()
+            self.assertIs(first, get_postgres_provider())
+        with patch.dict('os.environ', {"DB_HOST": "host", "DB_NAME": "otherdb", "DB_USER": "user", "DB_PASS": "pass"}):
+            self.assertIsNot(first, get_postgres_provider())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import base64
+import hashlib
+import logging
+import struct
+from urllib.request import Request, urlopen
+
+# Bytes requested when probing an image's dimensions. Comfortably covers PNG and GIF headers and the
+# segments in front of the JPEG frame header, including typical EXIF blocks.
+PROBE_BYTES = 64 * 1024
+
+# MD5 of the whole blob, returned by blob storage for ranged reads
+BLOB_CONTENT_MD5_HEADER = "x-ms-blob-content-md5"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+GIF_SIGNATURES = (b"GIF87a", b"GIF89a")
+JPEG_SOI = b"\xff\xd8"
+# Start of frame markers carrying the image dimensions. C4 (DHT), C8 (JPG) and CC (DAC) share the range but are not frames.
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers with no length field following them
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+
+
+# Reads an image's (width, height) from the start of the file at url. Only the first PROBE_BYTES are requested
+# with an HTTP Range header. Falls back to downloading and opening the whole image if the header can't be parsed.
+def probe_image_size(url, probe_bytes=PROBE_BYTES):
+    width, height, _ = probe_image(url, probe_bytes)
+    return width, height
+
+
+# Like probe_image_size, also returning the image's base64 encoded MD5, or None if it isn't known. Blob storage
+# returns the MD5 of the whole blob with ranged reads when the blob has one. When the whole image has to be
+# downloaded anyway, the MD5 is computed from its bytes.
+def probe_image(url, probe_bytes=PROBE_BYTES):
+    request = Request(url, headers={"Range": "bytes=0-{0}".format(probe_bytes - 1)})
+    with urlopen(request) as response:
+        # Servers that ignore Range answer with the whole body, so never read past what was asked for
+        header = response.read(probe_bytes)
+        content_md5 = response.headers.get(BLOB_CONTENT_MD5_HEADER)
+    size = get_image_size_from_header(header)
+    if size:
+        return size[0], size[1], content_md5
+    logging.info("Could not read image size from the first {0} bytes of {1}, downloading it".format(probe_bytes, url))
+    with urlopen(url) as response:
+        image_bytes = response.read()
+    width, height = get_image_size(image_bytes)
+    return width, height, get_content_md5(image_bytes)
+
+
+# Base64 encoded MD5, the form blob storage keeps as a blob's Content-MD5
+def get_content_md5(image_bytes):
+    return base64.b64encode(hashlib.md5(image_bytes).digest()).decode("ascii")
+
+
+# (width, height) of a complete image held in memory
+def get_image_size(image_bytes):
+    size = get_image_size_from_header(image_bytes)
+    if size:
+        return size
+    # PIL is only needed for formats the header parsers don't know, so it isn't imported up front
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return img.size
+
+
+# Parses (width, height) from the leading bytes of a JPEG, PNG or GIF. Returns None for other formats or when
+# the dimensions are not within the bytes given.
+def get_image_size_from_header(header):
+    if header.startswith(PNG_SIGNATURE):
+        return _get_png_size(header)
+    if header[:6] in GIF_SIGNATURES:
+        return _get_gif_size(header)
+    if header.startswith(JPEG_SOI):
+        return _get_jpeg_size(header)
+    return None
+
+
+def _get_png_size(header):
+    # The IHDR chunk always comes first: length (4), type (4), width (4), height (4)
+    if len(header) < 24 or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def _get_gif_size(header):
+    # Logical screen descriptor follows the 6 byte signature, little endian
+    if len(header) < 10:
+        return None
+    return struct.unpack("<HH", header[6:10])
+
+
+def _get_jpeg_size(header):
+    position = 2
+    while position + 4 <= len(header):
+        if header[position] != 0xFF:
+            return None
+        marker = header[position + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+        if marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        segment_length = struct.unpack(">H", header[position + 2:position + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            # Segment: length (2), precision (1), height (2), width (2)
+            if position + 9 > len(header):
+                return None
+            height, width = struct.unpack(">HH", header[position + 5:position + 9])
+            return width, height
+        position += 2 + segment_length
+    return None
@@ -0,0 +1,79 @@
+import io
+import unittest
+from unittest.mock import patch, MagicMock
+
+from PIL import Image
+
+from . import get_image_size, get_image_size_from_header, probe_image_size, probe_image, get_content_md5
+
+
+def make_image(image_format, width=37, height=21, **save_args):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (120, 40, 200)).save(buffer, format=image_format, **save_args)
+    return buffer.getvalue()
+
+
+def mock_response(data, headers=None):
+    response = MagicMock()
+    response.headers = headers or {}
+    response.read.side_effect = lambda size=-1: data if size < 0 else data[:size]
+    response.__enter__.return_value = response
+    return response
+
+
+class TestImageHeaders(unittest.TestCase):
+    def test_png(self):
+        self.assertEqual((37, 21), get_image_size_from_header(make_image("PNG")[:64]))
+
+    def test_gif(self):
+        self.assertEqual((37, 21), get_image_size_from_header(make_image("GIF")[:64]))
+
+    def test_jpeg(self):
+        self.assertEqual((37, 21), get_image_size_from_header(make_image("JPEG")[:1024]))
+
+    def test_progressive_jpeg(self):
+        self.assertEqual((640, 480), get_image_size_from_header(make_image("JPEG", 640, 480, progressive=True)))
+
+    def test_jpeg_frame_after_large_segment(self):
+        jpeg = make_image("JPEG", 300, 200, exif=b"Exif\x00\x00" + b"\x00" * 40000)
+        self.assertEqual((300, 200), get_image_size_from_header(jpeg[:64 * 1024]))
+        self.assertIsNone(get_image_size_from_header(jpeg[:1024]))
+
+    def test_unknown_format(self):
+        self.assertIsNone(get_image_size_from_header(make_image("BMP")))
+
+    def test_get_image_size_falls_back_to_pil(self):
+        self.assertEqual((37, 21), get_image_size(make_image("BMP")))
+
+
+class TestProbeImageSize(unittest.TestCase):
+    @patch(__package__ + ".urlopen")
+    def test_requests_only_the_header(self, mock_urlopen):
+        mock_urlopen.return_value = mock_response(make_image("PNG", 800, 600))
+        self.assertEqual((800, 600), probe_image_size("https://a/1.png", probe_bytes=1024))
+        self.assertEqual(1, mock_urlopen.call_count)
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual("bytes=0-1023", request.get_header("Range"))
+        mock_urlopen.return_value.read.assert_called_once_with(1024)
+
+    @patch(__package__ + ".urlopen")
+    def test_downloads_whole_image_when_header_is_not_enough(self, mock_urlopen):
+        jpeg = make_image("JPEG", 300, 200, exif=b"Exif\x00\x00" + b"\x00" * 40000)
+        mock_urlopen.side_effect = [mock_response(jpeg), mock_response(jpeg)]
+        self.assertEqual((300, 200), probe_image_size("https://a/1.jpg", probe_bytes=1024))
+        self.assertEqual(2, mock_urlopen.call_count)
+
+    @patch(__package__ + ".urlopen")
+    def test_blob_md5_comes_from_the_ranged_read(self, mock_urlopen):
+        mock_urlopen.return_value = mock_response(make_image("PNG"), {"x-ms-blob-content-md5": "abc=="})
+        self.assertEqual((37, 21, "abc=="), probe_image("https://a/1.png"))
+
+    @patch(__package__ + ".urlopen")
+    def test_md5_is_computed_when_whole_image_is_downloaded(self, mock_urlopen):
+        bmp = make_image("BMP")
+        mock_urlopen.side_effect = [mock_response(bmp), mock_response(bmp)]
+        self.assertEqual((37, 21, get_content_md5(bmp)), probe_image("https://a/1.bmp"))
+
+
+if __name__ == '__main__':
+    unittest.main()
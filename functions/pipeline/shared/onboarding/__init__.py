@@ -1,11 +1,22 @@
 import os
+import json
 import logging
 from enum import Enum
 from datetime import datetime
 import time
-import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
 
-TIMEOUT_SECONDS = 1
+# Server side copies are polled with exponential backoff until they finish or COPY_TIMEOUT_SECONDS passes
+COPY_POLL_INITIAL_SECONDS = 0.5
+COPY_POLL_MAX_SECONDS = 8
+COPY_TIMEOUT_SECONDS = 120
+# Copy Blob answers with these when the destination account can't read the source
+COPY_SOURCE_UNREADABLE_STATUS_CODES = {403, 404}
+# Copies of a batch are started and polled concurrently
+COPY_WORKERS = int(os.getenv('COPY_WORKERS', 16))
+# Temporary blobs are deleted concurrently after onboarding
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', 16))
 
 class CopyStatus(Enum):
     SUCCESS = "success",
@@ -21,95 +32,215 @@ class DeleteStatus(Enum):
     FAILED = "failed",
     TIMEOUT = "timeout" # custom status
 
-# Initiates copy of images from temporary to permanent storage, and checks the status of each operation.
-# Returns two dictionaries, copy_succeeded_dict and copy_error_dict, in the format {sourceURL : destinationURL }.
-def copy_images_to_permanent_storage(image_id_url_map, copy_source, copy_destination, blob_service):
-    copy_initiated_dict = {}        # Dictionary of images for which copy was successfully initiated
-    copy_error_dict = {}            # Dictionary of images for which some error/exception occurred
+# Onboarding queue messages carry up to ONBOARD_BATCH_SIZE images uploaded by one user, and the onboarding job
+# they belong to if any: {"userName": ..., "jobId": ...,
+#                         "images": [{"imageUrl": ..., "fileName": ..., "fileExtension": ..., "directoryComponents": ...,
+#                                     "contentMd5": ... (optional)}]}
+ONBOARD_BATCH_SIZE = int(os.getenv('ONBOARD_BATCH_SIZE', 32))
+# Queue messages are limited to 64 KB once base64 encoded
+MAX_ONBOARD_MESSAGE_BYTES = 48 * 1024
+ONBOARD_QUEUE_NAME = "onboardqueue"
+# Same queue the Functions host moves messages to after repeated failures, so both are handled alike
+ONBOARD_POISON_QUEUE_NAME = "onboardqueue-poison"
+# Container listing work items, one page of blobs per message:
+# {"jobId", "userName", "storageAccount", "storageContainer", "sasToken", "prefix", "marker"}
+ONBOARD_LIST_QUEUE_NAME = "onboardlistqueue"
+ONBOARD_LIST_PAGE_SIZE = int(os.getenv('ONBOARD_LIST_PAGE_SIZE', 1000))
+# Copies still pending when the onboarding function returns are finished by onboardcopyprocessor, which checks
+# them every COPY_FOLLOW_UP_DELAY_SECONDS until they finish or COPY_FOLLOW_UP_MAX_ATTEMPTS checks have been made:
+# {"userId": ..., "attempt": ..., "copies": [{"imageId": ..., "sourceUrl": ..., "destinationUrl": ...}]}
+ONBOARD_COPY_QUEUE_NAME = "onboardcopyqueue"
+COPY_FOLLOW_UP_DELAY_SECONDS = 60
+COPY_FOLLOW_UP_MAX_ATTEMPTS = 60
 
-    # Create new blob names
-    for key, value in image_id_url_map.items():
-        original_blob_url = key
-        # original_blob_name = original_blob_url.split("/")[-1]
+# Yields message bodies batching the images, starting a new message early if one would grow too large
+def build_onboarding_messages(user_name, images, batch_size=ONBOARD_BATCH_SIZE, job_id=None):
+    envelope = {"userName": user_name, "images": []}
+    if job_id is not None:
+        envelope["jobId"] = job_id
+    envelope_bytes = len(json.dumps(envelope))
+    batch = []
+    batch_bytes = envelope_bytes
+    for image in images:
+        # Serialized image plus the separator between list items
+        image_bytes = len(json.dumps(image)) + 2
+        if batch and (len(batch) >= batch_size or batch_bytes + image_bytes > MAX_ONBOARD_MESSAGE_BYTES):
+            yield json.dumps(dict(envelope, images=batch))
+            batch = []
+            batch_bytes = envelope_bytes
+        batch.append(image)
+        batch_bytes += image_bytes
+    if batch:
+        yield json.dumps(dict(envelope, images=batch))
+
+# Returns (user name, list of images, job id or None). Messages queued before batching held a single image
+# at the top level.
+def parse_onboarding_message(msg_json):
+    if "images" in msg_json:
+        return msg_json["userName"], msg_json["images"], msg_json.get("jobId")
+    image = {key: msg_json[key] for key in ("imageUrl", "fileName", "fileExtension", "directoryComponents")}
+    return msg_json["userName"], [image], None
+
+# Queues pending copies, given as [{"imageId", "sourceUrl", "destinationUrl"}], to be checked again after
+# COPY_FOLLOW_UP_DELAY_SECONDS
+def queue_pending_copies(queue_service, user_id, copies, attempt=0):
+    for i in range(0, len(copies), ONBOARD_BATCH_SIZE):
+        message = {"userId": user_id, "attempt": attempt, "copies": copies[i:i + ONBOARD_BATCH_SIZE]}
+        queue_service.put_message(ONBOARD_COPY_QUEUE_NAME, json.dumps(message),
+                                  visibility_timeout=COPY_FOLLOW_UP_DELAY_SECONDS)
+
+class CopyTimeoutError(Exception):
+    pass
+
+# Copies the blob at source_url into container/blob_name. Storage copies the data server side, so it never
+# passes through the function host. Sources the storage account can't read (e.g. another account without a
+# usable signature) are streamed through instead. Returns once the destination blob is complete.
+def copy_blob_from_url(blob_service, container, blob_name, source_url, metadata=None,
+                       timeout_seconds=COPY_TIMEOUT_SECONDS):
+    # The storage SDK is imported on first use, see onboardcontainer
+    from azure.common import AzureHttpError
+    try:
+        copy_properties = blob_service.copy_blob(container, blob_name, source_url, metadata=metadata)
+        status = wait_for_copy(blob_service, container, blob_name, copy_properties, timeout_seconds)
+        if status == "success":
+            return
+        logging.warning("Server side copy of {0} ended with status {1}".format(blob_name, status))
+    except AzureHttpError as e:
+        if e.status_code not in COPY_SOURCE_UNREADABLE_STATUS_CODES:
+            raise
+        logging.warning("Server side copy of {0} not possible: {1}".format(blob_name, e))
+    upload_blob_from_url(blob_service, container, blob_name, source_url, metadata)
+
+# Polls the destination blob until a pending copy finishes and returns its final status
+def wait_for_copy(blob_service, container, blob_name, copy_properties, timeout_seconds=COPY_TIMEOUT_SECONDS):
+    deadline = time.monotonic() + timeout_seconds
+    delay = COPY_POLL_INITIAL_SECONDS
+    status = copy_properties.status
+    while status == "pending":
+        if time.monotonic() + delay > deadline:
+            raise CopyTimeoutError("Copy of {0} still pending after {1}s".format(blob_name, timeout_seconds))
+        time.sleep(delay)
+        delay = min(delay * 2, COPY_POLL_MAX_SECONDS)
+        status = blob_service.get_blob_properties(container, blob_name).properties.copy.status
+    return status
+
+# Streams the source into a block blob in chunks without holding the whole image in memory
+def upload_blob_from_url(blob_service, container, blob_name, source_url, metadata=None):
+    logging.info("Streaming {0} into {1}".format(blob_name, container))
+    with urlopen(source_url) as response:
+        # The response can't seek, so blocks are uploaded one at a time
+        blob_service.create_blob_from_stream(container, blob_name, response, metadata=metadata, max_connections=1)
+
+# Result of copying a batch of images, each dictionary in the format {sourceURL : destinationURL}. Pending copies
+# were accepted by storage but had not finished by the deadline, so they may still complete.
+class CopyResult(object):
+    def __init__(self):
+        self.succeeded = {}
+        self.pending = {}
+        self.failed = {}
+
+# Initiates copy of images from temporary to permanent storage concurrently, then polls the copies that are still
+# pending with exponential backoff until they finish or timeout_seconds passes. Returns a CopyResult.
+def copy_images_to_permanent_storage(image_id_url_map, copy_source, copy_destination, blob_service,
+                                     timeout_seconds=COPY_TIMEOUT_SECONDS):
+    deadline = time.monotonic() + timeout_seconds
+    result = CopyResult()
+
+    # Create new blob names. image_id_url_map is { sourceURL : imageId }
+    copies = []
+    for original_blob_url, image_id in image_id_url_map.items():
         file_extension = os.path.splitext(original_blob_url)[1]
-        image_id = value
         new_blob_name = (str(image_id) + file_extension)
-
         # Create the destination blob URL
         destination_blob_path = blob_service.make_blob_url(copy_destination, new_blob_name)
+        copies.append((original_blob_url, new_blob_name, destination_blob_path))
 
-        # Copy blob from temp storage to permanent storage
-        logging.info("Now initiating copy of image from temporary to permanent storage...")
-        # Log source and destination paths for debugging
-        logging.info("Source path: " + original_blob_url)
-        logging.info("Destination path: " + destination_blob_path)
+    def start_copy(copy):
+        original_blob_url, new_blob_name, destination_blob_path = copy
+        logging.info("Copying {0} to {1}".format(original_blob_url, destination_blob_path))
         try:
-            blob_service.copy_blob(copy_destination, new_blob_name, original_blob_url)
-            logging.info("Done.")
-            # Add to list of items for which we need to check status if copy was initiated successfully
-            copy_initiated_dict[original_blob_url] = destination_blob_path
+            return blob_service.copy_blob(copy_destination, new_blob_name, original_blob_url).status
         except Exception as e:
             logging.error("ERROR: Exception thrown during copy attempt: " + str(e))
-            copy_error_dict[original_blob_url] = destination_blob_path
+            return "failed"
+
+    def get_copy_status(copy):
+        try:
+            return blob_service.get_blob_properties(copy_destination, copy[1]).properties.copy.status
+        except Exception as e:
+            # Transient, the copy is polled again until the deadline
+            logging.warning("Could not get copy status of {0}: {1}".format(copy[1], e))
+            return "pending"
+
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+        statuses = list(executor.map(start_copy, copies))
+        pending = _sort_copies(copies, statuses, result)
 
-    # Wait a few seconds before checking status
-    time.sleep(TIMEOUT_SECONDS)
+        delay = COPY_POLL_INITIAL_SECONDS
+        while pending and time.monotonic() + delay <= deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, COPY_POLL_MAX_SECONDS)
+            pending = _sort_copies(pending, list(executor.map(get_copy_status, pending)), result)
 
-    copy_succeeded_dict = {}        # Dictionary of copy operations that were successful
+    for original_blob_url, _, destination_blob_path in pending:
+        logging.warning("Copy of {0} still pending after {1}s".format(original_blob_url, timeout_seconds))
+        result.pending[original_blob_url] = destination_blob_path
+    return result
 
-    # Get copy status of each item.  If status is succeeded, add to success list.  Otherwise, add to error list.
-    for key, value in copy_initiated_dict.items():
-        target_blob_properties = blob_service.get_blob_properties(copy_destination, value.split("/")[-1])
-        copy_properties = target_blob_properties.properties.copy
-        # logging.info("Copy status of image" + value.split("/")[-1] + " is: " + copy_properties.status)     # Debugging
-        # if copy_properties.status == CopyStatus.SUCCESS:    # Note: Want to remove hard-coding, but this line does not work
-        if copy_properties.status == "success":
-            copy_succeeded_dict[key] = value
+# Records finished copies in result and returns the ones still pending
+def _sort_copies(copies, statuses, result):
+    pending = []
+    for copy, status in zip(copies, statuses):
+        original_blob_url, _, destination_blob_path = copy
+        if status == "success":
+            result.succeeded[original_blob_url] = destination_blob_path
+        elif status == "pending":
+            pending.append(copy)
         else:
-            copy_error_dict[key] = value
-    
-    # Debugging
-    # logging.info("copy_succeeded_dict:")
-    # for key, value in copy_succeeded_dict.items():
-    #     logging.info("Key: " + key + " Value: " + value)
-    # logging.info("copy_error_dict:")
-    # for key, value in copy_error_dict.items():
-    #     logging.info("Key: " + key + " Value: " + value)
-    
-    return copy_succeeded_dict, copy_error_dict
-
-# Initiates deletion of images from temporary storage, and then checks whether the images still exist in the container.
+            result.failed[original_blob_url] = destination_blob_path
+    return pending
+
+# Deletes images from temporary storage concurrently, then lists the container once to check the images no longer exist.
 # Returns two dictionaries, delete_succeeded_dict and delete_error_dict, in the format {sourceURL : destinationURL }.
 def delete_images_from_temp_storage(delete_images_dict, delete_location, blob_service):
-    delete_initiated_dict = {}        # Dictionary of images for which delete was successfully initiated
+    from azure.common import AzureMissingResourceHttpError
     delete_error_dict = {}            # Dictionary of images for which some error/exception occurred
 
-    # Delete blobs from container
-    for key, value in delete_images_dict.items():
-        logging.info("Now initiating delete of image from temp storage...")
-        logging.info("Image to be deleted: " + key)
+    def delete(image_url):
+        blob_name = image_url.split("/")[-1]
+        logging.info("Deleting image from temp storage: " + image_url)
         try:
-            blob_service.delete_blob(delete_location, key.split("/")[-1])
-            logging.info("Done.")
-            # Add to list of items to check status if delete was initiated successfully
-            delete_initiated_dict[key] = value
+            blob_service.delete_blob(delete_location, blob_name)
+            return True
+        except AzureMissingResourceHttpError:
+            # Already gone, e.g. removed by an earlier attempt
+            return True
         except Exception as e:
             logging.error("ERROR: Exception thrown during delete attempt: " + str(e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        deleted = list(executor.map(delete, delete_images_dict.keys()))
+
+    delete_initiated_dict = {}        # Dictionary of images for which delete was successfully initiated
+    for (key, value), succeeded in zip(delete_images_dict.items(), deleted):
+        if succeeded:
+            delete_initiated_dict[key] = value
+        else:
             delete_error_dict[key] = value
 
-    # Wait a few seconds before checking status
-    time.sleep(TIMEOUT_SECONDS)
+    # Blob names still in the container, listed once and limited to the names' common prefix
+    blob_names = [key.split("/")[-1] for key in delete_initiated_dict.keys()]
+    remaining = set()
+    if blob_names:
+        prefix = os.path.commonprefix(blob_names) or None
+        remaining = {blob.name for blob in blob_service.list_blobs(delete_location, prefix=prefix)}
 
     delete_succeeded_dict = {}        # Dictionary of delete operations that were successful
-
-    # List blobs in the source container.  For each image in delete_initiated_dict, if the blob no longer exists,
-    # add to delete_succeeded_dict.  If the blob still exists, add to delete_error_dict.
-    blob_list = blob_service.list_blobs(delete_location)
     for key, value in delete_initiated_dict.items():
-        blob_name = key.split('/')[-1]
-        if blob_name in blob_list:
+        if key.split("/")[-1] in remaining:
             delete_error_dict[key] = value
         else:
             delete_succeeded_dict[key] = value
-    
-    return delete_succeeded_dict, delete_error_dict
\ No newline at end of file
+
+    return delete_succeeded_dict, delete_error_dict
@@ -0,0 +1,163 @@
+import json
+import unittest
+from unittest.mock import Mock, MagicMock, patch
+
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+
+from . import (
+    copy_blob_from_url,
+    wait_for_copy,
+    CopyTimeoutError,
+    copy_images_to_permanent_storage,
+    delete_images_from_temp_storage,
+    build_onboarding_messages,
+    parse_onboarding_message,
+    MAX_ONBOARD_MESSAGE_BYTES
+)
+
+
+def copy_properties(status):
+    properties = Mock()
+    properties.status = status
+    return properties
+
+
+def blob_properties(status):
+    blob = Mock()
+    blob.properties.copy.status = status
+    return blob
+
+
+@patch(__package__ + ".time.sleep")
+class TestCopyBlobFromUrl(unittest.TestCase):
+    def test_synchronous_copy(self, mock_sleep):
+        blob_service = Mock()
+        blob_service.copy_blob.return_value = copy_properties("success")
+        copy_blob_from_url(blob_service, "perm", "1.jpg", "https://src/a.jpg", metadata={"uploadUser": "me"})
+        blob_service.copy_blob.assert_called_once_with("perm", "1.jpg", "https://src/a.jpg", metadata={"uploadUser": "me"})
+        blob_service.get_blob_properties.assert_not_called()
+        blob_service.create_blob_from_stream.assert_not_called()
+
+    def test_polls_pending_copy_with_backoff(self, mock_sleep):
+        blob_service = Mock()
+        blob_service.copy_blob.return_value = copy_properties("pending")
+        blob_service.get_blob_properties.side_effect = [blob_properties("pending"), blob_properties("success")]
+        copy_blob_from_url(blob_service, "perm", "1.jpg", "https://src/a.jpg")
+        self.assertEqual([0.5, 1.0], [c[0][0] for c in mock_sleep.call_args_list])
+        blob_service.create_blob_from_stream.assert_not_called()
+
+    @patch(__package__ + ".urlopen")
+    def test_streams_sources_storage_cannot_read(self, mock_urlopen, mock_sleep):
+        blob_service = Mock()
+        blob_service.copy_blob.side_effect = AzureHttpError("CannotVerifyCopySource", 403)
+        response = MagicMock()
+        mock_urlopen.return_value.__enter__.return_value = response
+        copy_blob_from_url(blob_service, "perm", "1.jpg", "https://src/a.jpg")
+        blob_service.create_blob_from_stream.assert_called_once_with("perm", "1.jpg", response, metadata=None,
+                                                                     max_connections=1)
+
+    def test_other_errors_are_raised(self, mock_sleep):
+        blob_service = Mock()
+        blob_service.copy_blob.side_effect = AzureHttpError("ServerBusy", 503)
+        with self.assertRaises(AzureHttpError):
+            copy_blob_from_url(blob_service, "perm", "1.jpg", "https://src/a.jpg")
+        blob_service.create_blob_from_stream.assert_not_called()
+
+    def test_wait_times_out(self, mock_sleep):
+        blob_service = Mock()
+        blob_service.get_blob_properties.return_value = blob_properties("pending")
+        with self.assertRaises(CopyTimeoutError):
+            wait_for_copy(blob_service, "perm", "1.jpg", copy_properties("pending"), timeout_seconds=0)
+
+
+@patch(__package__ + ".time.sleep")
+class TestCopyImagesToPermanentStorage(unittest.TestCase):
+    def setUp(self):
+        self.blob_service = Mock()
+        self.blob_service.make_blob_url.side_effect = lambda container, blob: "https://perm/" + blob
+        self.image_id_url_map = {"https://temp/a.jpg": 1, "https://temp/b.jpg": 2, "https://temp/c.jpg": 3}
+
+    def test_polls_only_pending_copies(self, mock_sleep):
+        statuses = {"1.jpg": "success", "2.jpg": "pending", "3.jpg": "pending"}
+        self.blob_service.copy_blob.side_effect = lambda container, blob, url: copy_properties(statuses[blob])
+        polls = {"2.jpg": ["success"], "3.jpg": ["pending", "success"]}
+        self.blob_service.get_blob_properties.side_effect = lambda container, blob: blob_properties(polls[blob].pop(0))
+        result = copy_images_to_permanent_storage(self.image_id_url_map, "temp", "perm", self.blob_service)
+        self.assertEqual({"https://temp/a.jpg": "https://perm/1.jpg", "https://temp/b.jpg": "https://perm/2.jpg",
+                          "https://temp/c.jpg": "https://perm/3.jpg"}, result.succeeded)
+        self.assertEqual({}, result.pending)
+        self.assertEqual(3, self.blob_service.get_blob_properties.call_count)
+        self.assertEqual([0.5, 1.0], [c[0][0] for c in mock_sleep.call_args_list])
+
+    def test_slow_copies_are_pending_not_failed(self, mock_sleep):
+        def copy_blob(container, blob, url):
+            if blob == "3.jpg":
+                raise AzureHttpError("ServerBusy", 503)
+            return copy_properties("pending" if blob == "2.jpg" else "failed")
+        self.blob_service.copy_blob.side_effect = copy_blob
+        result = copy_images_to_permanent_storage(self.image_id_url_map, "temp", "perm", self.blob_service,
+                                                  timeout_seconds=0)
+        self.assertEqual({}, result.succeeded)
+        self.assertEqual({"https://temp/b.jpg": "https://perm/2.jpg"}, result.pending)
+        self.assertEqual({"https://temp/a.jpg", "https://temp/c.jpg"}, set(result.failed))
+        mock_sleep.assert_not_called()
+
+
+class TestDeleteImagesFromTempStorage(unittest.TestCase):
+    def test_verifies_with_one_prefixed_listing(self):
+        blob_service = Mock()
+        still_there = Mock()
+        still_there.name = "img_2.jpg"
+        blob_service.list_blobs.return_value = iter([still_there])
+
+        def delete_blob(container, blob):
+            if blob == "img_3.jpg":
+                raise AzureMissingResourceHttpError("BlobNotFound", 404)
+            if blob == "img_4.jpg":
+                raise AzureHttpError("ServerBusy", 503)
+        blob_service.delete_blob.side_effect = delete_blob
+
+        images = {"https://temp/t/img_{0}.jpg".format(i): "https://perm/{0}.jpg".format(i) for i in range(1, 5)}
+        succeeded, failed = delete_images_from_temp_storage(images, "temp", blob_service)
+        self.assertEqual({"https://temp/t/img_1.jpg", "https://temp/t/img_3.jpg"}, set(succeeded))
+        self.assertEqual({"https://temp/t/img_2.jpg", "https://temp/t/img_4.jpg"}, set(failed))
+        blob_service.list_blobs.assert_called_once_with("temp", prefix="img_")
+
+    def test_nothing_to_verify(self):
+        blob_service = Mock()
+        self.assertEqual(({}, {}), delete_images_from_temp_storage({}, "temp", blob_service))
+        blob_service.list_blobs.assert_not_called()
+
+
+def make_images(count, url_length=100):
+    return [{"imageUrl": "https://src/{0}.jpg?".format(i) + "s" * url_length, "fileName": "{0}.jpg".format(i),
+             "fileExtension": ".jpg", "directoryComponents": ""} for i in range(count)]
+
+
+class TestOnboardingMessages(unittest.TestCase):
+    def test_batches_images(self):
+        images = make_images(5)
+        messages = [json.loads(m) for m in build_onboarding_messages("me", images, batch_size=2)]
+        self.assertEqual([2, 2, 1], [len(m["images"]) for m in messages])
+        self.assertEqual(images, [image for m in messages for image in m["images"]])
+        self.assertEqual({"me"}, set(m["userName"] for m in messages))
+
+    def test_messages_stay_under_size_limit(self):
+        messages = list(build_onboarding_messages("me", make_images(100, url_length=2000), batch_size=100))
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(m) <= MAX_ONBOARD_MESSAGE_BYTES for m in messages))
+        self.assertEqual(100, sum(len(json.loads(m)["images"]) for m in messages))
+
+    def test_parses_batched_and_single_image_messages(self):
+        image = make_images(1)[0]
+        self.assertEqual(("me", [image], None), parse_onboarding_message({"userName": "me", "images": [image]}))
+        legacy = dict(image, userName="me")
+        self.assertEqual(("me", [image], None), parse_onboarding_message(legacy))
+
+    def test_job_id_is_carried_by_every_batch(self):
+        messages = list(build_onboarding_messages("me", make_images(3), batch_size=2, job_id=7))
+        self.assertEqual([7, 7], [parse_onboarding_message(json.loads(m))[2] for m in messages])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,32 +1,109 @@
 import logging
 import os
-from urlpath import URL
+import posixpath
+import threading
+from urllib.parse import urlsplit, urlunsplit, unquote
 from datetime import datetime, timedelta
-from azure.storage.blob import BlockBlobService, BlobPermissions
+
+# Signed urls are valid for SAS_EXPIRY. Signatures are reused until SAS_CACHE_MARGIN before they expire, so a
+# url handed out from the cache is always good for at least that long.
+SAS_EXPIRY = timedelta(hours=1)
+SAS_CACHE_MARGIN = timedelta(minutes=10)
+SAS_CACHE_MAX_SIZE = 10000
+
+# Set to "true" to sign perm store urls with one read only container SAS rather than one SAS per blob
+USE_CONTAINER_SAS = os.getenv('PERMSTORE_CONTAINER_SAS', 'false').lower() == 'true'
+
+# The client and signer are module level so they are reused across warm Azure Function invocations
+_perm_store_signer = None
+_perm_store_signer_lock = threading.Lock()
+
 
 def get_signed_url_for_permstore_blob(permstore_url):
-    blob_url = URL(permstore_url)            
+    return get_perm_store_signer().sign(permstore_url)
 
-    # create sas signature
-    blob_service = __get_perm_store_service()
-    sas_signature = blob_service.generate_blob_shared_access_signature(
-        os.getenv('DESTINATION_CONTAINER_NAME'),
-        blob_url.name,
-        BlobPermissions.READ,
-        datetime.utcnow() + timedelta(hours=1)
-    )
 
-    logging.debug("INFO: have sas signature {}".format(sas_signature))
-    signed_url = blob_url.with_query(sas_signature)
-    return signed_url.as_uri()
+def get_signed_urls_for_permstore_blobs(permstore_urls):
+    return get_perm_store_signer().sign_all(permstore_urls)
+
+
+def get_perm_store_signer():
+    global _perm_store_signer
+    with _perm_store_signer_lock:
+        if _perm_store_signer is None:
+            _perm_store_signer = BlobUrlSigner(__get_perm_store_service(), os.getenv('DESTINATION_CONTAINER_NAME'),
+                                               use_container_sas=USE_CONTAINER_SAS)
+        return _perm_store_signer
 
 
 def __get_perm_store_service():
+    # The storage SDK is imported on first use to keep it out of cold starts of requests that don't sign urls
+    from azure.storage.blob import BlockBlobService
     return BlockBlobService(account_name=os.getenv('STORAGE_ACCOUNT_NAME'),
                             account_key=os.getenv('STORAGE_ACCOUNT_KEY'))
 
 
-def get_filepath_from_url(blob_url: URL, storage_container):
+# Appends read only SAS tokens to urls of blobs in a container, caching tokens until shortly before they
+# expire. With use_container_sas a single token for the whole container is shared by every blob.
+class BlobUrlSigner(object):
+    def __init__(self, blob_service, container_name, use_container_sas=False, expiry=SAS_EXPIRY,
+                 cache_margin=SAS_CACHE_MARGIN, cache_max_size=SAS_CACHE_MAX_SIZE):
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.use_container_sas = use_container_sas
+        self.expiry = expiry
+        self.cache_margin = cache_margin
+        self.cache_max_size = cache_max_size
+        # Blob name (None for the container SAS) to (sas token, reuse until)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def sign(self, blob_url):
+        return self.sign_all([blob_url])[0]
+
+    def sign_all(self, blob_urls):
+        now = datetime.utcnow()
+        signed_urls = []
+        with self._lock:
+            for blob_url in blob_urls:
+                # Plain url parsing, urlpath is slow to import and not needed to swap the query
+                parts = urlsplit(str(blob_url))
+                blob_name = unquote(posixpath.basename(parts.path))
+                signed_urls.append(urlunsplit(parts._replace(query=self.__get_signature(blob_name, now))))
+        return signed_urls
+
+    # Must be called holding the lock
+    def __get_signature(self, blob_name, now):
+        key = None if self.use_container_sas else blob_name
+        cached = self._cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        from azure.storage.blob import BlobPermissions, ContainerPermissions
+        expires_at = now + self.expiry
+        if self.use_container_sas:
+            sas_signature = self.blob_service.generate_container_shared_access_signature(
+                self.container_name, ContainerPermissions.READ, expires_at)
+        else:
+            sas_signature = self.blob_service.generate_blob_shared_access_signature(
+                self.container_name, blob_name, BlobPermissions.READ, expires_at)
+        logging.debug("INFO: have sas signature {}".format(sas_signature))
+        # Re-inserted so the cache stays in signing order for eviction
+        self._cache.pop(key, None)
+        if len(self._cache) >= self.cache_max_size:
+            self.__evict(now)
+        self._cache[key] = (sas_signature, expires_at - self.cache_margin)
+        return sas_signature
+
+    # Drops expired signatures, then the oldest ones if the cache is still full
+    def __evict(self, now):
+        self._cache = {k: v for k, v in self._cache.items() if v[1] > now}
+        for key in list(self._cache)[:len(self._cache) - self.cache_max_size + 1]:
+            del self._cache[key]
+
+
+# blob_url is a urlpath URL
+def get_filepath_from_url(blob_url, storage_container):
     blob_uri = blob_url.path
     return __remove_postfix(__remove_prefix(blob_uri, '/' + storage_container), '/' + blob_url.name)
 
@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+
+from . import BlobUrlSigner
+
+
+class TestBlobUrlSigner(unittest.TestCase):
+    def setUp(self):
+        self.blob_service = Mock()
+        self.blob_service.generate_blob_shared_access_signature.side_effect = \
+            lambda container, blob, permission, expiry: "sig=" + blob
+        self.blob_service.generate_container_shared_access_signature.return_value = "sig=container"
+
+    def test_signs_each_blob_once_while_cached(self):
+        signer = BlobUrlSigner(self.blob_service, "perm")
+        urls = ["https://a.blob.core.windows.net/perm/1.jpg", "https://a.blob.core.windows.net/perm/2.jpg"]
+        signed = signer.sign_all(urls + urls)
+        self.assertEqual("https://a.blob.core.windows.net/perm/1.jpg?sig=1.jpg", signed[0])
+        self.assertEqual(signed[:2], signed[2:])
+        self.assertEqual(2, self.blob_service.generate_blob_shared_access_signature.call_count)
+        signer.sign(urls[0])
+        self.assertEqual(2, self.blob_service.generate_blob_shared_access_signature.call_count)
+
+    def test_resigns_before_expiry(self):
+        signer = BlobUrlSigner(self.blob_service, "perm", expiry=timedelta(hours=1), cache_margin=timedelta(minutes=10))
+        url = "https://a.blob.core.windows.net/perm/1.jpg"
+        now = datetime.utcnow()
+        with patch(__package__ + ".datetime") as mock_datetime:
+            mock_datetime.utcnow.return_value = now
+            signer.sign(url)
+            mock_datetime.utcnow.return_value = now + timedelta(minutes=49)
+            signer.sign(url)
+            self.assertEqual(1, self.blob_service.generate_blob_shared_access_signature.call_count)
+            mock_datetime.utcnow.return_value = now + timedelta(minutes=51)
+            signer.sign(url)
+            self.assertEqual(2, self.blob_service.generate_blob_shared_access_signature.call_count)
+
+    def test_container_sas_is_shared_by_all_blobs(self):
+        signer = BlobUrlSigner(self.blob_service, "perm", use_container_sas=True)
+        signed = signer.sign_all(["https://a.blob.core.windows.net/perm/1.jpg",
+                                  "https://a.blob.core.windows.net/perm/2.jpg"])
+        self.assertEqual(["https://a.blob.core.windows.net/perm/1.jpg?sig=container",
+                          "https://a.blob.core.windows.net/perm/2.jpg?sig=container"], signed)
+        self.assertEqual(1, self.blob_service.generate_container_shared_access_signature.call_count)
+        self.blob_service.generate_blob_shared_access_signature.assert_not_called()
+
+    def test_cache_is_bounded(self):
+        signer = BlobUrlSigner(self.blob_service, "perm", cache_max_size=2)
+        signer.sign_all(["https://a.blob.core.windows.net/perm/{0}.jpg".format(i) for i in range(5)])
+        signer.sign("https://a.blob.core.windows.net/perm/5.jpg")
+        self.assertLessEqual(len(signer._cache), 2)
+
+    def test_cache_is_bounded_within_one_call(self):
+        signer = BlobUrlSigner(self.blob_service, "perm", cache_max_size=3)
+        signer.sign_all(["https://a.blob.core.windows.net/perm/{0}.jpg".format(i) for i in range(10)])
+        self.assertEqual(["7.jpg", "8.jpg", "9.jpg"], list(signer._cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,4 @@
 import logging
-import jsonpickle
 from collections import namedtuple
 import azure.functions as func
 import json
@@ -35,7 +34,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 return func.HttpResponse(
                     status_code=200,
                     headers=headers,
-                    body=jsonpickle.encode("Not implemented",unpicklable=False)
+                    body=json.dumps("Not implemented")
                 )
             elif req.method == "POST":
                 payload = json.loads(req.get_body())
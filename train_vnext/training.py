@@ -13,14 +13,25 @@ import sys
 import time
 import jsonpickle
 import json
+from concurrent.futures import ThreadPoolExecutor
 from functions.pipeline.shared.db_access import ImageTagState, PredictionLabel, TrainingSession, Tag
 
 CONFIG_PATH = os.environ.get('ALCONFIG', None)
+LABEL_PAGE_SIZE = 500
+LABEL_DOWNLOAD_WORKERS = 4
+LABEL_PAGE_RETRIES = 3
+# Kept in data_dir, which unlike train_dir survives between training runs
+SYNC_STATE_FILE_NAME = "sync_state.json"
+# Images in these states are part of the training data
+TRAINING_TAG_STATES = [ImageTagState.READY_TO_TAG, ImageTagState.TAG_IN_PROGRESS, ImageTagState.COMPLETED_TAG,
+                       ImageTagState.INCOMPLETE_TAG]
 
 def train(legacy_config, user_name, function_url):
 
-    # First, downloxad data necessary for training
-    training_data = download_data_for_training(user_name, function_url)
+    # First, download the data that changed since the last training run
+    sync_state_path = os.path.join(os.path.expanduser(legacy_config.get('data_dir')), SYNC_STATE_FILE_NAME)
+    sync_state = load_sync_state(sync_state_path)
+    training_data = download_data_for_training(user_name, function_url, sync_state)
 
     # Make sure directory is clean:
     file_location = initialize_training_location(legacy_config)
@@ -35,6 +46,9 @@ def train(legacy_config, user_name, function_url):
     #create label map
     create_pascal_label_map(legacy_config.get('label_map_path'),legacy_config.get('classes').split(","))
 
+    # Only advance the watermark once everything it covers is on disk
+    save_sync_state(sync_state_path, training_data["syncState"])
+
 
 def download_images(image_urls, folder_location): 
     folder_location = os.path.expanduser(folder_location)
@@ -44,14 +58,11 @@ def download_images(image_urls, folder_location):
         print("Directory doesn't exist so downloading all images may take a few minutes...")
         os.makedirs(folder_location)
 
-    existing_files = {os.path.relpath(os.path.join(directory, cur_file), folder_location) for (directory, _, filenames) 
-        in os.walk(folder_location) for cur_file in filenames}
-
     try:
         for image_url in image_urls:
             parsed_url = URL(image_url)
             file_name = parsed_url.name
-            if file_name not in existing_files:
+            if not os.path.exists(os.path.join(folder_location, file_name)):
                 with urllib.request.urlopen(image_url) as response, open(folder_location + '/' + str(file_name), 'wb') as out_file:
                     data = response.read() # a `bytes` object
                     out_file.write(data)      
@@ -61,32 +72,142 @@ def download_images(image_urls, folder_location):
     print("Synced images into " + folder_location)
 
 
-def download_data_for_training(user_name, function_url):
+# Only images and labels changed since the watermark in sync_state are downloaded. They are merged into the
+# images and labels cached in sync_state, which the returned training data is built from.
+def download_data_for_training(user_name, function_url, sync_state=None):
     print("Downloading data for training, this may take a few moments...")
-    # Download all images to begin training
+    sync_state = sync_state or new_sync_state()
+    modified_since = sync_state["watermark"]
+
+    # Labels are downloaded before the images are listed. Their watermark is taken before the listing, so an
+    # image that changes in between is listed now and again by the next sync rather than missed by both.
+    changed_labels, watermark = download_labels(function_url, user_name, sync_state["images"].keys(), modified_since=modified_since)
+    for label in changed_labels:
+        # Images whose labels were all removed come back with none and are dropped from the training set
+        if label["labels"]:
+            sync_state["labels"][str(label["image_id"])] = label
+        else:
+            sync_state["labels"].pop(str(label["image_id"]), None)
+    print("{0} labeled images changed since {1}".format(len(changed_labels), modified_since or "the first sync"))
+
+    # An incremental sync lists changed images in every state, so images that left the training states are dropped
+    tag_states = list(ImageTagState) if modified_since else TRAINING_TAG_STATES
     query = {
         "userName": user_name,
-        "tagStatus": [  int(ImageTagState.READY_TO_TAG),
-                        int(ImageTagState.TAG_IN_PROGRESS),
-                        int(ImageTagState.COMPLETED_TAG),
-                        int(ImageTagState.INCOMPLETE_TAG)]
+        "tagStatus": ",".join(str(int(state)) for state in tag_states)
     }
+    if modified_since:
+        query["modifiedSince"] = modified_since
     url = function_url + '/api/images'
     response = requests.get(url, params=query)
-    all_images_json = response.json()
-    image_urls_to_download = [info['location'] for info in all_images_json]
-
-    # Download upto 200 images that have been tagged, for training
-    query['tagStatus'] = ImageTagState.COMPLETED_TAG
-    query['imageCount'] = 200
-    url = function_url + '/api/labels'
-    response = requests.get(url, params=query)
-    tagged_label_data = response.json()
-
-    tagging_image_data = set([get_image_name_from_url(item['location']) for item in all_images_json if item['tagstate'] == ImageTagState.TAG_IN_PROGRESS])
+    response.raise_for_status()
+    changed_images_json = response.json()
+    image_urls_to_download = []
+    for info in changed_images_json:
+        if info['tagstate'] in TRAINING_TAG_STATES:
+            sync_state["images"][str(info['id'])] = { "name": get_image_name_from_url(info['location']),
+                                                      "tagstate": info['tagstate'] }
+            image_urls_to_download.append(info['location'])
+        else:
+            sync_state["images"].pop(str(info['id']), None)
+    print("{0} images changed since {1}".format(len(changed_images_json), modified_since or "the first sync"))
+    sync_state["watermark"] = watermark or modified_since
+
+    tagging_image_data = set([image['name'] for image in sync_state["images"].values() if image['tagstate'] == ImageTagState.TAG_IN_PROGRESS])
+    tagged_label_data = [sync_state["labels"][image_id] for image_id in sorted(sync_state["labels"], key=int)]
     return { "imageURLs": image_urls_to_download,
              "taggedLabelData": tagged_label_data,
-             "taggingLabelData": tagging_image_data }
+             "taggingLabelData": tagging_image_data,
+             "syncState": sync_state }
+
+def new_sync_state():
+    return { "watermark": None, "images": {}, "labels": {} }
+
+def load_sync_state(sync_state_path):
+    if not os.path.exists(sync_state_path):
+        print("No sync state found at {0}, downloading all training data".format(sync_state_path))
+        return new_sync_state()
+    with open(sync_state_path, 'r') as sync_state_file:
+        return json.load(sync_state_file)
+
+def save_sync_state(sync_state_path, sync_state):
+    dir_name = os.path.dirname(sync_state_path)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    # Write then rename so an interrupted run leaves the previous state intact
+    temp_path = sync_state_path + ".tmp"
+    with open(temp_path, 'w') as sync_state_file:
+        json.dump(sync_state, sync_state_file)
+    os.replace(temp_path, sync_state_path)
+
+# Labels are pulled in keyset pages. The image id space is split into ranges that are paged concurrently,
+# using the known image ids to balance them.
+# Returns the labels and the watermark to pass as modified_since on the next sync.
+def download_labels(function_url, user_name, image_ids, page_size=LABEL_PAGE_SIZE, workers=LABEL_DOWNLOAD_WORKERS, modified_since=None):
+    url = function_url + '/api/labels'
+    ranges = partition_image_id_range(image_ids, workers)
+    labels_by_image_id = {}
+    watermarks = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_label_range, url, user_name, after, before, page_size, modified_since) for after, before in ranges]
+        for future in futures:
+            labels, watermark = future.result()
+            watermarks.append(watermark)
+            # Ranges don't overlap, keying by image id just guards against a page being returned twice
+            for label in labels:
+                labels_by_image_id[label["image_id"]] = label
+    # The earliest watermark covers every page
+    watermark = earliest_watermark(watermarks)
+    return [labels_by_image_id[image_id] for image_id in sorted(labels_by_image_id)], watermark
+
+# Splits the id space into contiguous (after, before) ranges with about the same number of known images in each.
+# The first and last ranges are open ended so labels on images outside the known ids are still fetched.
+def partition_image_id_range(image_ids, partitions):
+    image_ids = sorted(set(int(i) for i in image_ids))
+    if not image_ids or partitions <= 1:
+        return [(None, None)]
+    size = -(-len(image_ids) // partitions)
+    boundaries = image_ids[size::size]
+    afters = [None] + [b - 1 for b in boundaries]
+    befores = boundaries + [None]
+    return list(zip(afters, befores))
+
+def download_label_range(url, user_name, after, before, page_size, modified_since=None):
+    labels = []
+    watermark = None
+    query = { "userName": user_name, "pageSize": page_size }
+    if before is not None:
+        query["before"] = before
+    if modified_since:
+        query["modifiedSince"] = modified_since
+    while True:
+        if after is not None:
+            query["after"] = after
+        page = get_json_with_retries(url, query)
+        labels.extend(page["labels"])
+        watermark = earliest_watermark([watermark, page["watermark"]])
+        # Each page is requested from the last image id seen, so a failed request is retried where it left off
+        after = page["nextAfter"]
+        if after is None:
+            return labels, watermark
+
+# Watermarks are ISO 8601 strings. isoformat() leaves out zero microseconds, so they are compared as datetimes
+# rather than as strings. Returns None if there are none.
+def earliest_watermark(watermarks):
+    timestamps = [datetime.datetime.fromisoformat(w) for w in watermarks if w]
+    return min(timestamps).isoformat() if timestamps else None
+
+def get_json_with_retries(url, query, retries=LABEL_PAGE_RETRIES):
+    for attempt in range(retries):
+        try:
+            response = requests.get(url, params=query)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            if attempt == retries - 1:
+                raise
+            print("Retrying labels request after error: {0}".format(e))
+            time.sleep(2 ** attempt)
 
 def convert_tagging_labels_to_csv(filenames, tagging_output_file_path):
     try:
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.vott_parser import process_vott_json, process_vott_json_file, ijson
+
+#################################################################
+# Times process_vott_json against the implementation it replaced
+# on a synthetic VoTT session, and checks both give the same
+# upload payload. Run with: python3 -m utils.benchmark_vott_parser
+#################################################################
+
+DEFAULT_FRAME_COUNT = 50000
+CLASS_NAMES = ["car", "truck", "road", "water", "cloud", "mountain", "knot", "defect", "person", "tree"]
+
+
+def generate_vott_json(frame_count, seed=0):
+    rng = random.Random(seed)
+    frames = {}
+    for image_id in range(1, frame_count + 1):
+        tags = []
+        for tag_id in range(rng.choice([0, 0, 1, 2, 3, 5])):
+            x, y = rng.uniform(0, 500), rng.uniform(0, 500)
+            tags.append({
+                "x1": x, "x2": x + rng.uniform(1, 100), "y1": y, "y2": y + rng.uniform(1, 100),
+                "width": 600, "height": 600,
+                "box": {"x1": x, "x2": x + 1, "y1": y, "y2": y + 1},
+                "UID": "{0:08x}".format(rng.getrandbits(32)), "id": image_id, "type": "Rectangle",
+                "tags": rng.sample(CLASS_NAMES, rng.choice([1, 1, 2])), "name": tag_id + 1
+            })
+        frames["{0}.jpg".format(image_id)] = tags
+    visited = [name for name in frames if rng.random() < 0.7]
+    return {"frames": frames, "visitedFrames": visited, "inputTags": ",".join(CLASS_NAMES), "scd": False}
+
+
+# process_vott_json before the single pass rewrite, kept for comparison
+def legacy_process_vott_json(json):
+    all_frame_data = json['frames']
+
+    id_to_tags_dict = {}
+    for full_path_key in sorted(all_frame_data.keys()):
+        id_to_tags_dict[_legacy_get_id_from_fullpath(full_path_key)] = \
+            [_legacy_process_json_tag(json_tag) for json_tag in all_frame_data[full_path_key]]
+    all_ids = list(id_to_tags_dict.keys())
+
+    for id in all_ids:
+        if not id_to_tags_dict[id]:
+            del(id_to_tags_dict[id])
+
+    visited_ids = sorted(json['visitedFrames'])
+    for index, filename in enumerate(visited_ids):
+        visited_ids[index] = _legacy_get_id_from_fullpath(filename)
+
+    visited_no_tag_ids = sorted(list(set(visited_ids) - set(id_to_tags_dict.keys())))
+    unvisited_ids = sorted(list(set(all_ids) - set(visited_ids)))
+
+    all_class_name_lists = []
+    unique_class_names = []
+    for val in id_to_tags_dict.values():
+        for v in val:
+            all_class_name_lists.append(v["classes"])
+    for c in set(x for l in all_class_name_lists for x in l):
+        unique_class_names.append(c)
+
+    return {
+            "totalNumImages" : len(all_ids),
+            "numImagesVisted" : len(visited_ids),
+            "numImagesVisitedNoTag": len(visited_no_tag_ids),
+            "numImagesNotVisted" : len(unvisited_ids),
+            "imagesVisited" : visited_ids,
+            "imagesNotVisited" : unvisited_ids,
+            "imagesVisitedNoTag": visited_no_tag_ids,
+            "imageIdToTags": id_to_tags_dict,
+            "uniqueClassNames": unique_class_names
+        }
+
+
+def _legacy_get_id_from_fullpath(fullpath):
+    return int(fullpath.split('/')[-1].split('.')[0])
+
+
+def _legacy_process_json_tag(json_tag):
+    return {
+        "x1": json_tag['x1'],
+        "x2": json_tag['x2'],
+        "y1": json_tag['y1'],
+        "y2": json_tag['y2'],
+        "UID": json_tag["UID"],
+        "id": json_tag["id"],
+        "type": json_tag["type"],
+        "classes": json_tag["tags"],
+        "name": json_tag["name"]
+    }
+
+
+def best_time(func, arg, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+# Class names come from a set, so their order is arbitrary
+def normalized(payload):
+    return dict(payload, uniqueClassNames=sorted(payload["uniqueClassNames"]))
+
+
+def main(frame_count, runs):
+    vott_json = generate_vott_json(frame_count)
+    print("{0} frames".format(frame_count))
+
+    legacy_result, legacy_elapsed = best_time(legacy_process_vott_json, vott_json, runs)
+    print("legacy process_vott_json:  {0:8.1f} ms".format(legacy_elapsed * 1000))
+    result, elapsed = best_time(process_vott_json, vott_json, runs)
+    print("process_vott_json:         {0:8.1f} ms  ({1:.1f}x)".format(elapsed * 1000, legacy_elapsed / elapsed))
+    assert normalized(result) == normalized(legacy_result), "process_vott_json differs from the legacy parser"
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as vott_file:
+        json.dump(vott_json, vott_file)
+    try:
+        file_result, file_elapsed = best_time(process_vott_json_file, vott_file.name, runs)
+        print("process_vott_json_file:    {0:8.1f} ms  ({1}, includes parsing {2:.0f} MB)".format(
+            file_elapsed * 1000, "ijson" if ijson else "json.load", os.path.getsize(vott_file.name) / 2 ** 20))
+        assert normalized(file_result) == normalized(legacy_result), "process_vott_json_file differs from the legacy parser"
+    finally:
+        os.remove(vott_file.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--frames', type=int, default=DEFAULT_FRAME_COUNT,
+                        help='Number of frames in the synthetic VoTT session')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='Runs per implementation, the fastest is reported')
+    args = parser.parse_args()
+    main(args.frames, args.runs)
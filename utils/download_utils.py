@@ -0,0 +1,89 @@
+import os
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DOWNLOAD_WORKERS = 8
+# Large enough that writing a chunk costs far less than receiving it
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF_SECONDS = 1
+# (connect, read) timeouts, a stalled connection is retried rather than hanging the download
+DOWNLOAD_TIMEOUT_SECONDS = (10, 60)
+# Errors worth trying again, anything else (e.g. an expired signature) fails the file straight away
+RETRIABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    pass
+
+
+# Downloads each (url, path) pair, workers at a time. A file already at path with the size the server reports is
+# not downloaded again. Each file is retried with exponential backoff on connection errors and server errors.
+# progress, if given, is called with (number finished, total, path, error or None) as each file finishes.
+# Returns (paths downloaded or already present, [(url, path, error)] for the files that failed).
+def download_files(downloads, workers=DOWNLOAD_WORKERS, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES,
+                   progress=None):
+    downloads = list(downloads)
+    sessions = threading.local()
+
+    def download(url, path):
+        # One session per worker thread so connections are kept alive between its files
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        _download_with_retries(sessions.session, url, path, chunk_size, retries)
+
+    completed = []
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, url, path): (url, path) for url, path in downloads}
+        for future in as_completed(futures):
+            url, path = futures[future]
+            error = future.exception()
+            if error:
+                failures.append((url, path, error))
+            else:
+                completed.append(path)
+            if progress:
+                progress(len(completed) + len(failures), len(downloads), path, error)
+    return completed, failures
+
+
+def _download_with_retries(session, url, path, chunk_size, retries):
+    for attempt in range(retries):
+        try:
+            return _download_file(session, url, path, chunk_size)
+        except (requests.exceptions.RequestException, DownloadError) as e:
+            if attempt == retries - 1 or not _is_retriable(e):
+                raise
+            time.sleep(DOWNLOAD_BACKOFF_SECONDS * 2 ** attempt)
+
+
+# Returns False if the file was already present
+def _download_file(session, url, path, chunk_size):
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+        response.raise_for_status()
+        expected_size = response.headers.get("Content-Length")
+        expected_size = int(expected_size) if expected_size is not None else None
+        if expected_size is not None and os.path.isfile(path) and os.path.getsize(path) == expected_size:
+            return False
+
+        # Written next to the destination and moved into place once complete, so an interrupted download
+        # never leaves a truncated image behind
+        partial_path = str(path) + ".part"
+        with open(partial_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+        received_size = os.path.getsize(partial_path)
+        if expected_size is not None and received_size != expected_size:
+            os.remove(partial_path)
+            raise DownloadError("Download of {0} ended after {1} of {2} bytes".format(url, received_size, expected_size))
+        os.replace(partial_path, str(path))
+        return True
+
+
+def _is_retriable(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRIABLE_STATUS_CODES
+    return True
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, MagicMock, patch
+
+import requests
+
+from .download_utils import download_files
+
+
+def mock_response(data, status_code=200, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = {"Content-Length": str(len(data))} if headers is None else headers
+    response.iter_content.side_effect = lambda chunk_size: [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=response)
+    response.__enter__.return_value = response
+    return response
+
+
+@patch(__package__ + ".download_utils.time.sleep")
+@patch(__package__ + ".download_utils.requests.Session")
+class TestDownloadFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_downloads_in_chunks(self, mock_session, mock_sleep):
+        mock_session.return_value.get.return_value = mock_response(b"x" * 10)
+        completed, failures = download_files([("https://a/1.jpg", self.path("1.jpg"))], chunk_size=4)
+        self.assertEqual([self.path("1.jpg")], completed)
+        self.assertEqual([], failures)
+        with open(self.path("1.jpg"), "rb") as f:
+            self.assertEqual(b"x" * 10, f.read())
+        self.assertFalse(os.path.exists(self.path("1.jpg.part")))
+
+    def test_skips_file_with_matching_size(self, mock_session, mock_sleep):
+        with open(self.path("1.jpg"), "wb") as f:
+            f.write(b"y" * 10)
+        response = mock_response(b"x" * 10)
+        mock_session.return_value.get.return_value = response
+        completed, _ = download_files([("https://a/1.jpg", self.path("1.jpg"))])
+        self.assertEqual([self.path("1.jpg")], completed)
+        response.iter_content.assert_not_called()
+
+    def test_retries_server_errors_with_backoff(self, mock_session, mock_sleep):
+        mock_session.return_value.get.side_effect = [mock_response(b"", 503), mock_response(b"", 503),
+                                                     mock_response(b"x" * 10)]
+        progress = Mock()
+        completed, failures = download_files([("https://a/1.jpg", self.path("1.jpg"))], progress=progress)
+        self.assertEqual([self.path("1.jpg")], completed)
+        self.assertEqual([1, 2], [c[0][0] for c in mock_sleep.call_args_list])
+        progress.assert_called_once_with(1, 1, self.path("1.jpg"), None)
+
+    def test_client_errors_are_not_retried(self, mock_session, mock_sleep):
+        mock_session.return_value.get.return_value = mock_response(b"", 403)
+        completed, failures = download_files([("https://a/1.jpg", self.path("1.jpg"))])
+        self.assertEqual([], completed)
+        self.assertEqual([("https://a/1.jpg", self.path("1.jpg"))], [f[:2] for f in failures])
+        self.assertEqual(1, mock_session.return_value.get.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,11 @@ import unittest
 import json
 import pathlib
 import os
-from unittest.mock import Mock
-from .vott_parser import process_vott_json, create_starting_vott_json, build_id_to_VottImageTag, create_vott_json_from_image_labels
+import tempfile
+import sys
+import types
+from unittest.mock import Mock, patch
+from .vott_parser import _load_ijson, process_vott_json, process_vott_json_file, create_starting_vott_json, build_id_to_VottImageTag, create_vott_json_from_image_labels, create_vott_json_from_checkout_columns, get_frame_hashes, select_frames
 from functions.pipeline.shared.db_access import ImageLabel
 
 class TestVOTTParser(unittest.TestCase):
@@ -18,6 +21,65 @@ class TestVOTTParser(unittest.TestCase):
             self.assertIsNotNone(vott_json["frames"]["199.JPG"])
             self.assertTrue("inputTags" in vott_json)
 
+    def test_create_vott_json_from_checkout_columns(self):
+        dirname, _ = os.path.split(os.path.abspath(__file__))
+        with open(dirname + '/mock_response.json') as f:
+            image_labels = [ImageLabel.fromJson(item) for item in json.load(f)]
+        existing_classification_list = ['road', 'knot', 'car']
+        checkout = json.loads(json.dumps(ImageLabel.toColumns(image_labels)))
+        vott_json, image_urls = create_vott_json_from_checkout_columns(checkout, existing_classification_list)
+        expected_vott_json, expected_image_urls = create_vott_json_from_image_labels(image_labels, existing_classification_list)
+        self.assertEqual(expected_image_urls, image_urls)
+        self.assertEqual(expected_vott_json, vott_json)
+
+
+    def test_frame_hashes_follow_boxes_and_visits(self):
+        tag = {"x1": 1, "x2": 2, "y1": 3, "y2": 4, "tags": ["car"], "UID": "a", "id": 1, "type": "Rectangle", "name": 1}
+        vott_json = {"frames": {"1.jpg": [tag], "2.jpg": []}, "visitedFrames": ["1.jpg"]}
+        hashes = get_frame_hashes(vott_json)
+
+        regenerated_uid = dict(vott_json, frames={"1.jpg": [dict(tag, UID="b")], "2.jpg": []})
+        self.assertEqual(hashes, get_frame_hashes(regenerated_uid))
+        moved = dict(vott_json, frames={"1.jpg": [dict(tag, x2=5)], "2.jpg": []})
+        self.assertNotEqual(hashes["1.jpg"], get_frame_hashes(moved)["1.jpg"])
+        visited = dict(vott_json, visitedFrames=["1.jpg", "2.jpg"])
+        self.assertNotEqual(hashes["2.jpg"], get_frame_hashes(visited)["2.jpg"])
+
+    def test_process_selected_frames(self):
+        tag = {"x1": 1, "x2": 2, "y1": 3, "y2": 4, "tags": ["car"], "UID": "a", "id": 1, "type": "Rectangle", "name": 1}
+        vott_json = {"frames": {"1.jpg": [tag], "2.jpg": [], "3.jpg": []}, "visitedFrames": ["1.jpg", "2.jpg"]}
+        processed = process_vott_json(select_frames(vott_json, ["2.jpg", "3.jpg"]))
+        self.assertEqual({}, processed["imageIdToTags"])
+        self.assertEqual([2], processed["imagesVisitedNoTag"])
+        self.assertEqual([3], processed["imagesNotVisited"])
+
+    def test_process_vott_json_file(self):
+        tag = {"x1": 1.5, "x2": 2, "y1": 3, "y2": 4, "tags": ["car", "truck"], "UID": "a", "id": 10, "type": "Rectangle", "name": 1}
+        vott_json = {"frames": {"10.jpg": [tag], "2.jpg": [], "3.jpg": []}, "visitedFrames": ["10.jpg", "2.jpg"]}
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as vott_file:
+            json.dump(vott_json, vott_file)
+        try:
+            processed = process_vott_json_file(vott_file.name)
+        finally:
+            os.remove(vott_file.name)
+        self.assertEqual({"car", "truck"}, set(processed.pop("uniqueClassNames")))
+        expected = process_vott_json(vott_json)
+        del expected["uniqueClassNames"]
+        self.assertEqual(expected, processed)
+        self.assertEqual([3], processed["imagesNotVisited"])
+
+    def test_old_ijson_is_not_used(self):
+        # ijson 3.0 has kvitems without use_float, 2.x has no kvitems at all
+        ijson_3_0 = types.ModuleType("ijson")
+        ijson_3_0.kvitems = lambda file, prefix: iter(())
+        for old_ijson in (ijson_3_0, types.ModuleType("ijson")):
+            with patch.dict(sys.modules, {"ijson": old_ijson}):
+                self.assertIsNone(_load_ijson())
+
+    def test_missing_ijson_is_not_used(self):
+        with patch.dict(sys.modules, {"ijson": None}):
+            self.assertIsNone(_load_ijson())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,20 @@
+import io
 import json
+import hashlib
 from functions.pipeline.shared.db_access import ImageTag
-import string
-import random 
+
+
+# ijson is optional, only used to stream large VoTT files in process_vott_json_file. It needs ijson 3.1 or later
+# for kvitems(use_float=True), older versions are treated as not installed.
+def _load_ijson():
+    try:
+        import ijson
+        ijson.kvitems(io.BytesIO(b"{}"), "", use_float=True)
+        return ijson
+    except (ImportError, AttributeError, TypeError):
+        return None
+
+ijson = _load_ijson()
 
 # Vott tags have image height & width data as well.
 class VottImageTag(ImageTag):
@@ -11,7 +24,7 @@ class VottImageTag(ImageTag):
         self.image_width = image_width
         self.image_location = image_location
 
-def __build_tag_from_VottImageTag(image_tag):
+def __build_tag_from_VottImageTag(image_tag, uid):
     return {
         "x1": image_tag.x_min,
         "x2": image_tag.x_max,
@@ -20,7 +33,7 @@ def __build_tag_from_VottImageTag(image_tag):
         "width": image_tag.image_width,
         "height": image_tag.image_height,
         "tags": [image_tag.classification_names],
-        "UID": __generate_uid(),
+        "UID": uid,
         "box": {
             "x1": image_tag.x_min,
             "x2": image_tag.x_max,
@@ -52,7 +65,7 @@ def __build_tag_list_from_VottImageTags(image_tag_list):
     tag_list = []
     for image_tag in image_tag_list:
         if image_tag:
-            tag_list.append(__build_tag_from_VottImageTag(image_tag))
+            tag_list.append(__build_tag_from_VottImageTag(image_tag, _get_tag_uid(image_tag.image_id, len(tag_list))))
     return tag_list
 
 
@@ -76,7 +89,7 @@ def create_vott_json_from_image_labels(image_labels, existing_classifications_li
         for tag in label.labels:
             if tag and tag.x_min and tag.x_max and tag.y_min and tag.y_max:
                 vott_image_tag = VottImageTag(label.image_id, tag.x_min, tag.x_max, tag.y_min, tag.y_max, tag.classification_names, label.image_height, label.image_width, label.imagelocation)
-                image_tags.append(__build_tag_from_VottImageTag(vott_image_tag))    
+                image_tags.append(__build_tag_from_VottImageTag(vott_image_tag, _get_tag_uid(label.image_id, len(image_tags))))
 
         frames[image_file_name] = image_tags
 
@@ -94,6 +107,41 @@ def create_vott_json_from_image_labels(image_labels, existing_classifications_li
     }, image_urls
 
 
+# For download function. Builds the VoTT json from a compact checkout (see ImageLabel.toColumns) in one pass
+# over its boxes. Returns the VoTT json and the image urls in checkout order.
+def create_vott_json_from_checkout_columns(checkout, existing_classifications_list):
+    images = checkout["images"]
+    tags = checkout["tags"]
+    classes = checkout["classes"]
+    image_urls = images["location"]
+
+    frame_tags = [[] for _ in image_urls]
+    for image_index, class_index, x1, x2, y1, y2 in zip(tags["image"], tags["class"], tags["x_min"],
+                                                        tags["x_max"], tags["y_min"], tags["y_max"]):
+        image_tags = frame_tags[image_index]
+        image_id = images["id"][image_index]
+        image_tags.append({
+            "x1": x1,
+            "x2": x2,
+            "y1": y1,
+            "y2": y2,
+            "width": images["width"][image_index],
+            "height": images["height"][image_index],
+            "tags": [classes[class_index]],
+            "UID": _get_tag_uid(image_id, len(image_tags)),
+            "box": {"x1": x1, "x2": x2, "y1": y1, "y2": y2},
+            "type": "Rectangle",
+            "id": image_id,
+            "name": 2
+        })
+
+    return {
+        "frames": {__get_filename_from_fullpath(url): image_tags for url, image_tags in zip(image_urls, frame_tags)},
+        "inputTags": ",".join(existing_classifications_list),
+        "scd": False  # Required for VoTT and image processing? unknown if it's also used for video.
+    }, list(image_urls)
+
+
 # For download function
 def create_starting_vott_json(image_id_to_urls, image_id_to_image_tags, existing_classifications_list):
     # "frames"
@@ -118,69 +166,82 @@ def __get_filename_from_fullpath(filename):
     return path_components[-1]
 
 
-def __get_id_from_fullpath(fullpath):
-    return int(__get_filename_from_fullpath(fullpath).split('.')[0])
+# VoTT only needs a tag's UID to be unique, the image id and the tag's position in its frame are enough
+def _get_tag_uid(image_id, tag_index):
+    return "{0}-{1}".format(image_id, tag_index)
 
 
-# Returns a list of processed tags for a single frame
-def __create_tag_data_list(json_tag_list):
-    processed_tags = []
-    for json_tag in json_tag_list:
-        processed_tags.append(__process_json_tag(json_tag))
-    return processed_tags
+# Hash of each frame's state as the labels function sees it: whether it was visited and its boxes and classes.
+# Returns {frame name: hash}. Frames whose hash matches the last upload don't need to be uploaded again.
+def get_frame_hashes(vott_json):
+    visited = {__get_filename_from_fullpath(frame) for frame in vott_json.get('visitedFrames', [])}
+    frame_hashes = {}
+    for frame_name, json_tags in vott_json['frames'].items():
+        boxes = sorted([tag['x1'], tag['x2'], tag['y1'], tag['y2'], sorted(tag['tags'])] for tag in json_tags)
+        frame_state = json.dumps([__get_filename_from_fullpath(frame_name) in visited, boxes])
+        frame_hashes[frame_name] = hashlib.sha1(frame_state.encode('utf-8')).hexdigest()
+    return frame_hashes
 
 
-def __generate_uid(size=8, chars=string.ascii_lowercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+# VoTT json holding only the given frames, for uploading part of a tagging session
+def select_frames(vott_json, frame_names):
+    frame_names = set(frame_names)
+    file_names = {__get_filename_from_fullpath(frame) for frame in frame_names}
+    selected = dict(vott_json)
+    selected['frames'] = {frame: tags for frame, tags in vott_json['frames'].items() if frame in frame_names}
+    selected['visitedFrames'] = [frame for frame in vott_json.get('visitedFrames', [])
+                                 if __get_filename_from_fullpath(frame) in file_names]
+    return selected
 
-def __process_json_tag(json_tag):
-    return {
-        "x1": json_tag['x1'],
-        "x2": json_tag['x2'],
-        "y1": json_tag['y1'],
-        "y2": json_tag['y2'],
-        "UID": json_tag["UID"],
-        "id": json_tag["id"],
-        "type": json_tag["type"],
-        "classes": json_tag["tags"],
-        "name": json_tag["name"]
-    }
 
-
-# For upload function
+# For upload function. Builds the upload payload in a single pass over the frames.
 def process_vott_json(json):
-    all_frame_data = json['frames']
+    return _process_vott_frames(json['frames'].items(), json['visitedFrames'])
+
 
+# Same as process_vott_json, reading the VoTT json from a file. With ijson installed the frames are parsed one
+# at a time instead of loading the whole document first, which keeps memory down for very large sessions.
+def process_vott_json_file(path):
+    if ijson is None:
+        with open(path) as json_file:
+            return process_vott_json(json.load(json_file))
+    with open(path, 'rb') as json_file:
+        visited_frames = list(ijson.items(json_file, 'visitedFrames.item'))
+    with open(path, 'rb') as json_file:
+        return _process_vott_frames(ijson.kvitems(json_file, 'frames', use_float=True), visited_frames)
+
+
+def _process_vott_frames(frames, visited_frames):
     # Scrub filename keys to only have integer Id, drop path and file extensions.
+    # Images with no tags are counted but left out of id_to_tags_dict.
+    all_ids = set()
     id_to_tags_dict = {}
-    for full_path_key in sorted(all_frame_data.keys()):
-        # Map ID to list of processed tag data
-        id_to_tags_dict[__get_id_from_fullpath(full_path_key)] = __create_tag_data_list(all_frame_data[full_path_key])
-    all_ids = list(id_to_tags_dict.keys())
-
-    # Remove images with no tags from dict
-    for id in all_ids:
-        if not id_to_tags_dict[id]:
-            del(id_to_tags_dict[id])
-
-    # Do the same with visitedFrames
-    visited_ids = sorted(json['visitedFrames'])
-    for index, filename in enumerate(visited_ids):
-        visited_ids[index] = __get_id_from_fullpath(filename)
-
-    visited_no_tag_ids = sorted(list(set(visited_ids) - set(id_to_tags_dict.keys())))
-
-    # Unvisisted imageIds
-    unvisited_ids = sorted(list(set(all_ids) - set(visited_ids)))
-
-    #TODO: A cleaner way to do this
-    all_class_name_lists = []
-    unique_class_names = []
-    for val in id_to_tags_dict.values():
-        for v in val:
-            all_class_name_lists.append(v["classes"])
-    for c in set(x for l in all_class_name_lists for x in l):
-        unique_class_names.append(c)
+    unique_class_names = set()
+    for full_path_key, json_tags in frames:
+        image_id = _get_id_from_path(full_path_key)
+        all_ids.add(image_id)
+        if not json_tags:
+            id_to_tags_dict.pop(image_id, None)
+            continue
+        id_to_tags_dict[image_id] = [{
+            "x1": json_tag['x1'],
+            "x2": json_tag['x2'],
+            "y1": json_tag['y1'],
+            "y2": json_tag['y2'],
+            "UID": json_tag["UID"],
+            "id": json_tag["id"],
+            "type": json_tag["type"],
+            "classes": json_tag["tags"],
+            "name": json_tag["name"]
+        } for json_tag in json_tags]
+        for json_tag in json_tags:
+            unique_class_names.update(json_tag["tags"])
+
+    # Visited ids are listed in the order of their file names, as VoTT keeps them
+    visited_ids = [_get_id_from_path(filename) for filename in sorted(visited_frames)]
+    visited_id_set = set(visited_ids)
+    visited_no_tag_ids = sorted(visited_id_set.difference(id_to_tags_dict))
+    unvisited_ids = sorted(all_ids - visited_id_set)
 
     return {
             "totalNumImages" : len(all_ids),
@@ -191,10 +252,15 @@ def process_vott_json(json):
             "imagesNotVisited" : unvisited_ids,
             "imagesVisitedNoTag": visited_no_tag_ids,
             "imageIdToTags": id_to_tags_dict,
-            "uniqueClassNames": unique_class_names
+            "uniqueClassNames": list(unique_class_names)
         }
 
 
+# Integer image id from a frame's file name or path, e.g. "data/12.jpg" -> 12
+def _get_id_from_path(path):
+    return int(path.rpartition('/')[2].partition('.')[0])
+
+
 def main():
     images = {
 		"1.png" : {},